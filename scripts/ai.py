@@ -611,6 +611,8 @@ class Chatbot():
         if not self.enable:
             self.client.cancel_timer()
         self.hybrid_mode = config.hybrid_mode
+        # the hybrid mode publishes the candidate responses
+        self.client.verbose = self.hybrid_mode
         if self.hybrid_mode:
             logger.warn("Enabled hybrid mode")
         self.delay_response = config.delay_response
@@ -25,6 +25,8 @@ if 'HR_CHARACTER_PATH' not in os.environ:
     os.environ['HR_CHARACTER_PATH'] = os.path.join(CWD, 'characters')
 
 from chatbot.server.config import SERVER_LOG_DIR, HISTORY_DIR
+from chatbot.server.config import CHATBOT_LOG_DIR, SERVER_WORKERS
+from chatbot.server.config import RESPONSE_VERBOSE
 
 def init_logging():
     if os.environ.get('ROS_LOG_DIR'):
@@ -65,12 +67,16 @@ from chatbot.server.auth import check_auth, authenticate
 from flask import Flask, request, Response, send_from_directory
 
 from chatbot.server.chatbot_agent import (
-    ask, list_character, session_manager, set_weights, set_context,
+    ask, ask_batch, list_character, session_manager, set_weights, set_context,
     dump_history, dump_session, add_character, list_character_names,
     rate_answer, get_context, said, remove_context, update_config, feedback)
 from chatbot.stats import history_stats
+from chatbot.server.connectivity import monitor as connectivity_monitor
+from chatbot.server.history_writer import history_writer
+from chatbot.server.session_store import get_session_store
+from chatbot.server.prefork import PreforkServer
+from chatbot.server.model import json_encode
 
-json_encode = json.JSONEncoder().encode
 app = Flask(__name__)
 VERSION = 'v2.0'
 ROOT = '/{}'.format(VERSION)
@@ -89,6 +95,13 @@ def client():
     return send_from_directory('public', 'client.html')
 
 
+def _is_verbose(data):
+    """Whether to serialise the candidate responses and the traces"""
+    verbose = data.get('verbose')
+    if verbose is None:
+        return RESPONSE_VERBOSE
+    return verbose.lower() == 'true'
+
 @app.route(ROOT + '/chat', methods=['GET'])
 @requires_auth
 def _chat():
@@ -101,6 +114,7 @@ def _chat():
     request_id = request.headers.get('X-Request-Id')
     marker = data.get('marker', 'default')
     run_id = data.get('run_id', '')
+    verbose = _is_verbose(data)
     try:
         logger.warn("Chat request: %s", data)
         response = ask(
@@ -109,7 +123,8 @@ def _chat():
     except Exception as ex:
         logger.exception(ex)
         raise ex
-    return Response(response.toJSON(), mimetype="application/json")
+    return Response(response.toJSON(verbose=verbose),
+                    mimetype="application/json")
 
 @app.route(ROOT + '/feedback', methods=['GET'])
 @requires_auth
@@ -133,14 +148,28 @@ def _batch_chat():
     if not auth or not check_auth(auth):
         return authenticate()
 
-    questions = request.form.get('questions')
-    questions = json.loads(questions)
-    session = request.form.get('session')
-    lang = request.form.get('lang', 'en-US')
-    responses = []
-    for idx, question in questions:
-        response, ret = ask(str(question), lang, session)
-        responses.append((idx, response, ret))
+    data = request.form
+    questions = json.loads(data.get('questions'))
+    session = data.get('session')
+    lang = data.get('lang', 'en-US')
+    stream = data.get('stream', 'false').lower() == 'true'
+    verbose = _is_verbose(data)
+    request_id = request.headers.get('X-Request-Id')
+    ids = [idx for idx, _ in questions]
+    results = ask_batch(
+        [question for _, question in questions], lang, session,
+        request_id=request_id, marker=data.get('marker', 'default'),
+        run_id=data.get('run_id', ''))
+    if stream:
+        # a line of JSON per question, as it's answered
+        def generate():
+            for i, response in results:
+                yield json_encode(
+                    [ids[i], response.to_dict(verbose)]) + '\n'
+        return Response(generate(), mimetype="application/x-ndjson")
+    responses = [None] * len(questions)
+    for i, response in results:
+        responses[i] = [ids[i], response.to_dict(verbose)]
     return Response(json_encode({'ret': 0, 'response': responses}),
                     mimetype="application/json")
 
@@ -200,7 +229,8 @@ def _start_session():
     sid = session_manager.start_session(
         client_id=client_id, user=user, test=test, refresh=refresh)
     sess = session_manager.get_session(sid)
-    sess.session_context.botname = botname
+    with session_manager.transaction(sess):
+        sess.session_context.botname = botname
     return Response(json_encode({'ret': 0, 'sid': str(sid)}),
                     mimetype="application/json")
 
@@ -352,6 +382,7 @@ def _dump_session():
 @app.route(ROOT + '/chat_history', methods=['GET'])
 @requires_auth
 def _chat_history():
+    history_writer.flush()
     history_stats(HISTORY_DIR, 7)
     history_file = os.path.join(HISTORY_DIR, 'last_7_days.csv')
     if os.path.isfile(history_file):
@@ -367,6 +398,7 @@ def _session_history():
         sid = data.get('session')
         sess = session_manager.get_session(sid)
         fname = sess.dump_file
+        history_writer.flush()
         if fname is not None and os.path.isfile(fname):
             return send_from_directory(
                 os.path.dirname(fname),
@@ -385,13 +417,31 @@ def _ping():
                     mimetype="application/json")
 
 
+@app.route(ROOT + '/status', methods=['GET'])
+@requires_auth
+def _status():
+    memory = session_manager.memory_usage().values()
+    response = {
+        'internet': connectivity_monitor.status(),
+        'sessions': {
+            'count': len(memory),
+            'memory': sum(memory),
+            'max_memory': max(memory) if memory else 0,
+            'avg_memory': sum(memory) / len(memory) if memory else 0,
+        },
+        'context': session_manager.context_stats(),
+    }
+    return Response(json_encode({'ret': 0, 'response': response}),
+                    mimetype="application/json")
+
+
 @app.route(ROOT + '/stats', methods=['GET'])
 @requires_auth
 def _stats():
     try:
         data = request.args
         days = int(data.get('lookback', 7))
-        dump_history()
+        history_writer.flush()
         response = history_stats(HISTORY_DIR, days)
         ret = True
     except Exception as ex:
@@ -409,6 +459,10 @@ def main():
     parser.add_argument(
         '-v', '--verbose',
         dest='verbose', action='store_true', help='Verbose')
+    parser.add_argument(
+        '-w', '--workers',
+        dest='workers', type=int, default=SERVER_WORKERS,
+        help='Number of worker processes')
 
     option = parser.parse_args()
 
@@ -425,7 +479,24 @@ def main():
             os.environ['HR_CHATBOT_SERVER_EXT_PATH']))
         import ext
         ext.load(app, ROOT)
-    app.run(host='0.0.0.0', debug=False, use_reloader=False, port=option.port)
+    if option.workers > 1:
+        if session_manager.store is None:
+            # any worker can get the requests of a session
+            session_manager.store = get_session_store('sqlite:{}'.format(
+                os.path.join(CHATBOT_LOG_DIR, 'sessions.db')))
+
+        def post_fork():
+            session_manager.after_fork()
+            history_writer.after_fork()
+            connectivity_monitor.start()
+
+        server = PreforkServer(
+            app, '0.0.0.0', option.port, option.workers, post_fork)
+        server.run()
+    else:
+        connectivity_monitor.start()
+        app.run(host='0.0.0.0', debug=False, use_reloader=False,
+                port=option.port)
 
 
 if __name__ == '__main__':
@@ -119,6 +119,8 @@ class HRSlackBot(object):
                         botname=self.botname, host=self.host, port=self.port,
                         response_listener=self)
                     client.set_marker('Slack')
+                    # the trace is only sent in the verbose response
+                    client.verbose = bool(self.enable_trace)
                     if self.weights:
                         client.set_weights(self.weights)
                     self.session_manager.add_session(name, self.botname, client.session)
@@ -628,3 +628,17 @@ def create_parser():
     parser.setContentHandler(handler)
     #parser.setFeature(xml.sax.handler.feature_namespaces, True)
     return parser
+
+
+def parse_file(filename, encoding="UTF-8"):
+    """Parse an AIML file and return the dictionary of its categories,
+    mapping (pattern, that, topic) tuples to templates.
+
+    Raises xml.sax.SAXParseException on parse errors.
+
+    """
+    parser = create_parser()
+    handler = parser.getContentHandler()
+    handler.setEncoding(encoding)
+    parser.parse(filename)
+    return handler.categories
@@ -0,0 +1,262 @@
+"""
+Copyright 2015, 2016 Hanson Robotics
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+ 1. Redistributions of source code must retain the above copyright
+    notice, this list of conditions and the following disclaimer.
+ 2. Redistributions in binary form must reproduce the above copyright
+    notice, this list of conditions and the following disclaimer in the
+    documentation and/or other materials provided with the
+    distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE FREEBSD PROJECT OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""This module implements the CompiledMatcher class, a non-recursive
+alternative to PatternMgr._match().
+
+The nested dictionary tree of a PatternMgr is flattened into parallel
+node tables indexed by an integer node id, and every word of the patterns
+is replaced by an integer word id.  Matching walks the tables with an
+explicit stack over (node, segment, word offset) states, trying the
+alternatives in exactly the same order as PatternMgr._match(), and
+remembers the states that are known to fail so that no state is explored
+twice in one match.
+"""
+
+# Segments of the input: the pattern, the 'that' and the 'topic' words.
+_PATTERN = 0
+_THAT = 1
+_TOPIC = 2
+
+# Alternatives left to try at a branch point, in the order of
+# PatternMgr._match().
+_STEP_UNDERSCORE = 0
+_STEP_WORD = 1
+_STEP_BOT_NAME = 2
+_STEP_STAR = 3
+_STEP_FAIL = 4
+# A branch point at the end of a segment, whose template is tried after
+# the next segment fails.
+_STEP_TEMPLATE = 5
+
+
+class CompiledMatcher(object):
+    """Flat, read-only snapshot of the node tree of a PatternMgr."""
+
+    def __init__(self, patternMgr, tables=None):
+        """Compile the node tree of patternMgr, or share the node tables
+        of tables, a CompiledMatcher of the same node tree."""
+        if tables is not None:
+            self.__dict__.update(tables.__dict__)
+        else:
+            self._wordIds = {}
+            # node tables, indexed by node id. -1 means no such child.
+            self._children = []
+            self._underscore = []
+            self._star = []
+            self._botName = []
+            self._that = []
+            self._topic = []
+            self._templates = []
+            # For the nodes that can only continue with a word, the words
+            # they continue with. Used to skip the impossible wildcard
+            # spans.
+            self._anchors = []
+            self._keys = patternMgr
+            self._compile(patternMgr._root)
+        self._botNameId = self._wordId(patternMgr._botName)
+
+    def numNodes(self):
+        """Return the number of nodes in the node table."""
+        return len(self._templates)
+
+    def _wordId(self, word):
+        """Return the integer id of word, allocating one if necessary."""
+        try:
+            return self._wordIds[word]
+        except KeyError:
+            wid = len(self._wordIds)
+            self._wordIds[word] = wid
+            return wid
+
+    def _newNode(self):
+        self._children.append(None)
+        self._underscore.append(-1)
+        self._star.append(-1)
+        self._botName.append(-1)
+        self._that.append(-1)
+        self._topic.append(-1)
+        self._templates.append(None)
+        self._anchors.append(None)
+        return len(self._templates) - 1
+
+    def _compile(self, root):
+        """Flatten the node tree rooted at root. The root gets node id 0."""
+        keys = self._keys
+        stack = [(root, self._newNode())]
+        while stack:
+            node, nid = stack.pop()
+            for key, value in node.iteritems():
+                if key == keys._TEMPLATE:
+                    self._templates[nid] = value
+                    continue
+                child = self._newNode()
+                if key == keys._UNDERSCORE:
+                    self._underscore[nid] = child
+                elif key == keys._STAR:
+                    self._star[nid] = child
+                elif key == keys._BOT_NAME:
+                    self._botName[nid] = child
+                elif key == keys._THAT:
+                    self._that[nid] = child
+                elif key == keys._TOPIC:
+                    self._topic[nid] = child
+                else:
+                    if self._children[nid] is None:
+                        self._children[nid] = {}
+                    self._children[nid][self._wordId(key)] = child
+                stack.append((value, child))
+            if self._underscore[nid] == -1 and self._star[nid] == -1 and \
+                    self._botName[nid] == -1:
+                self._anchors[nid] = self._children[nid] or {}
+
+    def match(self, words, thatWords, topicWords):
+        """Return a tuple (pat, tem) where pat is a list of nodes, starting
+        at the root and leading to the matching pattern, and tem is the
+        matched template.
+
+        The result is the same as PatternMgr._match(words, thatWords,
+        topicWords, root).
+
+        """
+        keys = self._keys
+        wordIds = self._wordIds
+        children = self._children
+        underscores = self._underscore
+        stars = self._star
+        botNames = self._botName
+        templates = self._templates
+        anchors = self._anchors
+        botNameId = self._botNameId
+
+        segWords = (words, thatWords, topicWords)
+        segIds = tuple([wordIds.get(w, -1) for w in s] for s in segWords)
+        # The segment to continue with when a segment runs out of words.
+        # Like _match(), an empty 'that' skips straight to the topic.
+        afterThat = _TOPIC if topicWords else None
+        afterPattern = _THAT if thatWords else afterThat
+        nextSegment = (afterPattern, afterThat, None)
+        segmentNodes = (None, self._that, self._topic)
+        segmentKeys = (None, keys._THAT, keys._TOPIC)
+        stride = max(len(words), len(thatWords), len(topicWords)) + 1
+
+        # Branch points whose alternatives have all failed, and the
+        # branch points still to be resumed:
+        # [node, segment, offset, step, wildcard length, path length]
+        failed = set()
+        stack = []
+        path = []
+        node, seg, pos = 0, _PATTERN, 0
+        while True:
+            # Follow the state forward until it succeeds, reaches a branch
+            # point or a dead end.
+            ids = segIds[seg]
+            if pos == len(ids):
+                template = templates[node]
+                nxt = nextSegment[seg]
+                child = -1 if nxt is None else segmentNodes[nxt][node]
+                if child != -1:
+                    if template is not None:
+                        stack.append(
+                            [node, seg, pos, _STEP_TEMPLATE, 0, len(path)])
+                    path.append(segmentKeys[nxt])
+                    node, seg, pos = child, nxt, 0
+                    continue
+                if template is not None:
+                    return path, template
+            elif underscores[node] == -1 and stars[node] == -1 and (
+                    botNames[node] == -1 or ids[pos] != botNameId):
+                nodeChildren = children[node]
+                if nodeChildren is not None:
+                    child = nodeChildren.get(ids[pos], -1)
+                    if child != -1:
+                        path.append(segWords[seg][pos])
+                        node = child
+                        pos += 1
+                        continue
+            elif ((node * 3 + seg) * stride + pos) not in failed:
+                stack.append([node, seg, pos, _STEP_UNDERSCORE, 1, len(path)])
+
+            # Dead end: resume the latest branch point with alternatives.
+            while stack:
+                frame = stack[-1]
+                node, seg, pos, step, k, pathLen = frame
+                del path[pathLen:]
+                if step == _STEP_TEMPLATE:
+                    return path, templates[node]
+                ids = segIds[seg]
+                child = -1
+                if step == _STEP_UNDERSCORE:
+                    child = underscores[node]
+                    key = keys._UNDERSCORE
+                    if child == -1:
+                        step = _STEP_WORD
+                if step == _STEP_WORD:
+                    frame[3] = _STEP_BOT_NAME
+                    nodeChildren = children[node]
+                    if nodeChildren is not None:
+                        child = nodeChildren.get(ids[pos], -1)
+                        if child != -1:
+                            key = segWords[seg][pos]
+                            pos += 1
+                            break
+                    step = _STEP_BOT_NAME
+                if step == _STEP_BOT_NAME:
+                    frame[3] = _STEP_STAR
+                    child = botNames[node]
+                    if child != -1 and ids[pos] == botNameId:
+                        key = segWords[seg][pos]
+                        pos += 1
+                        break
+                    step = _STEP_STAR
+                if step == _STEP_STAR:
+                    child = stars[node]
+                    key = keys._STAR
+                if child != -1 and step != _STEP_FAIL:
+                    # a wildcard consumes the next k words, at least one.
+                    # Skip the spans after which the child can't continue.
+                    end = len(ids)
+                    p = pos + k
+                    anchor = anchors[child]
+                    if anchor is not None:
+                        while p < end and ids[p] not in anchor:
+                            p += 1
+                    if p <= end:
+                        frame[4] = p - pos + 1
+                        pos = p
+                        break
+                    frame[3] = _STEP_WORD if step == _STEP_UNDERSCORE \
+                        else _STEP_FAIL
+                    frame[4] = 1
+                    continue
+                # all the alternatives of this branch point have failed
+                failed.add((node * 3 + seg) * stride + pos)
+                stack.pop()
+            else:
+                # No matches were found.
+                return (None, None)
+            path.append(key)
+            node = child
@@ -31,6 +31,7 @@ import AimlParser
 import DefaultSubs
 import Utils
 from PatternMgr import PatternMgr
+from SessionView import SessionView
 from WordSub import WordSub
 
 from ConfigParser import ConfigParser
@@ -64,14 +65,24 @@ class Kernel:
     _outputHistory = "_outputHistory"
     # Should always be empty in between calls to respond()
     _inputStack = "_inputStack"
+    # keys to a stack (list) of the wildcard matches of the templates being
+    # processed. Should always be empty in between calls to respond()
+    _matchStack = "_matchStack"
 
     def __init__(self):
         self._verboseMode = True
         self._version = "PyAIML 0.8.6"
         self._brain = PatternMgr()
+        # parsed AIML files, shared with other kernels
+        self._parseCache = None
         self._respondLock = threading.RLock()
+        # Per session locks, used instead of _respondLock when session
+        # locking is enabled.
+        self._sessionLocking = False
+        self._sessionLocks = {}
+        # The state of the respond() call in progress on each thread.
+        self._context = threading.local()
         self._textEncoding = "utf-8"
-        self._trace = []
 
         # set up the sessions
         self._sessions = {}
@@ -167,6 +178,20 @@ class Kernel:
         """Enable/disable verbose output mode."""
         self._verboseMode = isVerbose
 
+    def compiledMatching(self, isCompiled=True):
+        """Enable/disable the compiled (non-recursive) pattern matcher."""
+        self._brain.setCompiled(isCompiled)
+
+    def sessionLocking(self, isSessionLocking=True):
+        """Enable/disable locking per session in respond().
+
+        When enabled, calls to respond() for different sessions run
+        concurrently instead of waiting on one lock for the whole Kernel.
+        The brain must not be changed (learn(), <learn>) while responding.
+
+        """
+        self._sessionLocking = isSessionLocking
+
     def version(self):
         """Return the Kernel's version string."""
         return self._version
@@ -212,6 +237,23 @@ class Kernel:
         if self._verboseMode:
             logger.info("done (%.2f seconds)" % (time.clock() - start))
 
+    def shareBrain(self, kernel):
+        """Use the brain of another kernel instead of a brain of our own.
+
+        The patterns are shared, the bot predicates and the sessions are
+        not. Neither kernel may learn anything afterwards.
+
+        """
+        brain = kernel._brain.share()
+        brain.setBotName(self.getBotPredicate("name"))
+        brain.setCompiled(self._brain._compiled)
+        self._brain = brain
+
+    def setParseCache(self, cache):
+        """Share the parsed AIML files with the other kernels using the
+        same cache dictionary, so that each file is parsed only once."""
+        self._parseCache = cache
+
     def getPredicate(self, name, sessionID=_globalSessionID):
         """Retrieve the current value of the predicate 'name' from the
         specified session.
@@ -297,13 +339,22 @@ class Kernel:
             # Initialize the special reserved predicates
             self._inputHistory: [],
             self._outputHistory: [],
-            self._inputStack: []
+            self._inputStack: [],
+            self._matchStack: []
         }
 
     def _deleteSession(self, sessionID):
         """Delete the specified session."""
         if self._sessions.has_key(sessionID):
             self._sessions.pop(sessionID)
+        self._sessionLocks.pop(sessionID, None)
+
+    def _lock(self, sessionID):
+        """Return the lock that respond() holds for the session."""
+        if not self._sessionLocking:
+            return self._respondLock
+        # setdefault is atomic, so all threads get the same lock.
+        return self._sessionLocks.setdefault(sessionID, threading.RLock())
 
     def getSessionData(self, sessionID=None):
         """Return a copy of the session data dictionary for the
@@ -323,6 +374,28 @@ class Kernel:
             s = self._sessions
         return copy.deepcopy(s)
 
+    def setSessionData(self, sessionID, data):
+        """Replace the session data dictionary of the specified session
+        with a copy of data, such as one returned by getSessionData().
+
+        """
+        with self._lock(sessionID):
+            self._sessions[sessionID] = copy.deepcopy(data)
+
+    def getSessionView(self, sessionID):
+        """Return a read-only view of the session data dictionary for
+        the specified session.
+
+        Unlike getSessionData(), nothing is copied: the view reflects
+        later changes to the session.
+
+        """
+        try:
+            s = self._sessions[sessionID]
+        except KeyError:
+            s = {}
+        return SessionView(s, readOnly=True)
+
     def learn(self, filename):
         """Load and learn the contents of the specified AIML file.
 
@@ -335,19 +408,22 @@ class Kernel:
             if self._verboseMode:
                 logger.info("Loading %s..." % f,)
             start = time.clock()
-            # Load and parse the AIML file.
-            parser = AimlParser.create_parser()
-            handler = parser.getContentHandler()
-            handler.setEncoding(self._textEncoding)
+            cacheKey = (os.path.realpath(f), self._textEncoding)
             try:
-                parser.parse(f)
-            except xml.sax.SAXParseException, msg:
-                err = "\nFATAL PARSE ERROR in file %s:\n%s\n" % (f, msg)
-                errors.append(err)
-                logger.error(err)
-                continue
+                categories = self._parseCache[cacheKey]
+            except (KeyError, TypeError):
+                # Load and parse the AIML file.
+                try:
+                    categories = AimlParser.parse_file(f, self._textEncoding)
+                except xml.sax.SAXParseException, msg:
+                    err = "\nFATAL PARSE ERROR in file %s:\n%s\n" % (f, msg)
+                    errors.append(err)
+                    logger.error(err)
+                    continue
+                if self._parseCache is not None:
+                    self._parseCache[cacheKey] = categories
             # store the pattern/template pairs in the PatternMgr.
-            for key, tem in handler.categories.items():
+            for key, tem in categories.items():
                 self._brain.add(key, tem)
             # Parsing was successful.
             if self._verboseMode:
@@ -368,20 +444,37 @@ class Kernel:
             pass
 
         # prevent other threads from stomping all over us.
-        self._respondLock.acquire()
+        lock = self._lock(sessionID)
+        lock.acquire()
+        try:
+            finalResponse = self._respondSentences(input, sessionID, query)
+        finally:
+            lock.release()
+        try:
+            return finalResponse.encode(self._textEncoding)
+        except UnicodeError:
+            return finalResponse
 
+    def _respondSentences(self, input, sessionID, query):
+        """Respond to each sentence of the input. The caller holds the
+        session lock."""
         # Add the session, if it doesn't already exist
         self._addSession(sessionID)
 
+        querySessionID = None
         if query:
-            # Copy current session data to new query session, and delete it
-            # use
-            sessionData = self.getSessionData(sessionID)
-            sessionID = self._querySessionID
-            self._addSession(sessionID)
-            self._sessions[sessionID].update(sessionData)
-
-        self._trace = []
+            # Layer a throwaway query session over the current session, and
+            # delete it after use. Reads fall through to the current
+            # session, writes stay in the query session.
+            querySessionID = self._querySessionID
+            if self._sessionLocking:
+                # the query sessions of concurrent calls must not collide
+                querySessionID = "%s.%s" % (self._querySessionID, sessionID)
+            self._sessions[querySessionID] = SessionView(
+                self._sessions[sessionID])
+            sessionID = querySessionID
+
+        trace = self._context.trace = []
         # split the input into discrete sentences
         sentences = Utils.sentences(input)
         finalResponse = ""
@@ -411,14 +504,9 @@ class Kernel:
         assert(len(self.getPredicate(self._inputStack, sessionID)) == 0)
 
         if query:
-            self._deleteSession(self._querySessionID)
-        logger.debug("Trace: {}".format(self._trace))
-        # release the lock and return
-        self._respondLock.release()
-        try:
-            return finalResponse.encode(self._textEncoding)
-        except UnicodeError:
-            return finalResponse
+            self._deleteSession(querySessionID)
+        logger.debug("Trace: {}".format(trace))
+        return finalResponse
 
     # This version of _respond() just fetches the response for some input.
     # It does not mess with the input and output histories.  Recursive calls
@@ -461,15 +549,27 @@ class Kernel:
 
         # Determine the final response.
         response = ""
-        elem = self._brain.match(subbedInput, subbedThat, subbedTopic)
+        elem, stars = self._brain.match(
+            subbedInput, subbedThat, subbedTopic, withStars=True)
         if elem is None:
             if self._verboseMode:
                 err = "No match found for input: %s" % input.encode(
                     self._textEncoding)
                 logger.debug(err)
         else:
+            # Remember what the wildcards matched for <star> and friends.
+            matchStack = self.getPredicate(self._matchStack, sessionID)
+            matchStack.append({
+                'star': (subbedInput.split(), stars['star']),
+                'thatstar': (subbedThat.split(), stars['thatstar']),
+                'topicstar': (subbedTopic.split(), stars['topicstar']),
+            })
+            self.setPredicate(self._matchStack, matchStack, sessionID)
             # Process the element into a response string.
-            _response = self._processElement(elem, sessionID).strip()
+            try:
+                _response = self._processElement(elem, sessionID).strip()
+            finally:
+                matchStack.pop()
             response += _response
             response += " "
         response = response.strip()
@@ -510,7 +610,7 @@ class Kernel:
             trace['loc'] = elem[1]['line']
             trace['pattern'] = elem[1]['pattern']
             trace['pattern-loc'] = elem[1]['pattern-loc']
-            self._trace.append(trace)
+            self._context.trace.append(trace)
 
         return _response
 
@@ -962,18 +1062,25 @@ class Kernel:
             index = int(elem[1]['index'])
         except KeyError:
             index = 1
-        # fetch the user's last input
-        inputStack = self.getPredicate(self._inputStack, sessionID)
-        input = self._subbers['normal'].sub(inputStack[-1])
-        # fetch the Kernel's last response (for 'that' context)
-        outputHistory = self.getPredicate(self._outputHistory, sessionID)
+        return self._matchedStar("star", index, sessionID)
+
+    def _matchedStar(self, starType, index, sessionID):
+        """Return the portion of the input matched by the index'th
+        wildcard of the template being processed.
+
+        The 'starType' parameter is one of 'star', 'thatstar' or
+        'topicstar', like in PatternMgr.star().
+
+        """
+        matchStack = self.getPredicate(self._matchStack, sessionID)
+        if not matchStack or index < 1:
+            return ""
+        words, spans = matchStack[-1][starType]
         try:
-            that = self._subbers['normal'].sub(outputHistory[-1])
-        except:
-            that = ""  # there might not be any output yet
-        topic = self.getPredicate("topic", sessionID)
-        response = self._brain.star("star", input, that, topic, index)
-        return response
+            start, end = spans[index - 1]
+        except IndexError:
+            return ""
+        return string.join(words[start:end])
 
     # <system>
     def _processSystem(self, elem, sessionID):
@@ -1054,6 +1161,8 @@ class Kernel:
         # we reduce all stretches of >1 whitespace characters to a single
         # space.  To improve performance, we do this only once for each
         # text element encountered, and save the results for the future.
+        # The text is saved before the flag, so threads responding
+        # concurrently at worst normalize the same text twice.
         if elem[1]["xml:space"] == "default":
             elem[2] = re.sub("\s+", " ", elem[2])
             elem[1]["xml:space"] = "preserve"
@@ -1109,18 +1218,7 @@ class Kernel:
             index = int(elem[1]['index'])
         except KeyError:
             index = 1
-        # fetch the user's last input
-        inputStack = self.getPredicate(self._inputStack, sessionID)
-        input = self._subbers['normal'].sub(inputStack[-1])
-        # fetch the Kernel's last response (for 'that' context)
-        outputHistory = self.getPredicate(self._outputHistory, sessionID)
-        try:
-            that = self._subbers['normal'].sub(outputHistory[-1])
-        except:
-            that = ""  # there might not be any output yet
-        topic = self.getPredicate("topic", sessionID)
-        response = self._brain.star("thatstar", input, that, topic, index)
-        return response
+        return self._matchedStar("thatstar", index, sessionID)
 
     # <think>
     def _processThink(self, elem, sessionID):
@@ -1154,18 +1252,7 @@ class Kernel:
             index = int(elem[1]['index'])
         except KeyError:
             index = 1
-        # fetch the user's last input
-        inputStack = self.getPredicate(self._inputStack, sessionID)
-        input = self._subbers['normal'].sub(inputStack[-1])
-        # fetch the Kernel's last response (for 'that' context)
-        outputHistory = self.getPredicate(self._outputHistory, sessionID)
-        try:
-            that = self._subbers['normal'].sub(outputHistory[-1])
-        except:
-            that = ""  # there might not be any output yet
-        topic = self.getPredicate("topic", sessionID)
-        response = self._brain.star("topicstar", input, that, topic, index)
-        return response
+        return self._matchedStar("topicstar", index, sessionID)
 
     # <uppercase>
     def _processUppercase(self, elem, sessionID):
@@ -1192,13 +1279,23 @@ class Kernel:
         return self.version()
 
     def getTraceDocs(self):
+        """Return the templates used by the last call to respond() on
+        the current thread, most recent first."""
         docs = []
-        for trace in self._trace:
+        for trace in getattr(self._context, 'trace', []):
             docs.append(
                 '{doc}, {loc}, {pattern}, {pattern-loc}'.format(**trace))
         docs.reverse()
         return docs
 
+    def getTracePatterns(self):
+        """Return the patterns of the templates used by the last call to
+        respond() on the current thread, most recent first."""
+        patterns = [trace['pattern']
+                    for trace in getattr(self._context, 'trace', [])]
+        patterns.reverse()
+        return patterns
+
 
 ##################################################
 ### Self-test functions follow                 ###
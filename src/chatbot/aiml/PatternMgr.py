@@ -28,12 +28,14 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # by Dr. Richard Wallace at the following site:
 # http://www.alicebot.org/documentation/matching.html
 
+import gc
 import marshal
 import pprint
 import re
 import string
 import sys
 import logging
+from CompiledMatcher import CompiledMatcher
 
 logger = logging.getLogger('hr.chatbot.aiml.patternmgr')
 
@@ -51,6 +53,10 @@ class PatternMgr:
         self._root = {}
         self._templateCount = 0
         self._botName = u"Nameless"
+        self._compiled = False
+        # compiled matchers by bot name, shared with the PatternMgrs that
+        # share() the node tree.
+        self._matchers = {}
         punctuation = "\"`~!@#$%^&*()-_=+[{]}\|;:',<.>/?"
         self._puncStripRE = re.compile("[" + re.escape(punctuation) + "]")
         self._whitespaceRE = re.compile("\s+", re.LOCALE | re.UNICODE)
@@ -67,6 +73,43 @@ class PatternMgr:
         # Collapse a multi-word name into a single word
         self._botName = unicode(string.join(name.split()))
 
+    def setCompiled(self, compiled=True):
+        """Enable/disable the compiled matcher.
+
+        When enabled, the node tree is flattened into a CompiledMatcher
+        the first time it is needed after a change, and match() and star()
+        use it instead of the recursive _match().
+
+        """
+        self._compiled = compiled
+
+    def share(self):
+        """Return a new PatternMgr that shares the node tree, and the
+        compiled matchers, with this one but has a bot name of its own.
+
+        The node tree must not be changed once it is shared.
+
+        """
+        other = PatternMgr()
+        other._root = self._root
+        other._templateCount = self._templateCount
+        other._botName = self._botName
+        other._compiled = self._compiled
+        other._matchers = self._matchers
+        return other
+
+    def _matchWords(self, words, thatWords, topicWords):
+        """Match the normalised word lists with the enabled matcher."""
+        if self._compiled:
+            matcher = self._matchers.get(self._botName)
+            if matcher is None:
+                # reuse the node tables compiled for another bot name
+                tables = next(self._matchers.itervalues(), None)
+                matcher = CompiledMatcher(self, tables)
+                self._matchers[self._botName] = matcher
+            return matcher.match(words, thatWords, topicWords)
+        return self._match(words, thatWords, topicWords, self._root)
+
     def get_templates(self, d, l):
         for k in d.iterkeys():
             if isinstance(d[k], dict):
@@ -95,15 +138,24 @@ class PatternMgr:
 
     def restore(self, filename):
         """Restore a previously save()d collection of patterns."""
+        # The node tree can be millions of containers, none of them in a
+        # cycle. Don't let the garbage collector scan them over and over
+        # while they are loaded.
+        gcEnabled = gc.isenabled()
+        gc.disable()
         try:
             inFile = open(filename, "rb")
             self._templateCount = marshal.load(inFile)
             self._botName = marshal.load(inFile)
             self._root = marshal.load(inFile)
             inFile.close()
+            self._matchers = {}
         except Exception, e:
             logger.error("Error restoring PatternMgr from file %s:" % filename)
             raise Exception, e
+        finally:
+            if gcEnabled:
+                gc.enable()
 
     def add(self, (pattern, that, topic), template):
         """Add a [pattern/that/topic] tuple and its corresponding template
@@ -162,17 +214,22 @@ class PatternMgr:
         if not node.has_key(self._TEMPLATE):
             self._templateCount += 1
         node[self._TEMPLATE] = template
+        self._matchers.clear()
 
-    def match(self, pattern, that, topic):
+    def match(self, pattern, that, topic, withStars=False):
         """Return the template which is the closest match to pattern. The
         'that' parameter contains the bot's previous response. The 'topic'
         parameter contains the current topic of conversation.
 
         Returns None if no template is found.
 
+        If withStars is true, return a tuple (template, stars) instead,
+        where stars is the match record returned by _starSpans(), or None
+        if no template is found.
+
         """
         if len(pattern) == 0:
-            return None
+            return (None, None) if withStars else None
         # Mutilate the input.  Remove all punctuation and convert the
         # text to all caps.
         input = string.upper(pattern)
@@ -187,10 +244,78 @@ class PatternMgr:
         topicInput = string.upper(topic)
         topicInput = re.sub(self._puncStripRE, " ", topicInput)
 
-        # Pass the input off to the recursive call
-        patMatch, template = self._match(
-            input.split(), thatInput.split(), topicInput.split(), self._root)
-        return template
+        # Pass the input off to the matcher
+        words = input.split()
+        thatWords = thatInput.split()
+        topicWords = topicInput.split()
+        patMatch, template = self._matchWords(words, thatWords, topicWords)
+        if not withStars:
+            return template
+        if template is None:
+            return None, None
+        return template, self._starSpans(
+            patMatch, words, thatWords, topicWords)
+
+    def _starSpans(self, patMatch, words, thatWords, topicWords):
+        """Return the portions of the input matched by the wildcards of
+        patMatch, a pattern returned by _match().
+
+        The result is a dictionary with the keys 'star', 'thatstar' and
+        'topicstar', each one a list of (start, end) word indices, one
+        for each wildcard of the pattern, that or topic segment.
+
+        """
+        segments = {'star': [], 'thatstar': [], 'topicstar': []}
+        segment = segments['star']
+        for node in patMatch:
+            if node == self._THAT:
+                segment = segments['thatstar']
+            elif node == self._TOPIC:
+                segment = segments['topicstar']
+            else:
+                segment.append(node)
+        return {
+            'star': self._alignStars(segments['star'], words),
+            'thatstar': self._alignStars(segments['thatstar'], thatWords),
+            'topicstar': self._alignStars(segments['topicstar'], topicWords),
+        }
+
+    def _alignStars(self, nodes, words):
+        """Return the (start, end) word indices matched by each wildcard
+        in nodes, a segment of a matched pattern.
+
+        Like _match(), each wildcard matches as few words as possible, so
+        the spans are the ones the pattern matched with.
+
+        """
+        spans = []
+        failed = set()
+        # stack of states still to try:
+        # (node index, word index, wildcard length, number of spans)
+        stack = [(0, 0, 1, 0)]
+        while stack:
+            i, pos, length, numSpans = stack.pop()
+            del spans[numSpans:]
+            if i == len(nodes):
+                if pos == len(words):
+                    return spans
+                continue
+            if (i, pos) in failed:
+                continue
+            node = nodes[i]
+            if node == self._STAR or node == self._UNDERSCORE:
+                if pos + length <= len(words):
+                    # first try this span, then the next longer one
+                    stack.append((i, pos, length + 1, numSpans))
+                    stack.append((i + 1, pos + length, 1, numSpans + 1))
+                    spans.append((pos, pos + length))
+                else:
+                    failed.add((i, pos))
+            elif pos < len(words) and words[pos] == node:
+                stack.append((i + 1, pos + 1, 1, numSpans))
+            else:
+                failed.add((i, pos))
+        return []
 
     def star(self, starType, pattern, that, topic, index):
         """Returns a string, the portion of pattern that was matched by a *.
@@ -218,9 +343,9 @@ class PatternMgr:
         topicInput = re.sub(self._puncStripRE, " ", topicInput)
         topicInput = re.sub(self._whitespaceRE, " ", topicInput)
 
-        # Pass the input off to the recursive pattern-matcher
-        patMatch, template = self._match(
-            input.split(), thatInput.split(), topicInput.split(), self._root)
+        # Pass the input off to the pattern-matcher
+        patMatch, template = self._matchWords(
+            input.split(), thatInput.split(), topicInput.split())
         if template == None:
             return ""
 
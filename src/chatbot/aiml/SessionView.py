@@ -0,0 +1,101 @@
+"""
+Copyright 2015, 2016 Hanson Robotics
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+ 1. Redistributions of source code must retain the above copyright
+    notice, this list of conditions and the following disclaimer.
+ 2. Redistributions in binary form must reproduce the above copyright
+    notice, this list of conditions and the following disclaimer in the
+    documentation and/or other materials provided with the
+    distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE FREEBSD PROJECT OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""This module implements the SessionView class, a copy-on-write view of
+the predicates of a Kernel session.
+
+Reads fall through to the underlying session, writes go to a layer of the
+view. A list or dictionary value is copied into the layer the first time
+it is read, so that changing it in place, like the Kernel does with the
+history lists, leaves the underlying session untouched. Only the values
+actually used are copied, instead of the whole session.
+"""
+
+import collections
+import copy
+
+
+class SessionView(collections.MutableMapping):
+    """Copy-on-write view of a session dictionary."""
+
+    def __init__(self, base, readOnly=False):
+        self._base = base
+        self._layer = {}
+        self._deleted = set()
+        self._readOnly = readOnly
+
+    def _checkWritable(self):
+        if self._readOnly:
+            raise TypeError("Session view is read-only")
+
+    def _peek(self, key):
+        """Return the value of key without copying it into the layer."""
+        try:
+            return self._layer[key]
+        except KeyError:
+            if key in self._deleted:
+                raise
+        return self._base[key]
+
+    def __getitem__(self, key):
+        value = self._peek(key)
+        if not self._readOnly and key not in self._layer and \
+                isinstance(value, (list, dict)):
+            value = self._layer[key] = copy.copy(value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._checkWritable()
+        self._layer[key] = value
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        self._checkWritable()
+        if key not in self:
+            raise KeyError(key)
+        self._layer.pop(key, None)
+        self._deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self._layer:
+            return True
+        return key not in self._deleted and key in self._base
+
+    def __iter__(self):
+        for key in self._layer:
+            yield key
+        for key in self._base.keys():
+            if key not in self._layer and key not in self._deleted:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict((k, self._peek(k)) for k in self), memo)
+
+    def has_key(self, key):
+        return key in self
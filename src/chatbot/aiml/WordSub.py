@@ -47,6 +47,12 @@ The following example illustrates this point:
     she says she'd like to help her
 Note that "he" and "he'd" were replaced, but "help" and "her" were
 not.
+
+Instead of one big regex alternation of all the keys, the text is split
+into tokens (runs of word characters and single other characters) and the
+keys are looked up in a trie of lowercased tokens, so each key is indexed
+once whatever its case. Where several keys match at the same place, the
+longest one wins. The results of the most recent inputs are cached.
 """
 
 # 'dict' objects weren't available to subclass from until version 2.2.
@@ -57,45 +63,53 @@ try:
 except:
     from UserDict import UserDict as dict
 
+import collections
 import ConfigParser
 import re
 import string
+import threading
 
 
 class WordSub(dict):
     """All-in-one multiple-string-substitution class."""
 
-    def _wordToRegex(self, word):
-        """Convert a word to a regex object which matches the word."""
-        if word != "" and word[0].isalpha() and word[-1].isalpha():
-            return "\\b%s\\b" % re.escape(word)
-        else:
-            return r"\b%s\b" % re.escape(word)
+    # flags of the regexes that define the word characters
+    _reFlags = 0
+    # number of recent inputs whose results are cached
+    _cacheSize = 256
 
-    def _update_regex(self):
-        """Build re object based on the keys of the current
-        dictionary.
+    def _update_trie(self):
+        """Build the trie of the lowercased tokens of the keys of the
+        current dictionary.
 
         """
-        self._regex = re.compile("|".join(map(self._wordToRegex, self.keys())))
-        self._regexIsDirty = False
+        trie = {}
+        for key in self.keys():
+            node = trie
+            for token in self._tokenRegex.findall(key.lower()):
+                node = node.setdefault(token, {})
+            if node is not trie:
+                node[None] = True
+        self._trie = trie
+        self._firstTokens = frozenset(trie)
+        self._trieIsDirty = False
 
     def __init__(self, defaults={}):
         """Initialize the object, and populate it with the entries in
         the defaults dictionary.
 
         """
-        self._regex = None
-        self._regexIsDirty = True
+        self._tokenRegex = re.compile(r"\w+|\s+|[^\w\s]", self._reFlags)
+        self._wordRegex = re.compile(r"\w", self._reFlags)
+        self._trie = None
+        self._trieIsDirty = True
+        self._cache = collections.OrderedDict()
+        self._cacheLock = threading.Lock()
         for k, v in defaults.items():
             self[k] = v
 
-    def __call__(self, match):
-        """Handler invoked for each regex match."""
-        return self[match.group(0)]
-
     def __setitem__(self, i, y):
-        self._regexIsDirty = True
+        self._trieIsDirty = True
         # for each entry the user adds, we actually add three entrys:
         super(type(self), self).__setitem__(
             string.lower(i), string.lower(y))  # key = value
@@ -106,9 +120,81 @@ class WordSub(dict):
 
     def sub(self, text):
         """Translate text, returns the modified text."""
-        if self._regexIsDirty:
-            self._update_regex()
-        return self._regex.sub(self, text)
+        if self._trieIsDirty:
+            with self._cacheLock:
+                self._cache.clear()
+            self._update_trie()
+        key = (type(text), text)
+        with self._cacheLock:
+            try:
+                # move the entry to the most recent end
+                result = self._cache.pop(key)
+                self._cache[key] = result
+                return result
+            except KeyError:
+                pass
+        result = self._sub(text)
+        with self._cacheLock:
+            self._cache[key] = result
+            if len(self._cache) > self._cacheSize:
+                self._cache.popitem(last=False)
+        return result
+
+    def _sub(self, text):
+        # lowercasing doesn't change the length of the text, so the
+        # offsets of the tokens are the same in text.
+        tokens = self._tokenRegex.findall(text.lower())
+        trie = self._trie
+        first = self._firstTokens
+        starts = [i for i, token in enumerate(tokens) if token in first]
+        if not starts:
+            return text
+        isWord = self._wordRegex.match
+        n = len(tokens)
+        output = []
+        copied = 0  # the end of the text copied to the output
+        pos = 0  # the offset of token t
+        t = 0
+        for start in starts:
+            if start < t:
+                # inside a replaced key
+                continue
+            pos += sum(map(len, tokens[t:start]))
+            t = start
+            # like the regex \b, a key that starts with a non-word
+            # character must follow a word character.
+            if not isWord(tokens[t]) and (t == 0 or not isWord(tokens[t - 1])):
+                continue
+            node = trie[tokens[t]]
+            ends = []
+            u = t + 1
+            end = pos + len(tokens[t])
+            while True:
+                if None in node:
+                    ends.append((u, end))
+                if u == n:
+                    break
+                node = node.get(tokens[u])
+                if node is None:
+                    break
+                end += len(tokens[u])
+                u += 1
+            # the longest key first
+            for u, end in reversed(ends):
+                if not isWord(tokens[u - 1]) and (
+                        u == n or not isWord(tokens[u])):
+                    continue
+                # only the cases that were added match
+                value = dict.get(self, text[pos:end])
+                if value is not None:
+                    output.append(text[copied:pos])
+                    output.append(value)
+                    copied = pos = end
+                    t = u
+                    break
+        output.append(text[copied:])
+        # the result has the type of text, like re.sub()
+        return text[:0].join(output)
 
 # self-test
 if __name__ == "__main__":
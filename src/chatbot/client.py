@@ -68,6 +68,8 @@ class Client(cmd.Cmd, object):
         self.test = test
         self.marker = 'default'
         self.run_id = ''
+        # get the candidate responses and the traces in the answers
+        self.verbose = False
         self.prompt = '[%s]: ' % self.user
         self.botname = botname
         self.chatbot_ip = host
@@ -149,6 +151,7 @@ class Client(cmd.Cmd, object):
             "query": query,
             "marker": self.marker,
             "run_id": self.run_id,
+            "verbose": self.verbose,
         }
 
         headers = {
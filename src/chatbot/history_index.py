@@ -0,0 +1,202 @@
+"""Incremental, columnar index of the chat history.
+
+The session CSV files are only appended to. The index keeps the offset up
+to which each file is read in a manifest, and adds the rows appended since
+then to a partition per day, with a file per column, so that the stats
+read the partitions of the days they look back over and only the columns
+they use.
+"""
+import os
+import csv
+import glob
+import json
+import fcntl
+import logging
+import datetime as dt
+import cPickle as pickle
+from contextlib import contextmanager
+from cStringIO import StringIO
+import pandas as pd
+
+logger = logging.getLogger('hr.chatbot.history_index')
+
+DAY_FORMAT = '%Y%m%d'
+# the line terminator of the csv writer, complete rows end with it
+ROW_END = '\r\n'
+
+
+def history_days(history_dir, days):
+    """The day directories of the last days, -1 for all of them, in
+    order"""
+    today = dt.datetime.utcnow()
+    names = []
+    for d in sorted(glob.glob('{}/*'.format(history_dir))):
+        if os.path.isdir(d):
+            dirname = os.path.basename(d)
+            try:
+                dirdate = dt.datetime.strptime(dirname, DAY_FORMAT)
+            except Exception as ex:
+                logger.error(ex)
+                continue
+            if days == -1 or (today - dirdate).days < days:
+                names.append(dirname)
+    return names
+
+
+def read_rows(fname, offset):
+    """Read the complete rows of the CSV file from offset, without the
+    headers written again in it. Return the rows and the offset after
+    them."""
+    with open(fname) as f:
+        header = None
+        if offset > 0:
+            header = next(csv.reader(f), None)
+            f.seek(offset)
+        data = f.read()
+    end = data.rfind(ROW_END)
+    if end == -1:
+        return [], offset
+    data = data[:end + len(ROW_END)]
+    rows = []
+    for row in csv.reader(StringIO(data)):
+        if not row:
+            continue
+        if header is None or (
+                'Datetime' in header and len(row) == len(header) and
+                row[header.index('Datetime')] == 'Datetime'):
+            header = row
+            continue
+        rows.append(dict(zip(header, [value or None for value in row])))
+    return rows, offset + len(data)
+
+
+class HistoryIndex(object):
+    """The rows of the chat history CSV files, partitioned by day.
+
+    update() reads the rows appended to the files since the last update,
+    from the offsets in the manifest, and adds them to the partitions of
+    their days. The processes that share the history directory take turns
+    to update it.
+    """
+
+    def __init__(self, history_dir, index_dir=None):
+        self.history_dir = history_dir
+        # hidden, so that it's not taken for a day of the history
+        self.index_dir = index_dir or os.path.join(history_dir, '.index')
+        self.manifest = os.path.join(self.index_dir, 'manifest.json')
+
+    @contextmanager
+    def _locked(self):
+        if not os.path.isdir(self.index_dir):
+            os.makedirs(self.index_dir)
+        with open(os.path.join(self.index_dir, 'lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load_manifest(self):
+        """Return the offsets the files are read up to, by their path in
+        the history directory"""
+        if not os.path.isfile(self.manifest):
+            return {}
+        with open(self.manifest) as f:
+            return json.load(f)['files']
+
+    def save_manifest(self, offsets):
+        tmp = '{}.tmp'.format(self.manifest)
+        with open(tmp, 'w') as f:
+            json.dump({'files': offsets}, f)
+        os.rename(tmp, self.manifest)
+
+    def update(self):
+        """Add the rows appended to the history files since the last
+        update. Return the number of rows added."""
+        with self._locked():
+            offsets = self.load_manifest()
+            updated = False
+            count = 0
+            for day in history_days(self.history_dir, -1):
+                rows = []
+                for fname in sorted(glob.glob(
+                        os.path.join(self.history_dir, day, '*.csv'))):
+                    key = os.path.join(day, os.path.basename(fname))
+                    offset = offsets.get(key, 0)
+                    size = os.path.getsize(fname)
+                    if size == offset:
+                        continue
+                    if size < offset:
+                        logger.warn("{} is truncated, read it again".format(
+                            fname))
+                        offset = 0
+                    try:
+                        new_rows, offsets[key] = read_rows(fname, offset)
+                    except Exception as ex:
+                        logger.warn("Reading {} error: {}".format(fname, ex))
+                        continue
+                    rows.extend(new_rows)
+                    updated = True
+                if rows:
+                    self._append(day, rows)
+                    count += len(rows)
+            # after the partitions, the rows of a failed update are read
+            # again, and dropped as duplicates
+            if updated:
+                self.save_manifest(offsets)
+        if count:
+            logger.info("Indexed {} history rows".format(count))
+        return count
+
+    def _append(self, day, rows):
+        df = pd.DataFrame(rows)
+        partition = self.read_partition(day)
+        if partition is not None:
+            df = pd.concat([partition, df], ignore_index=True, sort=False)
+        dirname = os.path.join(self.index_dir, day)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        for column in df.columns:
+            fname = os.path.join(dirname, '{}.pkl'.format(column))
+            tmp = '{}.tmp'.format(fname)
+            with open(tmp, 'wb') as f:
+                pickle.dump(df[column].values, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, fname)
+
+    def _load_column(self, dirname, column):
+        with open(os.path.join(dirname, '{}.pkl'.format(column)), 'rb') as f:
+            return pickle.load(f)
+
+    def read_partition(self, day, columns=None):
+        """The rows of the day, with the columns given or all of them, or
+        None if there are none"""
+        dirname = os.path.join(self.index_dir, day)
+        if not os.path.isdir(dirname):
+            return None
+        stored = sorted(os.path.splitext(name)[0]
+                        for name in os.listdir(dirname)
+                        if name.endswith('.pkl'))
+        if not stored:
+            return None
+        data = {}
+        for column in columns or stored:
+            if column in stored:
+                data[column] = self._load_column(dirname, column)
+        if not data:
+            # none of the columns, but the rows are still there
+            length = len(self._load_column(dirname, stored[0]))
+            return pd.DataFrame(index=range(length), columns=columns)
+        return pd.DataFrame(data, columns=columns or stored)
+
+    def read(self, days, columns=None):
+        """The rows of the last days, -1 for all of them, in the order
+        they were written, or None if there are none. The columns the
+        rows don't have are empty."""
+        dfs = []
+        for day in history_days(self.index_dir, days):
+            df = self.read_partition(day, columns)
+            if df is not None:
+                dfs.append(df)
+        if not dfs:
+            return None
+        return pd.concat(dfs, ignore_index=True, sort=False)
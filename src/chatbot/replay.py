@@ -0,0 +1,191 @@
+"""Replay of the chat history through the AIML characters, to find the
+patterns the questions match.
+
+Usage: python replay.py <output csv> [options]
+"""
+import os
+import csv
+import json
+import logging
+import argparse
+import multiprocessing
+
+logger = logging.getLogger('hr.chatbot.replay')
+
+COLUMNS = ['Offset', 'Datetime', 'User', 'BotName', 'Question', 'Character',
+           'Pattern']
+# the columns of the history rows the replay uses
+REPLAY_COLUMNS = ['Datetime', 'User', 'BotName', 'Lang', 'AnsweredBy',
+                  'Question']
+
+# the registry of the characters, for the worker processes
+_registry = None
+
+
+def history_rows(files):
+    """Yield the rows of the history files in order, without the headers
+    written again in them"""
+    for fname in files:
+        try:
+            with open(fname) as f:
+                for row in csv.DictReader(f):
+                    if row.get('Datetime') == 'Datetime':
+                        continue
+                    yield row
+        except Exception as ex:
+            logger.warn("Reading {} error: {}".format(fname, ex))
+
+
+def _aiml_characters(registry, row):
+    """The AIML characters to ask the question of the row: the one that
+    answered it, or the ones of the bot by level"""
+    from chatbot.server.character import TYPE_AIML
+    character = registry.get(row.get('AnsweredBy'))
+    if character is not None and character.type == TYPE_AIML:
+        return [character]
+    characters = registry.get_by_name(
+        row.get('BotName'), local=False, lang=row.get('Lang') or None)
+    characters.sort(key=lambda c: c.level)
+    return [c for c in characters if c.type == TYPE_AIML]
+
+
+def replay_row(registry, row):
+    """Ask the question of the row as a query. Return the id of the
+    character that answered it and the patterns it matched, most recent
+    first."""
+    question = row.get('Question')
+    if not question:
+        return None, []
+    sid = 'replay.{}'.format(os.getpid())
+    for character in _aiml_characters(registry, row):
+        if character.kernel.respond(question, sid, query=True):
+            return character.id, [
+                pattern.encode('utf-8')
+                for pattern in character.kernel.getTracePatterns()]
+    return None, []
+
+
+def _replay(item):
+    offset, row = item
+    return offset, row, replay_row(_registry, row)
+
+
+class Replay(object):
+    """Replays the history rows and writes the patterns they match to the
+    output CSV, a row per pattern, as they are replayed.
+
+    The rows are replayed in chunks in a pool of worker processes, forked
+    after the characters are loaded. After each chunk the offset of the
+    next row is saved in the checkpoint file, so that a replay that is
+    stopped resumes from there, on the same history files.
+    """
+
+    def __init__(self, characters, output, checkpoint=None, workers=None,
+                 chunk_size=1000):
+        from chatbot.server.registry import CharacterRegistry
+        self.registry = CharacterRegistry(characters)
+        self.output = output
+        self.checkpoint = checkpoint or '{}.checkpoint'.format(output)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+    def load_checkpoint(self, files):
+        """Return the offset to resume from and the size of the output at
+        that offset"""
+        if not os.path.isfile(self.checkpoint) or \
+                not os.path.isfile(self.output):
+            return 0, 0
+        with open(self.checkpoint) as f:
+            checkpoint = json.load(f)
+        if checkpoint['files'] != files:
+            logger.warn("The history files are changed, replay them again")
+            return 0, 0
+        return checkpoint['offset'], checkpoint['size']
+
+    def save_checkpoint(self, files, offset, size):
+        tmp = '{}.tmp'.format(self.checkpoint)
+        with open(tmp, 'w') as f:
+            json.dump({'files': files, 'offset': offset, 'size': size}, f)
+        os.rename(tmp, self.checkpoint)
+
+    def _chunks(self, rows, offset):
+        chunk = []
+        for i, row in enumerate(rows):
+            if i < offset:
+                continue
+            chunk.append((i, row))
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def run(self, files, rows=None):
+        """Replay the rows of the history files, or the rows given, read
+        from them already. Return the number of rows replayed."""
+        global _registry
+        offset, size = self.load_checkpoint(files)
+        if offset:
+            logger.info("Resume from row {}".format(offset))
+        pool = None
+        if self.workers > 1:
+            _registry = self.registry
+            pool = multiprocessing.Pool(self.workers)
+        count = 0
+        try:
+            with open(self.output, 'ab') as f:
+                f.seek(size)
+                f.truncate()
+                writer = csv.writer(f)
+                if size == 0:
+                    writer.writerow(COLUMNS)
+                if rows is None:
+                    rows = history_rows(files)
+                for chunk in self._chunks(rows, offset):
+                    if pool is not None:
+                        results = pool.imap(
+                            _replay, chunk,
+                            max(1, len(chunk) / (self.workers * 4)))
+                    else:
+                        results = (
+                            (i, row, replay_row(self.registry, row))
+                            for i, row in chunk)
+                    for i, row, (character, patterns) in results:
+                        for pattern in patterns or ['']:
+                            writer.writerow([
+                                i, row.get('Datetime'), row.get('User'),
+                                row.get('BotName'), row.get('Question'),
+                                character or '', pattern])
+                    f.flush()
+                    offset = chunk[-1][0] + 1
+                    count += len(chunk)
+                    self.save_checkpoint(files, offset, f.tell())
+                    logger.info("Replayed {} rows".format(offset))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                _registry = None
+        return count
+
+
+if __name__ == '__main__':
+    from chatbot.server.config import CHARACTER_PATH, HISTORY_DIR
+    from chatbot.server.loader import load_characters
+    from chatbot.stats import history_files
+    parser = argparse.ArgumentParser('Chat history replay')
+    parser.add_argument('output', help='Output CSV')
+    parser.add_argument(
+        '--history-dir', default=HISTORY_DIR, help='Chat history directory')
+    parser.add_argument(
+        '--days', type=int, default=-1,
+        help='Replay the last days of the history. Default: all of it')
+    parser.add_argument(
+        '-w', '--workers', type=int, help='Worker processes. Default: CPUs')
+    args = parser.parse_args()
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+    replay = Replay(load_characters(CHARACTER_PATH), args.output,
+                    workers=args.workers)
+    replay.run(history_files(args.history_dir, args.days))
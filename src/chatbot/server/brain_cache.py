@@ -0,0 +1,168 @@
+import os
+import sys
+import glob
+import time
+import hashlib
+import logging
+import tempfile
+import multiprocessing
+from chatbot.aiml import AimlParser
+
+logger = logging.getLogger('hr.chatbot.server.brain_cache')
+
+# Change it to invalidate all the snapshots when the brain format changes
+SNAPSHOT_VERSION = 1
+
+
+class BrainCache(object):
+    """Snapshots of the AIML brains, keyed by the content hash of the
+    sources they are built from. Restoring a snapshot replaces parsing the
+    AIML files."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def key(self, kernel, aiml_files):
+        """The content hash of the AIML files, in the order the kernel
+        learns them, the bot predicates (from the property file) and the
+        word substitutions of the kernel."""
+        h = hashlib.sha1()
+        h.update(repr((SNAPSHOT_VERSION, sys.version, kernel.version(),
+                       kernel._textEncoding)))
+        h.update(repr(sorted(kernel._botPredicates.items())))
+        for name in sorted(kernel._subbers.keys()):
+            h.update(repr((name, sorted(kernel._subbers[name].items()))))
+        for pattern in aiml_files:
+            for f in glob.glob(pattern):
+                with open(f, 'rb') as fp:
+                    content = fp.read()
+                h.update(repr((f, hashlib.sha1(content).hexdigest())))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, '{}.brain'.format(key))
+
+    def restore(self, kernel, key):
+        """Restore the brain of the kernel from the snapshot. Return False
+        if there is no such snapshot."""
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return False
+        try:
+            kernel.loadBrain(path)
+        except Exception as ex:
+            logger.error("Can't restore brain snapshot {}, {}".format(
+                path, ex))
+            return False
+        logger.info("Restored brain snapshot {}".format(path))
+        return True
+
+    def save(self, kernel, key):
+        """Save the brain of the kernel to the snapshot."""
+        path = self.path(key)
+        tmp = None
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # write to a temporary file and rename it, so that other
+            # processes never see a partial snapshot
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            os.close(fd)
+            kernel.saveBrain(tmp)
+            os.rename(tmp, path)
+        except Exception as ex:
+            logger.error("Can't save brain snapshot {}, {}".format(path, ex))
+            if tmp and os.path.isfile(tmp):
+                os.remove(tmp)
+            return False
+        logger.info("Saved brain snapshot {}".format(path))
+        return True
+
+
+def parse_aiml(filename, encoding):
+    """Parse the AIML file in a worker process. Return the categories and
+    the parse time, or None if the file can't be parsed."""
+    start = time.time()
+    try:
+        categories = AimlParser.parse_file(filename, encoding)
+    except Exception:
+        # let the kernel parse it again and report the error
+        return None, time.time() - start
+    return categories, time.time() - start
+
+
+class ParallelParseCache(dict):
+    """Parse cache (see Kernel.setParseCache) filled by a process pool.
+
+    The files are parsed in the background in the order they are
+    prefetched, and are waited for when a kernel learns them.
+    """
+
+    def __init__(self, processes):
+        super(ParallelParseCache, self).__init__()
+        self.pool = multiprocessing.Pool(processes)
+        self.pending = {}
+        # parse time in the workers, and time waited for them
+        self.parse_time = 0
+        self.wait_time = 0
+
+    def prefetch(self, aiml_files, encoding='utf-8'):
+        for pattern in aiml_files:
+            for f in glob.glob(pattern):
+                key = (os.path.realpath(f), encoding)
+                if key in self or key in self.pending:
+                    continue
+                self.pending[key] = self.pool.apply_async(
+                    parse_aiml, (f, encoding))
+
+    def __getitem__(self, key):
+        try:
+            return super(ParallelParseCache, self).__getitem__(key)
+        except KeyError:
+            # raises KeyError for the files that weren't prefetched
+            result = self.pending.pop(key)
+        start = time.time()
+        categories, parse_time = result.get()
+        self.wait_time += time.time() - start
+        self.parse_time += parse_time
+        if categories is None:
+            raise KeyError(key)
+        self[key] = categories
+        return categories
+
+    def close(self):
+        """Stop the workers, and the parsing of the files nobody learned."""
+        self.pool.terminate()
+        self.pool.join()
+        self.pending.clear()
+
+
+class BrainPool(object):
+    """Brains and parsed AIML files shared by the characters that are
+    loaded together."""
+
+    def __init__(self, parsed=None):
+        # the AIML files learned -> the kernel that learned them
+        self.kernels = {}
+        # the parsed AIML files, see Kernel.setParseCache
+        self.parsed = {} if parsed is None else parsed
+
+    def key(self, kernel, aiml_files):
+        files = [os.path.realpath(f)
+                 for pattern in aiml_files for f in glob.glob(pattern)]
+        return (kernel._textEncoding, tuple(files))
+
+    def share(self, kernel, aiml_files):
+        """Let the kernel share the brain of a kernel that has learned the
+        same AIML files. Return False if there is no such kernel."""
+        other = self.kernels.get(self.key(kernel, aiml_files))
+        if other is None:
+            kernel.setParseCache(self.parsed)
+            return False
+        kernel.shareBrain(other)
+        return True
+
+    def add(self, kernel, aiml_files):
+        """Offer the brain of the kernel, that has learned the AIML files,
+        to the other kernels."""
+        self.kernels.setdefault(self.key(kernel, aiml_files), kernel)
@@ -3,7 +3,8 @@ from chatbot.aiml import Kernel
 import logging
 import re
 from config import CHARACTER_PATH
-from chatbot.utils import shorten, check_online
+from chatbot.utils import shorten
+from chatbot.server import connectivity
 from collections import defaultdict
 from pprint import pformat
 from functools import wraps
@@ -16,9 +17,10 @@ logger = logging.getLogger(__name__)
 def respond_requires_internet(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        if check_online(timeout=0.5):
+        if connectivity.monitor.is_online():
             return func(*args, **kwargs)
         else:
+            connectivity.monitor.skipped += 1
             logger.warn("No Internet or unstable Internet")
             dummpy_response = {
                 'text': '',
@@ -43,6 +45,7 @@ class Character(object):
         self.type = TYPE_DEFAULT
         self.stateful = False
         self.lazy = False # If False, t will be called regardless the question is already answered
+        self.timeout = None # Seconds to wait for its response when the tiers are asked concurrently, None for TIER_TIMEOUT
 
     def get_properties(self):
         return self.properties
@@ -68,6 +71,33 @@ class Character(object):
     def remove_context(self, session, key):
         raise NotImplementedError
 
+    def update_context(self, session, context):
+        """Set the context, skipping what hasn't changed. Return the number
+        of keys set."""
+        self.set_context(session, context)
+        return len(context)
+
+    def get_session_state(self, session):
+        """Return the picklable state the character keeps for the session,
+        or None"""
+        return None
+
+    def set_session_state(self, session, state):
+        pass
+
+    def copy_session_state(self, session, tier_session):
+        """Copy the state the character keeps for the session to
+        tier_session, to answer on the copy. Return False if it keeps none
+        here, and answers on the session itself."""
+        return False
+
+    def move_session_state(self, tier_session, session):
+        """Replace the state of the session with the one of tier_session"""
+        pass
+
+    def drop_session_state(self, tier_session):
+        pass
+
     def is_command(self, question):
         return False
 
@@ -121,15 +151,34 @@ class AIMLCharacter(Character):
         self.response_limit = 512
         self.type = TYPE_AIML
 
-    def load_aiml_files(self, kernel, aiml_files):
+    def load_aiml_files(self, kernel, aiml_files, brain_cache=None,
+                        brain_pool=None):
         errors = []
+        for f in aiml_files:
+            if f not in self.aiml_files:
+                self.aiml_files.append(f)
+        key = None
+        fresh = kernel.numCategories() == 0
+        if fresh:
+            if brain_pool is not None and brain_pool.share(kernel, aiml_files):
+                self.logger.info("Share the brain of {}".format(aiml_files))
+                return errors
+            if brain_cache is not None:
+                key = brain_cache.key(kernel, aiml_files)
+                if brain_cache.restore(kernel, key):
+                    if brain_pool is not None:
+                        brain_pool.add(kernel, aiml_files)
+                    return errors
         for f in aiml_files:
             if '*' not in f and not os.path.isfile(f):
                 self.logger.warn("{} is not found".format(f))
             errors.extend(kernel.learn(f))
             self.logger.info("Load {}".format(f))
-            if f not in self.aiml_files:
-                self.aiml_files.append(f)
+        if not errors:
+            if key is not None:
+                brain_cache.save(kernel, key)
+            if fresh and brain_pool is not None:
+                brain_pool.add(kernel, aiml_files)
         return errors
 
     def set_property_file(self, propname):
@@ -240,7 +289,29 @@ class AIMLCharacter(Character):
 
     def get_context(self, session):
         sid = session.sid
-        return self.kernel.getSessionData(sid)
+        return self.kernel.getSessionView(sid)
+
+    def get_session_state(self, session):
+        return self.kernel.getSessionData(session.sid)
+
+    def set_session_state(self, session, state):
+        self.kernel.setSessionData(session.sid, state)
+
+    def copy_session_state(self, session, tier_session):
+        data = self.kernel._sessions.get(session.sid)
+        if data is not None:
+            self.kernel.setSessionData(tier_session.sid, data)
+        return True
+
+    def move_session_state(self, tier_session, session):
+        data = self.kernel._sessions.pop(tier_session.sid, None)
+        self.kernel._sessionLocks.pop(tier_session.sid, None)
+        if data is not None:
+            with self.kernel._lock(session.sid):
+                self.kernel._sessions[session.sid] = data
+
+    def drop_session_state(self, tier_session):
+        self.kernel._deleteSession(tier_session.sid)
 
     def set_context(self, session, context):
         assert isinstance(context, dict)
@@ -253,9 +324,25 @@ class AIMLCharacter(Character):
             if k in ['firstname', 'fullname']:
                 self.kernel.setPredicate('name', v, sid)
 
+    def update_context(self, session, context):
+        sid = session.sid
+        predicates = self.kernel._sessions.get(sid, {})
+        missing = object()
+        changed = {}
+        for k, v in context.iteritems():
+            if k.startswith('_'):
+                continue
+            if predicates.get(k, missing) != v or (
+                    k in ['firstname', 'fullname'] and
+                    predicates.get('name', missing) != v):
+                changed[k] = v
+        if changed:
+            self.set_context(session, changed)
+        return len(changed)
+
     def remove_context(self, session, key):
         sid = session.sid
-        if key in self.get_context(session).keys():
+        if key in self.get_context(session):
             del self.kernel._sessions[sid][key]
             self.logger.info("Removed context {}".format(key))
             return True
@@ -6,28 +6,36 @@ import os
 import re
 import sys
 import math
+import time
 import numpy as np
 import datetime as dt
 reload(sys)
 sys.setdefaultencoding('utf-8')
 import atexit
+import itertools
 from collections import defaultdict, OrderedDict
 
-from threading import RLock
+from threading import RLock, Lock, Event
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
 sync = RLock()
 
 
 logger = logging.getLogger('hr.chatbot.server.chatbot_agent')
 
 from loader import load_characters, dyn_properties
-from config import CHARACTER_PATH, RESET_SESSION_BY_HELLO, config
-CHARACTERS = load_characters(CHARACTER_PATH)
+from config import CHARACTER_PATH, RESET_SESSION_BY_HELLO, SESSION_STORE
+from config import config
+from registry import CharacterRegistry
+CHARACTERS = CharacterRegistry(load_characters(CHARACTER_PATH))
 REVISION = os.environ.get('HR_CHATBOT_REVISION')
 LOCATION = dyn_properties.get('location')
 IP = dyn_properties.get('ip')
 
-from session import ChatSessionManager
-session_manager = ChatSessionManager()
+from session import ChatSessionManager, TierSession
+from session_store import get_session_store
+session_manager = ChatSessionManager(store=get_session_store(SESSION_STORE))
 FALLBACK_LANG = 'en-US'
 
 from chatbot.utils import str_cleanup, do_translate, norm2
@@ -36,18 +44,11 @@ from model import Response, Request, RESPONSE_TYPE_WEIGHTS
 import codes
 
 def get_character(id, lang=None, ns=None):
-    for character in CHARACTERS:
-        if (ns is not None and character.name != ns) or character.id != id:
-            continue
-        if lang is None:
-            return character
-        elif lang in character.languages:
-            return character
+    return CHARACTERS.get(id, lang, ns)
 
 
 def add_character(character):
-    if character.id not in [c.id for c in CHARACTERS]:
-        CHARACTERS.append(character)
+    if CHARACTERS.add(character):
         return True, "Character added"
     # TODO: Update character
     else:
@@ -59,23 +60,7 @@ def is_local_character(character):
 
 
 def get_characters_by_name(name, local=True, lang=None, user=None):
-    characters = []
-    _characters = [c for c in CHARACTERS if c.name == name]
-    if local:
-        _characters = [c for c in _characters if is_local_character(c)]
-    if lang is not None:
-        _characters = [c for c in _characters if lang in c.languages]
-
-    if user is not None:
-        for c in _characters:
-            toks = c.id.split('/')
-            if len(toks) == 2:
-                if toks[0] == user:
-                    characters.append(c)
-            else:
-                characters.append(c)
-    else:
-        characters = _characters
+    characters = CHARACTERS.get_by_name(name, local, lang, user)
     if not characters:
         logger.warn('No character is satisfied')
     return characters
@@ -141,25 +126,29 @@ def set_context(prop, sid):
     session = session_manager.get_session(sid)
     if session is None:
         return False, "No session"
-    for c in CHARACTERS:
-        try:
-            c.set_context(session, prop)
-        except Exception:
-            pass
+    with session_manager.transaction(session):
+        session.context_key = None
+        for c in CHARACTERS:
+            try:
+                c.set_context(session, prop)
+            except Exception:
+                pass
     return True, "Context is updated"
 
 def remove_context(keys, sid):
     session = session_manager.get_session(sid)
     if session is None:
         return False, "No session"
-    for c in CHARACTERS:
-        if c.type != TYPE_AIML and c.type != TYPE_CS:
-            continue
-        try:
-            for key in keys:
-                c.remove_context(session, key)
-        except Exception:
-            pass
+    with session_manager.transaction(session):
+        session.context_key = None
+        for c in CHARACTERS:
+            if c.type != TYPE_AIML and c.type != TYPE_CS:
+                continue
+            try:
+                for key in keys:
+                    c.remove_context(session, key)
+            except Exception:
+                pass
     return True, "Context is updated"
 
 def get_context(sid, lang):
@@ -207,12 +196,14 @@ def preprocessing(question, lang):
     question = question.replace('sofia', 'sophia')
     return question
 
-def _ask_character(stage, character, request, response):
-    logger.info("Asking character {} \"{}\" in stage {}".format(
-        character.id, request.question, stage))
-
-    session = session_manager.get_session(request.sid)
-    tier_response = character.respond(request.question, request.lang, session, request.query, request.id)
+def _ask_character(stage, character, request, response, tier_response=None):
+    """Ask the character, or merge the tier_response it has already given,
+    into the response"""
+    if tier_response is None:
+        logger.info("Asking character {} \"{}\" in stage {}".format(
+            character.id, request.question, stage))
+        session = session_manager.get_session(request.sid)
+        tier_response = character.respond(request.question, request.lang, session, request.query, request.id)
     answer = str_cleanup(tier_response.get('text', ''))
     answered = False
     trace = tier_response.get('trace')
@@ -276,6 +267,109 @@ def pickone(items, weights=None):
     logger.info("Picked %s from cache by p=%s" % (item, pweights))
     return item
 
+tier_pool = None
+
+def get_tier_pool():
+    global tier_pool
+    with sync:
+        if tier_pool is None:
+            tier_pool = ThreadPool(config['TIER_WORKERS'])
+    return tier_pool
+
+class _TierCall(object):
+    """A character asked in the tier pool. The characters that keep a state
+    for the session answer on a copy of it, which is moved to the session
+    if they answer in time, and dropped if they are late."""
+
+    _count = itertools.count()
+
+    def __init__(self, character, request, session):
+        self.character = character
+        self.session = session
+        self.tier_session = TierSession(
+            session, '{}.tier{}'.format(session.sid, next(self._count)))
+        if not character.copy_session_state(session, self.tier_session):
+            self.tier_session = session
+        timeout = character.timeout
+        if timeout is None:
+            timeout = config['TIER_TIMEOUT']
+        self.start = time.time()
+        self.deadline = self.start + timeout
+        self.lock = Lock()
+        self.done = False
+        self.abandoned = False
+        self.result = get_tier_pool().apply_async(
+            _respond, (self, request))
+
+    def finish(self):
+        """The tier is done. Return whether it's still waited for."""
+        with self.lock:
+            self.done = True
+            if self.abandoned:
+                self.drop()
+            return not self.abandoned
+
+    def abandon(self):
+        """Stop waiting for the tier. Return False if it's done already."""
+        with self.lock:
+            if self.done:
+                return False
+            self.abandoned = True
+            return True
+
+    def drop(self):
+        if self.tier_session is not self.session:
+            self.character.drop_session_state(self.tier_session)
+
+def _respond(call, request):
+    """Ask the character in the tier pool. Return the tier response and
+    the time it took, or None if it's too late to start."""
+    try:
+        if time.time() > call.deadline:
+            return None, 0
+        logger.info("Asking character {} \"{}\" concurrently".format(
+            call.character.id, request.question))
+        start = time.time()
+        tier_response = call.character.respond(
+            request.question, request.lang, call.tier_session, request.query,
+            request.id)
+        return tier_response, time.time() - start
+    finally:
+        call.finish()
+
+def _dispatch_character(character, request, session):
+    """Start asking the character in the tier pool. Return the pending
+    call."""
+    return _TierCall(character, request, session)
+
+def _wait_character(character, call, response):
+    """Wait for the character until its deadline. Return its tier response,
+    or None if it's late. The state the character keeps for the session is
+    updated only if it's in time."""
+    try:
+        try:
+            tier_response, elapse = call.result.get(
+                max(0, call.deadline - time.time()))
+        except TimeoutError:
+            if call.abandon():
+                logger.warn("Character %s timed out", character.id)
+                response.add_trace((character.id, 'loop', 'Timeout. No response in {:.3f}s'.format(time.time() - call.start)))
+                return
+            # done just now
+            tier_response, elapse = call.result.get()
+    except Exception:
+        call.drop()
+        raise
+    if tier_response is None:
+        call.drop()
+        logger.warn("Character %s is cancelled", character.id)
+        response.add_trace((character.id, 'loop', 'Cancelled. Not started in {:.3f}s'.format(call.deadline - call.start)))
+        return
+    if call.tier_session is not call.session:
+        character.move_session_state(call.tier_session, call.session)
+    logger.info("Character %s responded in %.3fs", character.id, elapse)
+    return tier_response
+
 def _ask_characters(characters, request, response):
     session = session_manager.get_session(request.sid)
     if session is None:
@@ -333,14 +427,35 @@ def _ask_characters(characters, request, response):
     #                    response.set_default_response(_response)
     #                break
 
+    # In the concurrent mode the non-lazy characters are all asked up front,
+    # the lazy ones when they are needed, and their responses are merged in
+    # the same order as they are asked sequentially
+    concurrent = config['CONCURRENT_TIERS']
+    dispatched = {}
+    if concurrent:
+        for c, weight in weighted_characters:
+            if not c.lazy:
+                dispatched[c] = _dispatch_character(c, request, session)
+
     # Check the loop
     wcs = weighted_characters[:]
     while wcs:
         c, weight = wcs.pop(0)
         if not response.answered or not c.lazy:
             try:
-                answered, _response = _ask_character(
-                    'loop', c, request, response)
+                if concurrent:
+                    if c not in dispatched:
+                        dispatched[c] = _dispatch_character(
+                            c, request, session)
+                    tier_response = _wait_character(
+                        c, dispatched[c], response)
+                    if tier_response is None:
+                        continue
+                    answered, _response = _ask_character(
+                        'loop', c, request, response, tier_response)
+                else:
+                    answered, _response = _ask_character(
+                        'loop', c, request, response)
             except Exception as ex:
                 logger.exception(ex)
                 continue
@@ -357,6 +472,8 @@ def _ask_characters(characters, request, response):
     if not response.answered:
         # pick one default response
         default_response = pickone(response.get_default_responses())
+        if default_response:
+            response.render_response(default_response)
         if default_response and default_response.get('text'):
             response.set_default_response(default_response)
 
@@ -370,6 +487,8 @@ def _ask_characters(characters, request, response):
 
         candicate_responses = cached_responses.get(key)
         picked_response = pickone(candicate_responses)
+        if picked_response:
+            response.render_response(picked_response)
         if picked_response and picked_response.get('text'):
             response.set_default_response(picked_response)
             response.add_trace(
@@ -432,23 +551,14 @@ def get_responding_characters(lang, sid):
     user = session.session_context.user
 
     # current character > local character with the same name > solr > generic
-    responding_characters = get_characters_by_name(
-        botname, local=False, lang=lang, user=user)
-    responding_characters = sorted(responding_characters, key=lambda x: x.level)
-
-    generic = get_character('generic', lang)
-    if generic:
-        if generic not in responding_characters:
-            # get shared properties
-            character = get_character(botname)
-            generic.set_properties(character.get_properties())
-            responding_characters.append(generic)
-    else:
-        logger.info("Generic character is not found")
+    responding_characters, generic = CHARACTERS.get_responding_characters(
+        botname, lang, user)
+    if generic is not None:
+        # get shared properties
+        character = get_character(botname)
+        generic.set_properties(character.get_properties())
 
-    responding_characters = sorted(responding_characters, key=lambda x: x.level)
-
-    return responding_characters
+    return list(responding_characters)
 
 
 def rate_answer(sid, idx, rate):
@@ -457,22 +567,113 @@ def rate_answer(sid, idx, rate):
         logger.error("Session doesn't exist")
         return False
     try:
-        return session.rate(rate, idx)
+        with session_manager.transaction(session):
+            return session.rate(rate, idx)
     except Exception as ex:
         logger.error("Rate error: {}".format(ex))
         return False
     return True
 
 
+def _resolve_characters(lang, sid):
+    """The responding characters of the session in lang, or in the
+    fallback language. Return them and whether it's the fallback."""
+    responding_characters = get_responding_characters(lang, sid)
+    if not responding_characters and lang != FALLBACK_LANG:
+        logger.warn("Use %s medium language, in fallback mode", FALLBACK_LANG)
+        return get_responding_characters(FALLBACK_LANG, sid), True
+    return responding_characters, False
+
+
 def ask(question, lang, sid, query=False, request_id=None, **kwargs):
-    response = Response()
-    response.Datetime = str(dt.datetime.utcnow())
-    response.Rate = ''
-    response.Lang = lang
-    response.Location = LOCATION
-    response.ServerIP = IP
-    response.RequestId = request_id
-    response.Revision = REVISION
+    """Answer the question. The questions of a session are answered one
+    at a time, those of different sessions concurrently."""
+    session = session_manager.get_session(sid)
+    if session is None:
+        return _ask(question, lang, sid, query, request_id, **kwargs)
+    with session_manager.transaction(session):
+        response = _ask(question, lang, sid, query, request_id, **kwargs)
+    if config['STRIP_CANDIDATES']:
+        response.strip_candidates()
+    return response
+
+batch_pool = None
+
+def get_batch_pool():
+    global batch_pool
+    with sync:
+        if batch_pool is None:
+            batch_pool = ThreadPool(config['BATCH_WORKERS'])
+    return batch_pool
+
+def ask_batch(questions, lang, sid, request_id=None, **kwargs):
+    """Answer the questions of a batch. They are independent: each one
+    is asked as a query on a copy of the session, so it's answered as if
+    it were the only one, and BATCH_WORKERS of them are answered
+    concurrently. The responding characters are resolved once for the
+    batch. Yield (i, response) of the i-th question as they are
+    answered."""
+    session = session_manager.get_session(sid)
+    if session is None:
+        for i, question in enumerate(questions):
+            yield i, _ask(question, lang, sid, True, request_id, **kwargs)
+        return
+    # the session is locked only to copy it, and to add the records of
+    # the copies to it, not while the caller reads the responses
+    count = max(1, min(config['BATCH_WORKERS'], len(questions)))
+    with session_manager.transaction(session):
+        characters = _resolve_characters(lang, sid)
+        session.set_characters(characters[0])
+        batch_sessions = session_manager.add_batch_sessions(
+            session, count, characters[0])
+    try:
+        free_sessions = Queue()
+        for batch_session in batch_sessions:
+            free_sessions.put(batch_session)
+        # set when the caller stops reading the responses, so that the
+        # questions left are skipped
+        cancelled = Event()
+
+        def answer(item):
+            i, question = item
+            batch_session = free_sessions.get()
+            try:
+                if cancelled.is_set():
+                    return i, None
+                response = _ask(
+                    question, lang, batch_session.sid, True, request_id,
+                    characters=characters, **kwargs)
+            except Exception as ex:
+                logger.exception(ex)
+                response = Response(
+                    ret=codes.INTERNAL_ERROR, OriginalQuestion=question)
+            finally:
+                free_sessions.put(batch_session)
+            if config['STRIP_CANDIDATES']:
+                response.strip_candidates()
+            return i, response
+
+        results = get_batch_pool().imap_unordered(
+            answer, enumerate(questions))
+        try:
+            for result in results:
+                yield result
+        finally:
+            # the questions being answered still use the batch sessions
+            cancelled.set()
+            for _ in results:
+                pass
+    finally:
+        session_manager.remove_batch_sessions(session, batch_sessions)
+
+def _ask(question, lang, sid, query=False, request_id=None, characters=None,
+         **kwargs):
+    """Answer the question. characters are the responding characters
+    from _resolve_characters(), if they are resolved already."""
+    response = Response(
+        Datetime=str(dt.datetime.utcnow()), Rate='', Lang=lang,
+        Location=LOCATION, ServerIP=IP, RequestId=request_id,
+        Revision=REVISION)
 
     #response = {'text': '', 'emotion': '', 'botid': '', 'botname': ''}
 
@@ -497,12 +698,10 @@ def ask(question, lang, sid, query=False, request_id=None, **kwargs):
 
     input_translated = False
     output_translated = False
-    fallback_mode = False
-    responding_characters = get_responding_characters(lang, sid)
-    if not responding_characters and lang != FALLBACK_LANG:
-        fallback_mode = True
-        logger.warn("Use %s medium language, in fallback mode", FALLBACK_LANG)
-        responding_characters = get_responding_characters(FALLBACK_LANG, sid)
+    if characters is None:
+        characters = _resolve_characters(lang, sid)
+    responding_characters, fallback_mode = characters
+    if fallback_mode:
         try:
             input_translated, question = do_translate(question, FALLBACK_LANG)
         except Exception as ex:
@@ -531,12 +730,8 @@ def ask(question, lang, sid, query=False, request_id=None, **kwargs):
     session.set_characters(responding_characters)
     logger.info("Responding characters %s", responding_characters)
     
-    request = Request()
-    request.id = request_id
-    request.lang = lang
-    request.sid = sid
-    request.question = question
-    request.query = query
+    request = Request(
+        question=question, lang=lang, sid=sid, id=request_id, query=query)
 
     _question = preprocessing(request.question, request.lang)
     request.question = _question
@@ -628,16 +823,17 @@ def feedback(sid, text, label, lang):
     session = session_manager.get_session(sid)
     if session is None:
         return False, "No session"
-    success = session.update(-1, Feedback=text, Label=label)
+    with session_manager.transaction(session):
+        success = session.update(-1, Feedback=text, Label=label)
 
-    # feedback to characters
-    characters = get_responding_characters(lang, sid)
-    for c in characters:
-        if c.stateful:
-            try:
-                c.set_context(session, {'whatsaid': text})
-            except NotImplementedError:
-                pass
+        # feedback to characters
+        characters = get_responding_characters(lang, sid)
+        for c in characters:
+            if c.stateful:
+                try:
+                    c.set_context(session, {'whatsaid': text})
+                except NotImplementedError:
+                    pass
     return success, "Done"
 
 def said(sid, text):
@@ -659,14 +855,13 @@ def dump_session(sid):
 
 
 def reload_characters(**kwargs):
-    global CHARACTERS, REVISION
+    global REVISION
     with sync:
         characters = None
         logger.info("Reloading")
         try:
             characters = load_characters(CHARACTER_PATH)
-            del CHARACTERS[:]
-            CHARACTERS = characters
+            CHARACTERS.set(characters)
             revision = kwargs.get('revision')
             if revision:
                 REVISION = revision
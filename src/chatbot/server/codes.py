@@ -4,6 +4,7 @@ NO_PATTERN_MATCH = 2
 INVALID_SESSION = 3
 INVALID_QUESTION = 4
 TRANSLATE_ERROR = 5
+INTERNAL_ERROR = 6
 
 CODES = {
     SUCCESS: 'Success',
@@ -12,4 +13,5 @@ CODES = {
     INVALID_SESSION: 'Invalid session',
     INVALID_QUESTION: 'Invalid question',
     TRANSLATE_ERROR: 'Translate error',
+    INTERNAL_ERROR: 'Internal error',
 }
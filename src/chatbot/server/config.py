@@ -6,11 +6,56 @@ CHARACTER_PATH = os.environ.get('HR_CHARACTER_PATH', DEFAULT_CHARACTER_PATH)
 
 RESET_SESSION_BY_HELLO = False
 SESSION_REMOVE_TIMEOUT = 3600 # Timeout seconds for a session to be removed
+SESSION_SHARDS = 16 # Number of locks the sessions are sharded over
+# Where the sessions are shared between the server processes, 'memory',
+# 'sqlite:<path>', or empty to keep them in the process. The last
+# SESSION_STORE_TAIL records of the chat history are stored with them.
+SESSION_STORE = os.environ.get('SESSION_STORE', '')
+SESSION_STORE_TAIL = 20
 
 CHATBOT_LOG_DIR = os.environ.get('CHATBOT_LOG_DIR') or os.path.expanduser('~/.hr/chatbot')
 SERVER_LOG_DIR = os.environ.get('SERVER_LOG_DIR') or os.path.expanduser('~/.hr/log/chatbot')
 HISTORY_DIR = os.path.join(CHATBOT_LOG_DIR, 'history')
 TEST_HISTORY_DIR = os.path.join(CHATBOT_LOG_DIR, 'test/history')
+# Snapshots of the parsed AIML brains, set USE_BRAIN_CACHE=0 to disable
+BRAIN_CACHE_DIR = os.environ.get('BRAIN_CACHE_DIR') or os.path.join(CHATBOT_LOG_DIR, 'brain_cache')
+USE_BRAIN_CACHE = os.environ.get('USE_BRAIN_CACHE', '1') != '0'
+# Number of processes parsing the AIML files at startup, 0 to parse them
+# in the server process
+PARALLEL_LOAD_WORKERS = int(os.environ.get('PARALLEL_LOAD_WORKERS', 0))
+# Ask the responding characters concurrently, in a pool of TIER_WORKERS
+# threads, waiting TIER_TIMEOUT seconds for each of them unless the
+# character sets its own timeout
+CONCURRENT_TIERS = os.environ.get('CONCURRENT_TIERS', '0') != '0'
+TIER_WORKERS = int(os.environ.get('TIER_WORKERS', 8))
+TIER_TIMEOUT = float(os.environ.get('TIER_TIMEOUT', 3))
+# Seconds between the Internet connectivity probes, backing off up to
+# ONLINE_CHECK_MAX_INTERVAL while offline
+ONLINE_CHECK_INTERVAL = float(os.environ.get('ONLINE_CHECK_INTERVAL', 10))
+ONLINE_CHECK_MAX_INTERVAL = float(os.environ.get('ONLINE_CHECK_MAX_INTERVAL', 120))
+# Records of a session kept in memory, by count and by bytes (0 for no
+# limit). The older ones are only in the history files.
+RESPONSE_CACHE_MAX_RECORDS = int(os.environ.get('RESPONSE_CACHE_MAX_RECORDS', 1000))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 0))
+# The chat history is written in the background, every HISTORY_FLUSH_SIZE
+# records or HISTORY_FLUSH_INTERVAL seconds, and synced to the disk if
+# HISTORY_FSYNC=1
+HISTORY_FLUSH_SIZE = int(os.environ.get('HISTORY_FLUSH_SIZE', 100))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get('HISTORY_FLUSH_INTERVAL', 1))
+HISTORY_FSYNC = os.environ.get('HISTORY_FSYNC', '0') != '0'
+# Worker processes of the server, forked after the characters are loaded,
+# and the seconds a stopped worker has to finish its requests
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 1))
+SERVER_GRACEFUL_TIMEOUT = float(os.environ.get('SERVER_GRACEFUL_TIMEOUT', 10))
+# Compiled answer templates kept in memory
+TEMPLATE_CACHE_SIZE = int(os.environ.get('TEMPLATE_CACHE_SIZE', 256))
+# Leave the text of the responses that are not used out of the answer
+STRIP_CANDIDATES = os.environ.get('STRIP_CANDIDATES', '0') != '0'
+# Serialise the candidate responses and the traces in the /chat answers
+# when the request doesn't say
+RESPONSE_VERBOSE = os.environ.get('RESPONSE_VERBOSE', '0') != '0'
+# Threads answering the questions of a batch
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 4))
 CS_HOST = os.environ.get('CS_HOST') or 'localhost'
 CS_PORT = os.environ.get('CS_PORT') or '1024'
 CS_BOT = os.environ.get('CS_BOT') or 'rose'
@@ -22,9 +67,31 @@ config['DEFAULT_CHARACTER_PATH'] = DEFAULT_CHARACTER_PATH
 config['CHARACTER_PATH'] = CHARACTER_PATH
 config['RESET_SESSION_BY_HELLO'] = RESET_SESSION_BY_HELLO
 config['SESSION_REMOVE_TIMEOUT'] = SESSION_REMOVE_TIMEOUT
+config['SESSION_SHARDS'] = SESSION_SHARDS
+config['SESSION_STORE'] = SESSION_STORE
+config['SESSION_STORE_TAIL'] = SESSION_STORE_TAIL
 config['CHATBOT_LOG_DIR'] = CHATBOT_LOG_DIR
 config['SERVER_LOG_DIR'] = SERVER_LOG_DIR
 config['HISTORY_DIR'] = HISTORY_DIR
+config['BRAIN_CACHE_DIR'] = BRAIN_CACHE_DIR
+config['USE_BRAIN_CACHE'] = USE_BRAIN_CACHE
+config['PARALLEL_LOAD_WORKERS'] = PARALLEL_LOAD_WORKERS
+config['CONCURRENT_TIERS'] = CONCURRENT_TIERS
+config['TIER_WORKERS'] = TIER_WORKERS
+config['TIER_TIMEOUT'] = TIER_TIMEOUT
+config['ONLINE_CHECK_INTERVAL'] = ONLINE_CHECK_INTERVAL
+config['ONLINE_CHECK_MAX_INTERVAL'] = ONLINE_CHECK_MAX_INTERVAL
+config['RESPONSE_CACHE_MAX_RECORDS'] = RESPONSE_CACHE_MAX_RECORDS
+config['RESPONSE_CACHE_MAX_BYTES'] = RESPONSE_CACHE_MAX_BYTES
+config['HISTORY_FLUSH_SIZE'] = HISTORY_FLUSH_SIZE
+config['HISTORY_FLUSH_INTERVAL'] = HISTORY_FLUSH_INTERVAL
+config['HISTORY_FSYNC'] = HISTORY_FSYNC
+config['SERVER_WORKERS'] = SERVER_WORKERS
+config['SERVER_GRACEFUL_TIMEOUT'] = SERVER_GRACEFUL_TIMEOUT
+config['TEMPLATE_CACHE_SIZE'] = TEMPLATE_CACHE_SIZE
+config['STRIP_CANDIDATES'] = STRIP_CANDIDATES
+config['RESPONSE_VERBOSE'] = RESPONSE_VERBOSE
+config['BATCH_WORKERS'] = BATCH_WORKERS
 config['CS_HOST'] = CS_HOST
 config['CS_PORT'] = CS_PORT
 config['CS_BOT'] = CS_BOT
@@ -0,0 +1,102 @@
+import time
+import logging
+import threading
+import datetime as dt
+from chatbot.utils import check_online
+from config import ONLINE_CHECK_INTERVAL, ONLINE_CHECK_MAX_INTERVAL
+
+logger = logging.getLogger('hr.chatbot.server.connectivity')
+
+
+class ConnectivityMonitor(object):
+    """Probes the Internet connection in a background thread and keeps the
+    last known state, so that the characters that need the Internet don't
+    probe it on every question."""
+
+    def __init__(self, probe=None, interval=ONLINE_CHECK_INTERVAL,
+                 max_interval=ONLINE_CHECK_MAX_INTERVAL):
+        self.probe = probe or (lambda: check_online(timeout=0.5))
+        self.interval = interval
+        self.max_interval = max_interval
+        self.online = False
+        self.latency = None
+        self.last_probe_time = None
+        self.last_change_time = None
+        self.failures = 0
+        self.probes = 0
+        self.skipped = 0  # Responses skipped for being offline
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def next_interval(self):
+        """Probe every interval seconds when online, and back off
+        exponentially, up to max_interval, while offline."""
+        if self.failures == 0:
+            return self.interval
+        return min(self.interval * 2 ** self.failures, self.max_interval)
+
+    def check(self):
+        """Probe the connection now and update the state."""
+        start = time.time()
+        try:
+            online = bool(self.probe())
+        except Exception as ex:
+            logger.error("Connectivity probe error {}".format(ex))
+            online = False
+        self.latency = time.time() - start
+        self.last_probe_time = dt.datetime.utcnow()
+        self.probes += 1
+        if online != self.online or self.last_change_time is None:
+            self.last_change_time = self.last_probe_time
+            if online:
+                logger.info("Internet is online")
+            else:
+                logger.warn("Internet is offline")
+        self.online = online
+        self.failures = 0 if online else self.failures + 1
+        return online
+
+    def _run(self):
+        while not self._stop.wait(self.next_interval()):
+            self.check()
+
+    def start(self):
+        """Probe once, then keep probing in the background."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.check()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def is_online(self):
+        if self._thread is None:
+            self.start()
+        return self.online
+
+    def status(self):
+        return {
+            'online': self.online,
+            'latency': self.latency,
+            'last_probe_time': self.last_probe_time and
+                str(self.last_probe_time),
+            'last_change_time': self.last_change_time and
+                str(self.last_change_time),
+            'failures': self.failures,
+            'next_probe_in': self.next_interval(),
+            'probes': self.probes,
+            'skipped': self.skipped,
+        }
+
+monitor = ConnectivityMonitor()
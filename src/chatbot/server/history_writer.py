@@ -0,0 +1,154 @@
+import os
+import csv
+import time
+import Queue
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from config import HISTORY_FLUSH_SIZE, HISTORY_FLUSH_INTERVAL, HISTORY_FSYNC
+
+logger = logging.getLogger('hr.chatbot.server.history_writer')
+
+
+class HistoryWriter(object):
+    """Appends the chat history to the CSV files in a background thread.
+
+    The rows are buffered and written when there are flush_size of them,
+    flush_interval seconds after the last write, or when flush() or
+    close() is called. With fsync, the files are synced to the disk on
+    every write.
+    """
+
+    def __init__(self, flush_size=HISTORY_FLUSH_SIZE,
+                 flush_interval=HISTORY_FLUSH_INTERVAL, fsync=HISTORY_FSYNC,
+                 max_open_files=64):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_open_files = max_open_files
+        self.queue = Queue.Queue()
+        # file name -> file, the least recently used first
+        self.files = OrderedDict()
+        # file name -> [(header, rows, write header)]
+        self.pending = OrderedDict()
+        self.pending_rows = 0
+        self.last_write_time = time.time()
+        self.written = 0
+        self.errors = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="HistoryWriter")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def after_fork(self):
+        """Drop the thread and the rows of the parent in a forked process.
+        The parent writes them."""
+        self.queue = Queue.Queue()
+        self.files = OrderedDict()
+        self.pending = OrderedDict()
+        self.pending_rows = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, fname, header, rows, write_header=False):
+        """Append the rows (dicts) to the CSV file fname. The rows must not
+        change afterwards."""
+        self._start()
+        self.queue.put((fname, header, rows, write_header))
+
+    def flush(self, timeout=None):
+        """Wait until the rows given so far are written. Return False if
+        it times out."""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+        return done.is_set()
+
+    def close(self):
+        """Write the rows given so far, close the files and stop the
+        thread. Writing again restarts it."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self.pending_rows:
+                timeout = max(0, self.last_write_time + self.flush_interval -
+                              time.time())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                self._write()
+                continue
+            if item is None:
+                self._write()
+                self._close_files()
+                return
+            if isinstance(item, threading._Event):
+                self._write()
+                item.set()
+                continue
+            fname, header, rows, write_header = item
+            self.pending.setdefault(fname, []).append(
+                (header, rows, write_header))
+            self.pending_rows += len(rows)
+            if self.pending_rows >= self.flush_size or \
+                    time.time() - self.last_write_time >= self.flush_interval:
+                self._write()
+
+    def _open(self, fname):
+        f = self.files.pop(fname, None)
+        if f is None:
+            dirname = os.path.dirname(fname)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            f = open(fname, 'a')
+            while len(self.files) >= self.max_open_files:
+                self.files.popitem(last=False)[1].close()
+        self.files[fname] = f
+        return f
+
+    def _write(self):
+        for fname, batches in self.pending.iteritems():
+            try:
+                f = self._open(fname)
+                for header, rows, write_header in batches:
+                    writer = csv.DictWriter(f, header, extrasaction='ignore')
+                    if write_header:
+                        writer.writeheader()
+                    writer.writerows(rows)
+                    self.written += len(rows)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            except Exception as ex:
+                self.errors += 1
+                logger.error("Can't write chat history to {}, {}".format(
+                    fname, ex))
+        self.pending.clear()
+        self.pending_rows = 0
+        self.last_write_time = time.time()
+
+    def _close_files(self):
+        for f in self.files.values():
+            try:
+                f.close()
+            except Exception as ex:
+                logger.error("Can't close {}, {}".format(f.name, ex))
+        self.files.clear()
+
+history_writer = HistoryWriter()
+atexit.register(history_writer.close)
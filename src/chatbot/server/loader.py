@@ -1,11 +1,16 @@
+import gc
 import os
 import sys
+import time
 import yaml
 import logging
 import traceback
 from chatbot.server.character import AIMLCharacter, Character, TYPE_CS, TYPE_AIML
 from chatbot.utils import get_location, get_weather, parse_weather
 from chatbot.server.config import CS_HOST, CS_PORT, CS_BOT
+from chatbot.server.config import BRAIN_CACHE_DIR, USE_BRAIN_CACHE
+from chatbot.server.config import PARALLEL_LOAD_WORKERS
+from chatbot.server.brain_cache import BrainCache, BrainPool, ParallelParseCache
 from zipfile import ZipFile
 import pprint
 
@@ -50,26 +55,59 @@ def load_dyn_properties():
 
 load_dyn_properties()
 
-def load_characters(character_path):
+brain_cache = BrainCache(BRAIN_CACHE_DIR) if USE_BRAIN_CACHE else None
+
+def load_characters(character_path, parallel_workers=None):
+    """Load the characters. With parallel_workers, the AIML files are
+    parsed in that many worker processes, default PARALLEL_LOAD_WORKERS.
+    0 parses them sequentially."""
     characters = []
+    if parallel_workers is None:
+        parallel_workers = PARALLEL_LOAD_WORKERS
     logger.info("Character path %s" % character_path)
     if os.path.isfile(character_path) and character_path.endswith('.yaml'):
         characters.extend(ConfigFileLoader.load(character_path))
     else:
-        for path in character_path.split(','):
-            path = path.strip()
-            if not path:
-                continue
-            sys.path.insert(0, path)
-            module_names = [f for f in os.listdir(path) if f.endswith('.py')]
-            for module_name in module_names:
-                characters.extend(
-                    PyModuleCharacterLoader.load(module_name))
-
-            yaml_files = [f for f in os.listdir(path) if f.endswith('.yaml')]
-            for yaml_file in yaml_files:
-                characters.extend(
-                    AIMLCharacterLoader.load(os.path.join(path, yaml_file)))
+        paths = [p.strip() for p in character_path.split(',') if p.strip()]
+        parse_cache = None
+        if parallel_workers > 0:
+            parse_cache = ParallelParseCache(parallel_workers)
+            for path in paths:
+                for yaml_file in os.listdir(path):
+                    if yaml_file.endswith('.yaml'):
+                        parse_cache.prefetch(AIMLCharacterLoader.aiml_files(
+                            os.path.join(path, yaml_file)))
+        # the characters loaded together share the brains learned from the
+        # same AIML files
+        brain_pool = BrainPool(parse_cache)
+        start = time.time()
+        # The brains are millions of containers, none of them in a cycle.
+        # Don't let the garbage collector scan them over and over while
+        # they are built.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for path in paths:
+                sys.path.insert(0, path)
+                module_names = [f for f in os.listdir(path) if f.endswith('.py')]
+                for module_name in module_names:
+                    characters.extend(
+                        PyModuleCharacterLoader.load(module_name))
+
+                yaml_files = [f for f in os.listdir(path) if f.endswith('.yaml')]
+                for yaml_file in yaml_files:
+                    characters.extend(AIMLCharacterLoader.load(
+                        os.path.join(path, yaml_file), brain_pool))
+        finally:
+            if gc_enabled:
+                gc.enable()
+            if parse_cache is not None:
+                parse_cache.close()
+                logger.info("Parsed AIML in {} workers: {:.2f}s parsing, "
+                            "{:.2f}s waiting for the workers".format(
+                                parallel_workers, parse_cache.parse_time,
+                                parse_cache.wait_time))
+        logger.info("Loaded characters in {:.2f}s".format(time.time() - start))
 
         for c in characters:
             if c.type == TYPE_CS:
@@ -144,18 +182,33 @@ class PyModuleCharacterLoader(object):
         return characters
 
 
+def _abs_path(root_dir, p):
+    if p.startswith('/'):
+        return p
+    if p.startswith('~'):
+        return os.path.expanduser(p)
+    return os.path.join(root_dir, p)
+
 class AIMLCharacterLoader(object):
 
     @staticmethod
-    def load(character_yaml):
+    def aiml_files(character_yaml):
+        """Return the AIML files of the character yaml."""
+        with open(character_yaml) as f:
+            spec = yaml.load(f)
+        if not isinstance(spec, dict):
+            return []
+        root_dir = os.path.dirname(os.path.realpath(character_yaml))
+        return [_abs_path(root_dir, f) for f in spec.get('aiml', [])]
+
+    @staticmethod
+    def load(character_yaml, brain_pool=None):
         def abs_path(p):
-            if p.startswith('/'):
-                return p
-            if p.startswith('~'):
-                return os.path.expanduser(p)
-            return os.path.join(root_dir, p)
+            return _abs_path(root_dir, p)
 
         characters = []
+        if brain_pool is None:
+            brain_pool = BrainPool()
         with open(character_yaml) as f:
             spec = yaml.load(f)
             try:
@@ -166,6 +219,8 @@ class AIMLCharacterLoader(object):
                 else:
                     names = 'global'
                 for name in names.split(','):
+                    start = time.time()
+                    aiml_time = 0
                     name = name.strip()
                     character = AIMLCharacter(spec['id'], name)
                     if 'property_file' in spec:
@@ -174,14 +229,25 @@ class AIMLCharacterLoader(object):
                         character.level = int(spec['level'])
                     if 'aiml' in spec:
                         aiml_files = [abs_path(f) for f in spec['aiml']]
+                        aiml_start = time.time()
                         errors = character.load_aiml_files(
-                            character.kernel, aiml_files)
+                            character.kernel, aiml_files, brain_cache,
+                            brain_pool)
+                        aiml_time = time.time() - aiml_start
                     if 'weight' in spec:
                         character.weight = float(spec['weight'])
                     if 'dynamic_level' in spec:
                         character.dynamic_level = bool(spec['dynamic_level'])
                     if 'non_repeat' in spec:
                         character.non_repeat = bool(spec['non_repeat'])
+                    if 'timeout' in spec:
+                        character.timeout = float(spec['timeout'])
+                    if 'compiled_matcher' in spec:
+                        character.kernel.compiledMatching(
+                            bool(spec['compiled_matcher']))
+                    if 'session_locking' in spec:
+                        character.kernel.sessionLocking(
+                            bool(spec['session_locking']))
                     pre_prop = character.get_properties()
                     if not pre_prop.get('location'):
                         location = dyn_properties.get('location')
@@ -198,6 +264,11 @@ class AIMLCharacterLoader(object):
                             })
                     character.print_duplicated_patterns()
                     characters.append(character)
+                    logger.info("Loaded character {} ({}) in {:.2f}s, "
+                                "AIML {:.2f}s, {} categories".format(
+                                    name, spec['id'], time.time() - start,
+                                    aiml_time,
+                                    character.kernel.numCategories()))
                 if errors:
                     raise Exception("Loading {} error {}".format(
                         character_yaml, '\n'.join(errors)))
@@ -221,12 +292,13 @@ class AIMLCharacterZipLoader(object):
             f.extractall(output_dir)
 
         characters = []
+        brain_pool = BrainPool()
         dirpath = os.path.join(output_dir, dirname)
         batch_csv2aiml(dirpath, dirpath)
         for yaml_file in os.listdir(dirpath):
             if yaml_file.endswith('.yaml'):
                 characters.extend(AIMLCharacterLoader.load(
-                    os.path.join(dirpath, yaml_file)))
+                    os.path.join(dirpath, yaml_file), brain_pool))
         return characters
 
 if __name__ == '__main__':
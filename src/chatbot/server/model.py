@@ -1,4 +1,5 @@
-import bunch
+import json
+import yaml
 from codes import CODES
 import logging
 from template import render_template
@@ -32,6 +33,17 @@ RESPONSE_SCORE_NAMES = {
     'VERY_BAD': VERY_BAD,
 }
 
+def _encode_model(obj):
+    if isinstance(obj, Model):
+        return obj.to_dict()
+    raise TypeError("{!r} is not JSON serializable".format(obj))
+
+# the JSON of the models, without the spaces and the circular reference
+# check
+json_encode = json.JSONEncoder(
+    separators=(',', ':'), check_circular=False,
+    default=_encode_model).encode
+
 RESPONSE_TYPE_WEIGHTS = {
     '_DEFAULT_': 100,
     'sc': 100,
@@ -46,38 +58,129 @@ RESPONSE_TYPE_WEIGHTS = {
     'markov': 5,
 }
 
-class Request(bunch.Bunch):
+_unset = object()
 
-    def __init__(self):
-        self.question = None
-        self.lang = None
-        self.sid = None
-        self.id = None
-        self.query = None
+class Model(object):
+    """Base of the models. The FIELDS are the slots, serialised when they
+    are set. The other keys, as the ones added by the command responses,
+    are kept in extra. The models can be used as dicts of both."""
 
-    def __str__(self):
-        return self.toJSON()+'\n'
+    __slots__ = ('extra',)
+    FIELDS = frozenset()
+    # the fields that are serialised only in the verbose JSON, and the
+    # others
+    VERBOSE_FIELDS = COMPACT_FIELDS = frozenset()
+
+    def __init__(self, **kwargs):
+        self.extra = None
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key) if key in self.FIELDS \
+                else self.extra[key]
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        elif self.extra is None:
+            self.extra = {key: value}
+        else:
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        if key in self.FIELDS:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def get(self, key, default=None):
+        if key in self.FIELDS:
+            return getattr(self, key, default)
+        if self.extra is None:
+            return default
+        return self.extra.get(key, default)
+
+    def pop(self, key, default=None):
+        if key in self.FIELDS:
+            value = getattr(self, key, default)
+            if hasattr(self, key):
+                delattr(self, key)
+            return value
+        if self.extra is None:
+            return default
+        return self.extra.pop(key, default)
 
-class TierResponse(bunch.Bunch):
-    def __init__(self, botid='', botname='', text='', trace='', score=0):
-        self.botid = botid
-        self.botname = botname
-        self.text = text
-        self.trace = trace
-        self.score = score
+    def update(self, other):
+        for key, value in other.iteritems():
+            self[key] = value
+
+    def to_dict(self, verbose=True):
+        fields = self.FIELDS if verbose else self.COMPACT_FIELDS
+        data = {}
+        for field in fields:
+            value = getattr(self, field, _unset)
+            if value is not _unset:
+                data[field] = value
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def toJSON(self, verbose=True):
+        return json_encode(self.to_dict(verbose))
 
     def __str__(self):
         return self.toJSON()+'\n'
 
-class Response(bunch.Bunch):
-    def __init__(self):
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, self.to_dict())
+
+class Request(Model):
+    __slots__ = ('question', 'lang', 'sid', 'id', 'query')
+    FIELDS = COMPACT_FIELDS = frozenset(__slots__)
+
+    def __init__(self, question=None, lang=None, sid=None, id=None,
+                 query=None):
+        super(Request, self).__init__(
+            question=question, lang=lang, sid=sid, id=id, query=query)
+
+class TierResponse(Model):
+    __slots__ = ('botid', 'botname', 'text', 'trace', 'score')
+    FIELDS = COMPACT_FIELDS = frozenset(__slots__)
+
+    def __init__(self, botid='', botname='', text='', trace='', score=0,
+                 **kwargs):
+        super(TierResponse, self).__init__(
+            botid=botid, botname=botname, text=text, trace=trace,
+            score=score, **kwargs)
+
+class Response(Model):
+    __slots__ = (
+        'ret', 'Datetime', 'Rate', 'Lang', 'Location', 'ServerIP',
+        'RequestId', 'Revision', 'BotName', 'User', 'ClientId',
+        'OriginalQuestion', 'Question', 'ModQuestion', 'yousaid', 'Marker',
+        'RunId', 'OriginalAnswer', 'AnsweredBy', 'default_response',
+        'responses', 'trace')
+    FIELDS = frozenset(__slots__)
+    # the candidate responses and the traces
+    VERBOSE_FIELDS = frozenset(['responses', 'trace'])
+    COMPACT_FIELDS = FIELDS - VERBOSE_FIELDS
+    _default_category = '_DEFAULT_'
+
+    def __init__(self, **kwargs):
         self.ret = 0
         self.responses = {}
         self.trace = []
         self.default_response = None
-        self._default_category = '_DEFAULT_'
+        super(Response, self).__init__(**kwargs)
 
     def render_response(self, response):
+        """Render the text of the response, once. The responses are added
+        with their raw text, and rendered when they are picked."""
+        if 'orig_text' in response:
+            return
         text = response.get('text')
         try:
             response['orig_text'] = text
@@ -89,7 +192,6 @@ class Response(bunch.Bunch):
 
     def add_response(self, category, response):
         logger.info("Add response %s %s", category, response)
-        self.render_response(response)
         response['cweight'] = RESPONSE_TYPE_WEIGHTS.get(category, 0)
         if category in self.responses:
             self.responses[category].append(response)
@@ -110,6 +212,27 @@ class Response(bunch.Bunch):
         self.default_response = response
         self.render_response(response)
 
+    def render_candidates(self):
+        """Render the text of the responses that are not stripped"""
+        for responses in self.responses.itervalues():
+            for response in responses:
+                if 'text' in response:
+                    self.render_response(response)
+
+    def to_dict(self, verbose=True):
+        # the candidates are shown in the verbose JSON, to be picked
+        if verbose:
+            self.render_candidates()
+        return super(Response, self).to_dict(verbose)
+
+    def strip_candidates(self):
+        """Remove the text of the responses that are not used"""
+        for responses in self.responses.itervalues():
+            for response in responses:
+                if response is not self.default_response:
+                    response.pop('text', None)
+                    response.pop('orig_text', None)
+
     def add_trace(self, trace):
         self.trace.append(trace)
 
@@ -118,7 +241,8 @@ class Response(bunch.Bunch):
         return self.default_response is not None
 
     def show(self):
-        print self.toYAML()
+        print yaml.safe_dump(json.loads(self.toJSON()),
+                             default_flow_style=False)
 
 if __name__ == '__main__':
     response = Response()
@@ -129,5 +253,5 @@ if __name__ == '__main__':
     response.add_response('stage2', tier_response2)
     response.set_default_response(default_response)
     print response.toJSON()
-    print response.toYAML()
+    response.show()
     print response.answered
@@ -0,0 +1,196 @@
+import os
+import gc
+import time
+import errno
+import atexit
+import socket
+import signal
+import logging
+import threading
+from werkzeug.serving import make_server
+from config import SERVER_GRACEFUL_TIMEOUT
+
+logger = logging.getLogger('hr.chatbot.server.prefork')
+
+
+class PreforkServer(object):
+    """Serves a WSGI app from worker processes forked from this one, so
+    that the characters loaded before run() are shared copy-on-write and
+    the questions are answered in parallel.
+
+    The workers accept the connections on the socket bound by the master.
+    The master restarts the workers that die, replaces all of them on
+    SIGHUP, and stops them on SIGTERM or SIGINT. The workers stop by
+    themselves if the master dies. A worker that is stopped finishes the
+    requests it has accepted, for up to graceful_timeout seconds.
+
+    The sessions are per worker, unless they are in a shared session
+    store.
+    """
+
+    def __init__(self, app, host, port, workers, post_fork=None,
+                 graceful_timeout=SERVER_GRACEFUL_TIMEOUT):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.post_fork = post_fork
+        self.graceful_timeout = graceful_timeout
+        self.socket = None
+        self.master_pid = None
+        # pid -> generation of the worker
+        self.workers = {}
+        self.generation = 0
+        self._stopping = False
+        self._reloading = False
+        # requests in progress in the worker
+        self._requests = 0
+        self._requests_lock = threading.Lock()
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(128)
+        self.port = sock.getsockname()[1]
+        return sock
+
+    def run(self):
+        self.socket = self.bind()
+        self.master_pid = os.getpid()
+        # Collect the garbage of the loading now, rather than in each worker
+        # where it would copy the pages
+        gc.collect()
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        logger.warn("Serving on {}:{} with {} workers".format(
+            self.host, self.port, self.num_workers))
+        try:
+            while not self._stopping:
+                if self._reloading:
+                    self._reloading = False
+                    self.reload()
+                self.reap()
+                self.spawn_workers()
+                # interrupted by the signals
+                time.sleep(0.5)
+        finally:
+            self.stop()
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def _handle_reload(self, signum, frame):
+        self._reloading = True
+
+    def spawn_workers(self):
+        current = sum(1 for g in self.workers.itervalues()
+                      if g == self.generation)
+        for _ in xrange(self.num_workers - current):
+            pid = os.fork()
+            if pid == 0:
+                self._run_worker()
+            self.workers[pid] = self.generation
+            logger.info("Started worker {}".format(pid))
+
+    def reload(self):
+        """Start new workers, then stop the old ones gracefully"""
+        self.generation += 1
+        old = [pid for pid, g in self.workers.iteritems()
+               if g != self.generation]
+        self.spawn_workers()
+        for pid in old:
+            self._kill(pid, signal.SIGTERM)
+        logger.warn("Reloaded workers")
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as ex:
+                if ex.errno == errno.ECHILD:
+                    self.workers.clear()
+                    return
+                raise
+            if pid == 0:
+                return
+            if self.workers.pop(pid, None) == self.generation and \
+                    not self._stopping:
+                logger.error("Worker {} exited with status {}".format(
+                    pid, status))
+
+    def stop(self):
+        for pid in self.workers.keys():
+            self._kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout + 1
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in self.workers.keys():
+            logger.error("Killing worker {}".format(pid))
+            self._kill(pid, signal.SIGKILL)
+        self.reap()
+        self.socket.close()
+
+    def _kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError as ex:
+            if ex.errno != errno.ESRCH:
+                raise
+
+    def _count_requests(self, environ, start_response):
+        with self._requests_lock:
+            self._requests += 1
+        try:
+            return self.app(environ, start_response)
+        finally:
+            with self._requests_lock:
+                self._requests -= 1
+
+    def _run_worker(self):
+        """Serve until SIGTERM, and exit the process"""
+        status = 0
+        try:
+            # Ctrl-C is for the master
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.workers.clear()
+            if self.post_fork is not None:
+                self.post_fork()
+            server = make_server(
+                self.host, self.port, self._count_requests, threaded=True,
+                fd=self.socket.fileno())
+
+            def handle_stop(signum, frame):
+                # shutdown() waits for serve_forever() to return, so it
+                # can't be called in the handler
+                threading.Thread(target=server.shutdown).start()
+            signal.signal(signal.SIGTERM, handle_stop)
+
+            def watch_master():
+                # the worker is adopted by another process when the master
+                # dies
+                while os.getppid() == self.master_pid:
+                    time.sleep(1)
+                logger.error("Master {} is gone".format(self.master_pid))
+                server.shutdown()
+            watcher = threading.Thread(target=watch_master,
+                                       name="MasterWatcher")
+            watcher.daemon = True
+            watcher.start()
+            server.serve_forever()
+            deadline = time.time() + self.graceful_timeout
+            while self._requests and time.time() < deadline:
+                time.sleep(0.05)
+        except Exception as ex:
+            logger.exception(ex)
+            status = 1
+        finally:
+            # don't return to the master's stack
+            try:
+                atexit._run_exitfuncs()
+            finally:
+                os._exit(status)
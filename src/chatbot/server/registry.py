@@ -0,0 +1,115 @@
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger('hr.chatbot.server.registry')
+
+
+def get_namespace(character):
+    """The user of a character with the id user/id, or None"""
+    toks = character.id.split('/')
+    if len(toks) == 2:
+        return toks[0]
+
+
+class _Index(object):
+    """The indexes of a list of characters. They are never changed, the
+    registry replaces them."""
+
+    def __init__(self, characters):
+        self.characters = characters
+        self.by_id = defaultdict(list)
+        self.by_name = defaultdict(list)
+        self.by_name_lang = defaultdict(list)
+        self.by_namespace = defaultdict(list)
+        for c in characters:
+            self.by_id[c.id].append(c)
+            self.by_name[c.name].append(c)
+            for lang in c.languages:
+                self.by_name_lang[(c.name, lang)].append(c)
+            self.by_namespace[get_namespace(c)].append(c)
+        # (botname, lang, user) -> (responding characters, generic)
+        self.responding = {}
+
+
+class CharacterRegistry(object):
+    """The loaded characters, indexed by id, by name and language and by
+    user namespace. The responding characters of each bot name, language
+    and user are resolved once and cached.
+
+    add() and set() build new indexes and swap them in, which also drops
+    the cached responding characters, so the readers see either the old
+    or the new characters.
+    """
+
+    def __init__(self, characters=()):
+        self._lock = threading.Lock()
+        self._index = _Index(list(characters))
+
+    def __iter__(self):
+        return iter(self._index.characters)
+
+    def __len__(self):
+        return len(self._index.characters)
+
+    def set(self, characters):
+        """Replace all the characters"""
+        with self._lock:
+            self._index = _Index(list(characters))
+
+    def add(self, character):
+        """Add the character unless there is one with the same id"""
+        with self._lock:
+            if character.id in self._index.by_id:
+                return False
+            self._index = _Index(self._index.characters + [character])
+            return True
+
+    def get(self, id, lang=None, ns=None):
+        """The first character with the id, that speaks lang and is named
+        ns if they are given"""
+        for character in self._index.by_id.get(id, ()):
+            if ns is not None and character.name != ns:
+                continue
+            if lang is None or lang in character.languages:
+                return character
+
+    def get_by_name(self, name, local=True, lang=None, user=None):
+        """The characters named name. If user is given, the ones in other
+        users' namespaces are left out."""
+        index = self._index
+        if lang is not None:
+            characters = index.by_name_lang.get((name, lang), ())
+        else:
+            characters = index.by_name.get(name, ())
+        return [c for c in characters
+                if (not local or c.local) and
+                (user is None or get_namespace(c) in (None, user))]
+
+    def get_by_namespace(self, user):
+        return list(self._index.by_namespace.get(user, ()))
+
+    def get_responding_characters(self, botname, lang, user):
+        """The characters of the bot, sorted by level, with the generic
+        character of lang. Return them and the generic character if it's
+        not one of the bot's, as it then shares the bot's properties."""
+        index = self._index
+        key = (botname, lang, user)
+        responding = index.responding.get(key)
+        if responding is None:
+            characters = self.get_by_name(
+                botname, local=False, lang=lang, user=user)
+            if not characters:
+                logger.warn('No character is satisfied')
+            shared = None
+            generic = self.get('generic', lang)
+            if generic:
+                if generic not in characters:
+                    characters.append(generic)
+                    shared = generic
+            else:
+                logger.info("Generic character is not found")
+            characters.sort(key=lambda x: x.level)
+            responding = (tuple(characters), shared)
+            index.responding[key] = responding
+        return responding
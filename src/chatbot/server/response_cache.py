@@ -1,18 +1,46 @@
 import datetime as dt
 from collections import defaultdict
 import logging
-import os
-import csv
+import sys
 from chatbot.utils import norm
+from history_writer import history_writer
+from config import RESPONSE_CACHE_MAX_RECORDS, RESPONSE_CACHE_MAX_BYTES
+from config import SESSION_STORE_TAIL
 
 logger = logging.getLogger('hr.chatbot.server.response_cache')
 
+def record_size(record):
+    """Approximate memory used by a record, in bytes"""
+    return sys.getsizeof(record) + sum(
+        sys.getsizeof(k) + sys.getsizeof(v) for k, v in record.iteritems())
+
 class ResponseCache(object):
+    """The chat history of a session.
+
+    Only the latest records are kept in memory, up to max_records records
+    and max_bytes bytes (0 for no limit). The older ones are dumped to the
+    history file and dropped, but they are still in the indexes of the
+    repeat checks. The record indexes (in update, rate) count the dropped
+    records too.
+    """
 
-    def __init__(self):
+    def __init__(self, max_records=RESPONSE_CACHE_MAX_RECORDS,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
         self.record = []
+        self.record_bytes = []
+        self.bytes = 0
+        # number of the records dropped from memory
+        self.offset = 0
         self.cursor = 0
+        self.dump_file = None
+        # normalized question -> indexes of the records in memory
         self.index = defaultdict(list)
+        # normalized answer -> [count, index and datetime of the last record]
+        self.answers = {}
+        # (normalized question, normalized answer) -> count
+        self.question_answers = defaultdict(int)
         self.last_question = None
         self.last_answer = None
         self.that_question = None
@@ -22,29 +50,38 @@ class ResponseCache(object):
         del self.record[:]
         del self.index
         self.record = []
+        self.record_bytes = []
+        self.bytes = 0
+        self.offset = 0
         self.cursor = 0
         self.index = defaultdict(list)
+        self.answers = {}
+        self.question_answers = defaultdict(int)
         self.last_question = None
         self.last_answer = None
         self.that_question = None
         self.last_time = None
 
+    def __len__(self):
+        return self.offset + len(self.record)
+
     def check(self, question, answer):
         # each additional character over the 10 characters, adds 30 seconds
         # delay before that AIML string is allowed to repeat.
-        same_answers = [r for r in self.record if norm(r['Answer']) == norm(answer)]
-        time_elapsed = (dt.datetime.utcnow() - same_answers[-1]['Datetime']
-                        ).seconds if same_answers else 0
-        if max(0, len(norm(answer)) - 10) * 30 <= time_elapsed:
+        norm_answer = norm(answer)
+        same_answer = self.answers.get(norm_answer)
+        time_elapsed = (dt.datetime.utcnow() - same_answer[2]
+                        ).seconds if same_answer else 0
+        if max(0, len(norm_answer) - 10) * 30 <= time_elapsed:
             logger.debug("Allow repeat answer {}".format(answer))
             logger.debug("Answer length {}, time elapsed {}".format(
-                len(norm(answer)), time_elapsed))
+                len(norm_answer), time_elapsed))
             return True
 
-        if norm(answer) == norm(self.last_answer):
+        if norm_answer == norm(self.last_answer):
             logger.debug("Last answer repeat")
             return False
-        if not self.is_unique(answer):
+        if same_answer:
             logger.debug("Non unique answer")
             return False
         if self.contain(question, answer):
@@ -56,69 +93,187 @@ class ResponseCache(object):
         question = record['Question']
         answer = record['Answer']
         self.record.append(record)
-        self.index[norm(question)].append(len(self.record) - 1)
+        size = record_size(record)
+        self.record_bytes.append(size)
+        self.bytes += size
+        self._index_record(len(self) - 1)
         self.last_question = question
         self.last_answer = answer
         self.last_time = record.get('Datetime')
+        self._evict()
 
-    def update(self, idx, **kwargs):
+    def _local_index(self, idx):
+        """Return the index in memory of the record idx, or -1 if it's
+        dropped or out of range"""
         if idx < 0:
-            idx = len(self.record) + idx
-        if idx >= 0 and idx < len(self.record):
+            idx = len(self) + idx
+        if idx < self.offset or idx >= len(self):
+            return -1
+        return idx - self.offset
+
+    def update(self, idx, **kwargs):
+        i = self._local_index(idx)
+        if i >= 0:
+            reindex = set(kwargs) & set(
+                ['Feedback', 'Question', 'Answer', 'Datetime'])
+            if reindex:
+                self._unindex_record(self.offset + i)
             for k, v in kwargs.iteritems():
-                self.record[idx][k] = v
+                self.record[i][k] = v
             if 'Feedback' in kwargs:
                 answer = kwargs.pop('Feedback')
-                self.record[idx]['Answer'] = answer
-                self.record[idx]['Label'] = kwargs.pop('Label', '')
+                self.record[i]['Answer'] = answer
+                self.record[i]['Label'] = kwargs.pop('Label', '')
                 self.last_answer = answer
                 logger.warn("Updated feedback at %s", idx)
+            if reindex:
+                self._index_record(self.offset + i)
             return True
         return False
 
     def rate(self, rate, idx):
-        if idx < 0:
-            idx = len(self.record) + idx
-        if idx < len(self.record):
-            self.record[idx]['Rate'] = rate
+        i = self._local_index(idx)
+        if i >= 0:
+            self.record[i]['Rate'] = rate
             return True
         return False
 
     def contain(self, question, answer):
-        question = norm(question)
-        answer = norm(answer)
-        records = self._get_records(question)
-        answers = [norm(r['Answer']) for r in records]
-        return answer in answers
+        return (norm(question), norm(answer)) in self.question_answers
 
     def is_unique(self, answer):
-        answers = [norm(r['Answer']) for r in self.record]
-        return not norm(answer) in answers
+        return norm(answer) not in self.answers
 
     def _get_records(self, question):
-        records = [self.record[i] for i in self.index[norm(question)]]
+        records = [self.record[i - self.offset]
+                   for i in self.index[norm(question)]]
         return records
 
+    def _index_record(self, idx):
+        record = self.record[idx - self.offset]
+        question = norm(record['Question'])
+        answer = norm(record['Answer'])
+        self.index[question].append(idx)
+        self.question_answers[(question, answer)] += 1
+        same_answer = self.answers.get(answer)
+        if same_answer is None:
+            self.answers[answer] = [1, idx, record.get('Datetime')]
+        else:
+            same_answer[0] += 1
+            if idx >= same_answer[1]:
+                same_answer[1] = idx
+                same_answer[2] = record.get('Datetime')
+
+    def _unindex_record(self, idx):
+        record = self.record[idx - self.offset]
+        question = norm(record['Question'])
+        answer = norm(record['Answer'])
+        self.index[question].remove(idx)
+        if not self.index[question]:
+            del self.index[question]
+        key = (question, answer)
+        self.question_answers[key] -= 1
+        if self.question_answers[key] == 0:
+            del self.question_answers[key]
+        same_answer = self.answers[answer]
+        same_answer[0] -= 1
+        if same_answer[0] == 0:
+            del self.answers[answer]
+        elif same_answer[1] == idx:
+            # the previous record with the answer, if it's still in memory
+            for i in xrange(idx - self.offset - 1, -1, -1):
+                if norm(self.record[i]['Answer']) == answer:
+                    same_answer[1] = self.offset + i
+                    same_answer[2] = self.record[i].get('Datetime')
+                    break
+
+    def _evict(self):
+        """Drop the oldest records over the limits, dumping them first.
+        The records of the sessions that are never dumped (test sessions)
+        are just dropped."""
+        n = 0
+        if self.max_records and len(self.record) > self.max_records:
+            n = len(self.record) - self.max_records
+        if self.max_bytes:
+            size = self.bytes - sum(self.record_bytes[:n])
+            while n < len(self.record) - 1 and size > self.max_bytes:
+                size -= self.record_bytes[n]
+                n += 1
+        if n == 0:
+            return
+        if self.dump_file is not None:
+            if self.cursor < self.offset + n:
+                self.dump(self.dump_file)
+            n = min(n, self.cursor - self.offset)
+        for i in xrange(n):
+            question = norm(self.record[i]['Question'])
+            self.index[question].remove(self.offset + i)
+            if not self.index[question]:
+                del self.index[question]
+        self.bytes -= sum(self.record_bytes[:n])
+        del self.record[:n]
+        del self.record_bytes[:n]
+        self.offset += n
+        self.cursor = max(self.cursor, self.offset)
+
+    def get_state(self, tail=SESSION_STORE_TAIL):
+        """Return the picklable state of the cache: the last tail records,
+        and the indexes of all of them"""
+        return {
+            'records': self.record[-tail:] if tail else [],
+            'size': len(self),
+            'cursor': self.cursor,
+            'dump_file': self.dump_file,
+            'answers': self.answers,
+            'question_answers': dict(self.question_answers),
+            'last_question': self.last_question,
+            'last_answer': self.last_answer,
+            'that_question': self.that_question,
+            'last_time': self.last_time,
+        }
+
+    def set_state(self, state):
+        self.clean()
+        self.record = list(state['records'])
+        self.record_bytes = [record_size(r) for r in self.record]
+        self.bytes = sum(self.record_bytes)
+        self.offset = state['size'] - len(self.record)
+        self.cursor = max(state['cursor'], self.offset)
+        self.dump_file = state['dump_file']
+        for i, record in enumerate(self.record):
+            self.index[norm(record['Question'])].append(self.offset + i)
+        self.answers = state['answers']
+        self.question_answers = defaultdict(int, state['question_answers'])
+        self.last_question = state['last_question']
+        self.last_answer = state['last_answer']
+        self.that_question = state['that_question']
+        self.last_time = state['last_time']
+
+    def memory_usage(self):
+        """Approximate memory used by the records and the indexes, in
+        bytes"""
+        size = self.bytes
+        for answer in self.answers:
+            size += sys.getsizeof(answer)
+        for question, answer in self.question_answers:
+            size += sys.getsizeof(question)
+        return size
+
     def dump(self, fname):
         if not self.record:
             logger.warn("Nothing to dump")
             return False
-        if self.record and self.cursor >= len(self.record):
+        if self.record and self.cursor >= len(self):
             logger.warn("Nothing to dump")
             return False
-        dirname = os.path.dirname(fname)
-        if not os.path.isdir(dirname):
-            os.makedirs(dirname)
+        self.dump_file = fname
         header = self.record[0].keys()
-        with open(fname, 'a') as f:
-            writer = csv.DictWriter(f, header, extrasaction='ignore')
-            if self.cursor == 0:
-                writer.writeheader()
-            writer.writerows(self.record[self.cursor:])
-            self.cursor = len(self.record)
-            logger.warn("Dumpped chat history to {}".format(fname))
-            return True
-        return False
+        # copies, the records can be rated and updated later
+        rows = [dict(r) for r in self.record[self.cursor - self.offset:]]
+        history_writer.write(fname, header, rows, self.cursor == 0)
+        self.cursor = len(self)
+        logger.info("Dumpped chat history to {}".format(fname))
+        return True
 
 if __name__ == '__main__':
     cache = ResponseCache()
@@ -1,13 +1,18 @@
 import threading
+import heapq
 import time
 import os
 import sys
 import datetime as dt
 import logging
 import traceback
+import copy
 import uuid
+from contextlib import contextmanager
 from config import HISTORY_DIR, TEST_HISTORY_DIR, SESSION_REMOVE_TIMEOUT
+from config import SESSION_SHARDS
 from response_cache import ResponseCache
+from history_writer import history_writer
 from collections import defaultdict
 from chatbot.server.character import TYPE_AIML
 from chatbot.db import get_mongodb, MongoDB
@@ -60,11 +65,7 @@ class Session(object):
         self.cache = ResponseCache()
         self.created = dt.datetime.utcnow()
         self.characters = []
-        dirname = os.path.join(HISTORY_DIR, self.created.strftime('%Y%m%d'))
-        test_dirname = os.path.join(
-            TEST_HISTORY_DIR, self.created.strftime('%Y%m%d'))
-        self.fname = os.path.join(dirname, '{}.csv'.format(self.sid))
-        self.test_fname = os.path.join(test_dirname, '{}.csv'.format(self.sid))
+        self._set_fnames()
         self.dump_file = None
         self.closed = False
         self.active = False
@@ -72,6 +73,26 @@ class Session(object):
         self.test = False
         self.last_used_character = None
         self.open_character = None
+        # serializes the requests of the session
+        self.lock = threading.RLock()
+        # version of the state in the session store
+        self.version = None
+        # character key -> stored state, of the characters that haven't
+        # responded in this process since the session is loaded
+        self.character_states = {}
+        # predicates set and left as they were by set_characters
+        self.predicate_writes = 0
+        self.predicate_writes_avoided = 0
+        # the characters and the minute the context is set for, None when
+        # the context of the characters may have changed since
+        self.context_key = None
+
+    def _set_fnames(self):
+        dirname = os.path.join(HISTORY_DIR, self.created.strftime('%Y%m%d'))
+        test_dirname = os.path.join(
+            TEST_HISTORY_DIR, self.created.strftime('%Y%m%d'))
+        self.fname = os.path.join(dirname, '{}.csv'.format(self.sid))
+        self.test_fname = os.path.join(test_dirname, '{}.csv'.format(self.sid))
 
     def set_test(self, test):
         if test:
@@ -96,21 +117,30 @@ class Session(object):
 
     def set_characters(self, characters):
         self.characters = characters
+        if self.character_states:
+            for c in self.characters:
+                state = self.character_states.pop(_character_key(c), None)
+                if state is not None:
+                    c.set_session_state(self, state)
+        minute, clock = _clock_context(dt.datetime.utcnow())
+        context_key = (tuple(self.characters), minute)
+        if context_key == self.context_key:
+            return
+        self.context_key = context_key
         for c in self.characters:
             if c.type != TYPE_AIML:
                 continue
             prop = c.get_properties()
-            context = {}
+            context = dict(clock)
             for key in ['weather', 'location', 'temperature']:
                 if key in prop:
                     context[key] = prop.get(key)
-            now = dt.datetime.utcnow()
-            context['time'] = dt.datetime.strftime(now, '%I:%M %p')
-            context['date'] = dt.datetime.strftime(now, '%B %d %Y')
             try:
-                c.set_context(self, context)
-            except Exception as ex:
-                pass
+                written = c.update_context(self, context)
+            except Exception:
+                continue
+            self.predicate_writes += written
+            self.predicate_writes_avoided += len(context) - written
 
     def close(self):
         self.reset()
@@ -118,8 +148,10 @@ class Session(object):
 
     def reset(self):
         self.cache.clean()
+        self.character_states = {}
         self.last_used_character = None
         self.open_character = None
+        self.context_key = None
         for c in self.characters:
             try:
                 c.refresh(self)
@@ -136,6 +168,40 @@ class Session(object):
             self.dump_file = self.fname
         return self.test or self.cache.dump(self.dump_file)
 
+    def get_state(self):
+        """Return the picklable state of the session, for the session
+        store"""
+        characters = dict(self.character_states)
+        for c in self.characters:
+            state = c.get_session_state(self)
+            if state is not None:
+                characters[_character_key(c)] = state
+        return {
+            'created': self.created,
+            'test': self.test,
+            'active': self.active,
+            'last_active_time': self.last_active_time,
+            'context': dict(self.session_context.__dict__),
+            'cache': self.cache.get_state(),
+            'characters': characters,
+        }
+
+    def set_state(self, state):
+        """Restore the state from get_state(). The characters get theirs
+        when they are set."""
+        self.created = state['created']
+        self._set_fnames()
+        self.test = state['test']
+        self.active = state['active']
+        self.last_active_time = state['last_active_time']
+        self.session_context.__dict__.clear()
+        self.session_context.__dict__.update(state['context'])
+        self.cache.set_state(state['cache'])
+        self.character_states = state['characters']
+        self.context_key = None
+        characters, self.characters = self.characters, []
+        self.set_characters(characters)
+
     def since_idle(self, since):
         if self.last_active_time is not None:
             return (since - self.last_active_time).total_seconds()
@@ -147,84 +213,295 @@ class Session(object):
             self.sid, self.created, self.cache.last_time)
 
 
-class Locker(object):
+class BatchSession(Session):
+    """A copy of a session, to answer the questions of a batch. Its
+    records are kept in records, shared by the copies of the session, and
+    added to the session when the batch is done."""
 
-    def __init__(self):
-        self._lock = threading.RLock()
+    def __init__(self, sid, session, lock, records):
+        super(BatchSession, self).__init__(sid)
+        self.parent = session
+        self.session_context.__dict__.update(
+            copy.deepcopy(session.session_context.__dict__))
+        self.test = session.test
+        # serializes the records of the batch sessions of the parent
+        self._add_lock = lock
+        self.records = records
 
-    def lock(self):
-        self._lock.acquire()
+    def add(self, record):
+        with self._add_lock:
+            if self.parent.closed:
+                return False
+            self.records.append(record)
+            return True
+
+    def dump(self):
+        return False
 
-    def unlock(self):
-        self._lock.release()
+
+class TierSession(object):
+    """A session as a tier answers it in the tier pool. The character
+    keeps its state for it under another sid, and the state is moved to
+    the session only if the tier answers in time."""
+
+    def __init__(self, session, sid):
+        self.session = session
+        self.sid = sid
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+_clock = (None, None)
+
+
+def _clock_context(now):
+    """The minute and its time and date predicates, formatted once a
+    minute"""
+    global _clock
+    minute = now.replace(second=0, microsecond=0)
+    clock = _clock
+    if clock[0] != minute:
+        clock = (minute, {
+            'time': dt.datetime.strftime(now, '%I:%M %p'),
+            'date': dt.datetime.strftime(now, '%B %d %Y'),
+        })
+        _clock = clock
+    return clock
+
+
+def _character_key(character):
+    return '{}/{}'.format(character.id, character.name)
+
+
+class Shard(object):
+    """A part of a dict, with its own lock"""
+
+    def __init__(self, factory=dict):
+        self.lock = threading.RLock()
+        self.data = factory()
 
 
 class SessionManager(object):
 
-    def __init__(self, auto_clean=True):
-        self._sessions = dict()
-        self._users = defaultdict(dict)
-        self._locker = Locker()
+    def __init__(self, auto_clean=True, shards=SESSION_SHARDS, store=None):
+        # the sessions shared with the other server processes, if any. The
+        # local sessions are then copies of the stored ones.
+        self.store = store
+        # sid -> session
+        self._shards = [Shard() for _ in xrange(shards)]
+        # client id -> user -> sid
+        self._user_shards = [Shard(lambda: defaultdict(dict))
+                             for _ in xrange(shards)]
+        # (expiry time, sid) of the sessions, the earliest first. The
+        # entries are checked against the last activity of the sessions
+        # when they are due, and pushed back if the sessions are active.
+        self._expiry = []
+        self.auto_clean = auto_clean
+        self._start_cleaner()
+
+    def _start_cleaner(self):
+        self._expiry_changed = threading.Condition()
         self._session_cleaner = threading.Thread(
             target=self._clean_sessions, name="SessionCleaner")
         self._session_cleaner.daemon = True
-        if auto_clean:
+        if self.auto_clean:
             self._session_cleaner.start()
 
-    def _threadsafe(f):
-        def wrap(self, *args, **kwargs):
-            self._locker.lock()
-            try:
-                return f(self, *args, **kwargs)
-            finally:
-                self._locker.unlock()
-        return wrap
+    def after_fork(self):
+        """Restart the session cleaner in a forked process"""
+        self._start_cleaner()
+
+    # Lock order: a user shard before a session shard. The expiry lock is
+    # never held with a shard lock.
+
+    def _session_shard(self, sid):
+        return self._shards[hash(sid) % len(self._shards)]
+
+    def _user_shard(self, client_id):
+        return self._user_shards[hash(client_id) % len(self._user_shards)]
 
-    @_threadsafe
     def remove_session(self, sid):
-        if sid in self._sessions:
-            session = self._sessions.pop(sid)
+        session = self._pop_session(sid)
+        if session is not None:
+            self._close_session(session)
+
+    def _pop_session(self, sid):
+        """Take the session out of the shards, and return it"""
+        shard = self._session_shard(sid)
+        with shard.lock:
+            session = shard.data.pop(sid, None)
+        if session is None:
+            return None
+        client_id = session.session_context.client_id
+        user = session.session_context.user
+        user_shard = self._user_shard(client_id)
+        with user_shard.lock:
+            sessions = user_shard.data.get(client_id)
+            if sessions and sessions.get(user) == sid:
+                del sessions[user]
+                if not sessions:
+                    del user_shard.data[client_id]
+        return session
+
+    def _close_session(self, session):
+        """Dump and close the session taken out of the shards. It waits
+        for the request the session is answering, so no shard lock is to
+        be held."""
+        with session.lock:
             session.dump()
             session.close()
-            del session
-            logger.info("Removed session {}".format(sid))
+        if self.store is not None:
+            self.store.delete(session.sid)
+        logger.info("Removed session {}".format(session.sid))
 
     def reset_session(self, sid):
-        if sid in self._sessions:
-            session = self._sessions.get(sid)
-            if session.active:
-                session.reset()
-                logger.warn("Reset session {}".format(sid))
- 
+        session = self.get_session(sid)
+        if session is not None:
+            with session.lock:
+                if session.active:
+                    session.reset()
+                    logger.warn("Reset session {}".format(sid))
+
     def get_session(self, sid):
         if sid is not None:
-            return self._sessions.get(sid, None)
+            session = self._session_shard(sid).data.get(sid, None)
+            if session is None and self.store is not None:
+                session = self._load_session(sid)
+            return session
+
+    def _load_session(self, sid):
+        """Load the session started by another process from the store"""
+        loaded = self.store.load(sid)
+        if loaded is None:
+            return None
+        version, state = loaded
+        shard = self._session_shard(sid)
+        with shard.lock:
+            session = shard.data.get(sid)
+            if session is not None:
+                return session
+            session = Session(sid)
+            session.set_state(state)
+            session.version = version
+            shard.data[sid] = session
+        self._push_expiry(sid)
+        logger.info("Loaded session {} version {}".format(sid, version))
+        return session
+
+    def sync_session(self, session):
+        """Reload the session if another process has saved it since"""
+        if self.store is None:
+            return
+        version = self.store.version(session.sid)
+        if version is None or version == session.version:
+            return
+        version, state = self.store.load(session.sid)
+        session.set_state(state)
+        session.version = version
+        logger.info("Reloaded session {} version {}".format(
+            session.sid, version))
+
+    def save_session(self, session):
+        """Save the session to the store. It raises VersionConflict if
+        another process has saved it since it was loaded."""
+        if self.store is not None:
+            session.version = self.store.save(
+                session.sid, session.get_state(), session.version)
+
+    @contextmanager
+    def transaction(self, session):
+        """Lock the session, in this process and in the store, bring it up
+        to date with the store and save it back when the block is done"""
+        with session.lock:
+            if self.store is None:
+                yield session
+                return
+            with self.store.lock(session.sid):
+                self.sync_session(session)
+                yield session
+                self.save_session(session)
+
+    def add_batch_sessions(self, session, count, characters):
+        """Copy the session and the states the characters keep for it
+        count times, to answer the questions of a batch concurrently. The
+        copies are only in this process. The session is to be locked."""
+        states = {}
+        for c in characters:
+            state = c.get_session_state(session)
+            if state is not None:
+                states[_character_key(c)] = state
+        lock = threading.Lock()
+        records = []
+        sessions = []
+        for i in xrange(count):
+            batch_session = BatchSession(
+                '{}.batch{}'.format(session.sid, i), session, lock, records)
+            batch_session.character_states = dict(states)
+            batch_session.set_characters(characters)
+            shard = self._session_shard(batch_session.sid)
+            with shard.lock:
+                shard.data[batch_session.sid] = batch_session
+            sessions.append(batch_session)
+        return sessions
+
+    def remove_batch_sessions(self, session, sessions):
+        """Remove the copies of the session, and add their records to it"""
+        for batch_session in sessions:
+            shard = self._session_shard(batch_session.sid)
+            with shard.lock:
+                shard.data.pop(batch_session.sid, None)
+            batch_session.close()
+        records = sessions[0].records if sessions else []
+        if not records:
+            return
+        with self.transaction(session):
+            for record in records:
+                session.add(record)
 
     def get_sid(self, client_id, user):
-        if client_id in self._users:
-            sessions = self._users.get(client_id)
+        if self.store is not None:
+            sid = self.store.get_sid(client_id, user)
+            if sid is not None and self.has_session(sid):
+                return sid
+            return None
+        shard = self._user_shard(client_id)
+        with shard.lock:
+            sessions = shard.data.get(client_id)
             if sessions:
                 sid = sessions.get(user)
-                session = self._sessions.get(sid)
-                if session:
+                if sid is not None and self.has_session(sid):
                     return sid
 
     def gen_sid(self):
         return str(uuid.uuid1())
 
-    @_threadsafe
     def add_session(self, client_id, user, sid):
-        if sid in self._sessions:
-            return False
         if sid is None:
             return False
-        session = Session(sid)
-        session.session_context.user = user
-        session.session_context.client_id = client_id
-        self._sessions[sid] = session
-        self._users[client_id][user] = sid
+        user_shard = self._user_shard(client_id)
+        shard = self._session_shard(sid)
+        with user_shard.lock:
+            with shard.lock:
+                if sid in shard.data:
+                    return False
+                session = Session(sid)
+                session.session_context.user = user
+                session.session_context.client_id = client_id
+                shard.data[sid] = session
+            user_shard.data[client_id][user] = sid
+        if self.store is not None:
+            self.save_session(session)
+            self.store.set_sid(client_id, user, sid)
+        self._push_expiry(sid)
         return True
 
+    def _push_expiry(self, sid):
+        with self._expiry_changed:
+            heapq.heappush(
+                self._expiry, (time.time() + SESSION_REMOVE_TIMEOUT, sid))
+            self._expiry_changed.notify()
+
     def start_session(self, client_id, user, test=False, refresh=False):
         """
         client_id: client id
@@ -232,52 +509,117 @@ class SessionManager(object):
         test: if it's a session for test
         refresh: if true, it will generate new session id
         """
-        _sid = self.get_sid(client_id, user)
-        if _sid and refresh:
-            self.remove_session(_sid)
-            _sid = None
-        if not _sid:
-            _sid = self.gen_sid()
-            self.add_session(client_id, user, _sid)
+        # one session per user, even when it's started concurrently
+        removed = None
+        with self._user_shard(client_id).lock:
+            _sid = self.get_sid(client_id, user)
+            if _sid and refresh:
+                removed = self._pop_session(_sid)
+                _sid = None
+            if not _sid:
+                _sid = self.gen_sid()
+                self.add_session(client_id, user, _sid)
+        if removed is not None:
+            self._close_session(removed)
         session = self.get_session(_sid)
         assert(session is not None)
-        session.set_test(test)
+        if session.test != test:
+            with self.transaction(session):
+                session.set_test(test)
         return _sid
 
     def has_session(self, sid):
-        return sid in self._sessions
+        if sid in self._session_shard(sid).data:
+            return True
+        return self.store is not None and \
+            self.store.version(sid) is not None
 
     def _clean_sessions(self):
         while True:
-            remove_sessions = []
-            since = dt.datetime.utcnow()
-            for sid, s in self._sessions.iteritems():
-                if s.since_idle(since) > SESSION_REMOVE_TIMEOUT:
-                    remove_sessions.append(sid)
-            for sid in remove_sessions:
-                self.remove_session(sid)
-            time.sleep(0.1)
+            with self._expiry_changed:
+                while not self._expiry:
+                    self._expiry_changed.wait()
+                expired, timeout = self._pop_expired_sessions()
+            for sid in expired:
+                if self._active_elsewhere(sid):
+                    self._push_expiry(sid)
+                else:
+                    self.remove_session(sid)
+            # The new sessions expire after the ones in the heap, and the
+            # active ones later than their entries, so nothing expires
+            # before the first entry is due.
+            time.sleep(timeout)
+
+    def _active_elsewhere(self, sid):
+        """If another process has saved the session recently"""
+        if self.store is None:
+            return False
+        updated = self.store.last_update(sid)
+        return updated is not None and \
+            time.time() - updated < SESSION_REMOVE_TIMEOUT
+
+    def _pop_expired_sessions(self):
+        """Return the expired sessions and the seconds until the next
+        entry is due."""
+        expired = []
+        now = time.time()
+        while self._expiry and self._expiry[0][0] <= now:
+            _, sid = heapq.heappop(self._expiry)
+            # only the sessions of this process, the expiry lock is held
+            session = self._session_shard(sid).data.get(sid)
+            if session is None:
+                continue
+            idle = session.since_idle(dt.datetime.utcnow())
+            if idle > SESSION_REMOVE_TIMEOUT:
+                expired.append(sid)
+            else:
+                heapq.heappush(self._expiry, (
+                    now + max(SESSION_REMOVE_TIMEOUT - idle, 0.01), sid))
+        if self._expiry:
+            return expired, max(self._expiry[0][0] - now, 0)
+        return expired, 0
 
     def list_sessions(self):
-        return self._sessions.values()
+        sessions = []
+        for shard in self._shards:
+            with shard.lock:
+                sessions.extend(shard.data.values())
+        return sessions
+
+    def memory_usage(self):
+        """Approximate memory used by the chat history of each session,
+        in bytes"""
+        return {s.sid: s.cache.memory_usage() for s in self.list_sessions()}
+
+    def context_stats(self):
+        """Predicates set by the sessions on every question, and the ones
+        skipped as they were unchanged"""
+        sessions = self.list_sessions()
+        return {
+            'predicate_writes': sum(s.predicate_writes for s in sessions),
+            'predicate_writes_avoided': sum(
+                s.predicate_writes_avoided for s in sessions),
+        }
 
 
 class ChatSessionManager(SessionManager):
 
-    def __init__(self, auto_clean=True):
-        super(ChatSessionManager, self).__init__(auto_clean)
+    def __init__(self, auto_clean=True, store=None):
+        super(ChatSessionManager, self).__init__(auto_clean, store=store)
 
     def dump_all(self):
         fnames = []
-        for sid, sess in self._sessions.iteritems():
-            if sess and sess.dump():
+        for sess in self.list_sessions():
+            if sess.dump():
                 fnames.append(sess.dump_file)
+        history_writer.flush()
         return fnames
 
     def dump(self, sid):
         fname = None
-        sess = self._sessions.get(sid)
+        sess = self.get_session(sid)
         if sess:
             sess.dump()
             fname = sess.dump_file
+            history_writer.flush()
         return fname
@@ -0,0 +1,261 @@
+import os
+import time
+import zlib
+import fcntl
+import sqlite3
+import logging
+import threading
+import cPickle as pickle
+from contextlib import contextmanager
+
+logger = logging.getLogger('hr.chatbot.server.session_store')
+
+
+def dumps(state):
+    return zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+
+def loads(data):
+    return pickle.loads(zlib.decompress(data))
+
+
+class VersionConflict(Exception):
+    """The session was saved by another process since it was loaded"""
+
+
+class SessionStore(object):
+    """Storage of the session states shared by the server processes, so
+    that any of them can answer any session.
+
+    The states are versioned: save() returns the new version, and a
+    process reloads a session when the version in the store is different
+    from the one it has. A process holds the lock of a session from the
+    time it brings it up to date to the time it saves it, so that the
+    processes don't overwrite each other's updates.
+    """
+
+    @contextmanager
+    def lock(self, sid):
+        """Hold the lock of the session among the processes"""
+        yield
+
+    def load(self, sid):
+        """Return (version, state) of the session, or None"""
+        raise NotImplementedError
+
+    def version(self, sid):
+        """Return the version of the session, or None"""
+        raise NotImplementedError
+
+    def save(self, sid, state, version=None):
+        """Save the state of the session. If version is given, it's the
+        version the state was loaded from, and VersionConflict is raised
+        if the stored one is different. Return the new version."""
+        raise NotImplementedError
+
+    def delete(self, sid):
+        raise NotImplementedError
+
+    def get_sid(self, client_id, user):
+        raise NotImplementedError
+
+    def set_sid(self, client_id, user, sid):
+        raise NotImplementedError
+
+    def last_update(self, sid):
+        """Return the time the session was saved, or None"""
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """Session states in the memory of the process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # sid -> (version, update time, serialized state)
+        self._states = {}
+        self._users = {}
+
+    def load(self, sid):
+        with self._lock:
+            item = self._states.get(sid)
+        if item is not None:
+            return item[0], loads(item[2])
+
+    def version(self, sid):
+        item = self._states.get(sid)
+        if item is not None:
+            return item[0]
+
+    def save(self, sid, state, version=None):
+        data = dumps(state)
+        with self._lock:
+            item = self._states.get(sid)
+            stored = item[0] if item is not None else None
+            if version is not None and stored != version:
+                raise VersionConflict(sid)
+            version = (stored or 0) + 1
+            self._states[sid] = (version, time.time(), data)
+        return version
+
+    def delete(self, sid):
+        with self._lock:
+            self._states.pop(sid, None)
+            for key, value in self._users.items():
+                if value == sid:
+                    del self._users[key]
+
+    def get_sid(self, client_id, user):
+        return self._users.get((client_id, user))
+
+    def set_sid(self, client_id, user, sid):
+        with self._lock:
+            self._users[(client_id, user)] = sid
+
+    def last_update(self, sid):
+        item = self._states.get(sid)
+        if item is not None:
+            return item[1]
+
+
+class SqliteSessionStore(SessionStore):
+    """Session states in a sqlite database, shared by the processes on the
+    host.
+
+    The sessions are locked by stripes: a byte of the lock file, taken
+    with lockf() by the processes, and a lock per stripe for the threads
+    of a process, as lockf() locks belong to the process. They are
+    released if the process dies.
+    """
+
+    def __init__(self, path, timeout=10, lock_stripes=1024):
+        self.path = path
+        self.timeout = timeout
+        self.lock_stripes = lock_stripes
+        self._local = threading.local()
+        self._locks_lock = threading.Lock()
+        self._locks = None
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # not kept, so that it's not inherited by the forked processes
+        conn = sqlite3.connect(path, timeout=timeout)
+        try:
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY "
+                    "KEY, version INTEGER, updated REAL, state BLOB)")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS users (client_id TEXT, "
+                    "user TEXT, sid TEXT, PRIMARY KEY (client_id, user))")
+        finally:
+            conn.close()
+
+    def _connection(self):
+        """The connection of the thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.text_factory = str
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _stripe_locks(self):
+        """The lock file and the locks of the stripes of the process"""
+        with self._locks_lock:
+            if self._locks is None or self._locks[0] != os.getpid():
+                f = open('{}.lock'.format(self.path), 'a')
+                self._locks = (os.getpid(), f, [
+                    threading.Lock() for _ in xrange(self.lock_stripes)])
+            return self._locks[1:]
+
+    @contextmanager
+    def lock(self, sid):
+        f, locks = self._stripe_locks()
+        stripe = (zlib.crc32(sid) & 0xffffffff) % self.lock_stripes
+        # the stripes the thread holds, as the transactions can nest
+        held = self._local.__dict__.setdefault('held', set())
+        if stripe in held:
+            yield
+            return
+        with locks[stripe]:
+            fcntl.lockf(f, fcntl.LOCK_EX, 1, stripe)
+            held.add(stripe)
+            try:
+                yield
+            finally:
+                held.discard(stripe)
+                fcntl.lockf(f, fcntl.LOCK_UN, 1, stripe)
+
+    def _key(self, value):
+        # NULLs are distinct in the primary key
+        return u'' if value is None else unicode(value)
+
+    def load(self, sid):
+        row = self._connection().execute(
+            "SELECT version, state FROM sessions WHERE sid=?",
+            (sid,)).fetchone()
+        if row is not None:
+            return row[0], loads(str(row[1]))
+
+    def version(self, sid):
+        row = self._connection().execute(
+            "SELECT version FROM sessions WHERE sid=?", (sid,)).fetchone()
+        if row is not None:
+            return row[0]
+
+    def save(self, sid, state, version=None):
+        data = sqlite3.Binary(dumps(state))
+        with self._connection() as conn:
+            # takes the write lock, so that the version is read and
+            # incremented atomically
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT version FROM sessions WHERE sid=?", (sid,)).fetchone()
+            stored = row[0] if row is not None else None
+            if version is not None and stored != version:
+                raise VersionConflict(sid)
+            version = (stored or 0) + 1
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                (sid, version, time.time(), data))
+        return version
+
+    def delete(self, sid):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM sessions WHERE sid=?", (sid,))
+            conn.execute("DELETE FROM users WHERE sid=?", (sid,))
+
+    def get_sid(self, client_id, user):
+        row = self._connection().execute(
+            "SELECT sid FROM users WHERE client_id=? AND user=?",
+            (self._key(client_id), self._key(user))).fetchone()
+        if row is not None:
+            return row[0]
+
+    def set_sid(self, client_id, user, sid):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO users VALUES (?, ?, ?)",
+                (self._key(client_id), self._key(user), sid))
+
+    def last_update(self, sid):
+        row = self._connection().execute(
+            "SELECT updated FROM sessions WHERE sid=?", (sid,)).fetchone()
+        if row is not None:
+            return row[0]
+
+
+def get_session_store(spec):
+    """Return the session store of the spec, 'memory' or 'sqlite:<path>',
+    or None if it's empty."""
+    if not spec:
+        return None
+    if spec == 'memory':
+        return MemorySessionStore()
+    if spec.startswith('sqlite:'):
+        return SqliteSessionStore(os.path.expanduser(spec[len('sqlite:'):]))
+    raise ValueError("Unknown session store {}".format(spec))
@@ -1,22 +1,67 @@
 import os
 import re
+import threading
+from collections import OrderedDict
 from jinja2 import Template, Environment, meta
 import jinja2
 from renderers import *
+from config import TEMPLATE_CACHE_SIZE
 import logging
 
 logger = logging.getLogger('hr.chatbot.server.template')
 
+class CompiledTemplate(object):
+    """A template with what render() needs of its AST"""
+
+    def __init__(self, string):
+        ast = environment.parse(string)
+        self.variables = {}
+        for node in ast.body:
+            if isinstance(node, jinja2.nodes.Assign):
+                self.variables[node.target.name] = node.node.value
+        self.func = get_render_func(ast, string)
+        self.template = environment.from_string(ast)
+
+
+class TemplateCache(object):
+    """The compiled templates by their source, the least recently used
+    ones dropped first"""
+
+    def __init__(self, size=TEMPLATE_CACHE_SIZE):
+        self.size = size
+        self.templates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, string):
+        with self._lock:
+            compiled = self.templates.pop(string, None)
+            if compiled is not None:
+                self.templates[string] = compiled
+                self.hits += 1
+                return compiled
+        compiled = CompiledTemplate(string)
+        with self._lock:
+            self.misses += 1
+            self.templates[string] = compiled
+            while len(self.templates) > self.size:
+                self.templates.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self.templates.clear()
+
+environment = Environment()
+template_cache = TemplateCache()
+
 def render(string):
     render_result = ''
-    variables = {}
-    t = Template(string)
-    env = Environment()
-    ast = env.parse(string)
-    for node in ast.body:
-        if isinstance(node, jinja2.nodes.Assign):
-            variables[node.target.name] = node.node.value
-    func = get_render_func(ast)
+    compiled = template_cache.get(string)
+    t = compiled.template
+    variables = dict(compiled.variables)
+    func = compiled.func
     if func is not None:
         try:
             render_result = func(t) or t.render()
@@ -27,7 +72,7 @@ def render(string):
         render_result = t.render()
     return {"render_result": render_result, "variables": variables}
 
-def get_render_func(ast):
+def get_render_func(ast, string):
     func = None
     variables = meta.find_undeclared_variables(ast)
     if 'temperature' in variables:
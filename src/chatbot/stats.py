@@ -2,50 +2,42 @@ import os
 import logging
 import pandas as pd
 import glob
-import re
-import datetime as dt
-from collections import Counter
+from history_index import HistoryIndex, history_days
 
 logger = logging.getLogger('hr.chatbot.stats')
-trace_pattern = re.compile(
-    r'../(?P<fname>.*), (?P<tloc>\(.*\)), (?P<pname>.*), (?P<ploc>\(.*\))')
 
 
-def collect_history_data(history_dir, days):
-    today = dt.datetime.utcnow()
-    dfs = []
-    for d in glob.glob('{}/*'.format(history_dir)):
-        if os.path.isdir(d):
-            dirname = os.path.basename(d)
-            dirdate = None
-            try:
-                dirdate = dt.datetime.strptime(dirname, '%Y%m%d')
-            except Exception as ex:
-                logger.error(ex)
-            if dirdate and (days == -1 or (today - dirdate).days < days):
-                for fname in glob.glob('{}/{}/*.csv'.format(history_dir, dirname)):
-                    try:
-                        dfs.append(pd.read_csv(fname))
-                    except Exception as ex:
-                        logger.warn("Reading {} error: {}".format(fname, ex))
-    if not dfs:
+def history_files(history_dir, days):
+    """The history files of the last days, -1 for all of them, in the
+    order of the days"""
+    files = []
+    for day in history_days(history_dir, days):
+        files.extend(sorted(glob.glob('{}/{}/*.csv'.format(history_dir, day))))
+    return files
+
+
+def collect_history_data(history_dir, days, columns=None):
+    """The history records of the last days, with the columns given or all
+    of them, from the history index brought up to date"""
+    index = HistoryIndex(history_dir)
+    index.update()
+    df = index.read(days, columns)
+    if df is None:
         return None
-    df = pd.concat(dfs, ignore_index=True)
-    df = df[df.Datetime != 'Datetime'].sort(
-        ['User', 'Datetime']).drop_duplicates()
+    df = df.sort_values(['User', 'Datetime']).drop_duplicates()
     return df
 
 
 def history_stats(history_dir, days):
-    df = collect_history_data(history_dir, days)
+    columns = [u'Datetime', u'Revision', u'User', u'BotName',
+               u'AnsweredBy', u'Question', u'Answer', u'Rate', u'Trace']
+    df = collect_history_data(history_dir, days, columns)
     if df is None:
         return {}
     if days == -1:
         stats_csv = '{}/full_history.csv'.format(history_dir)
     else:
         stats_csv = '{}/last_{}_days.csv'.format(history_dir, days)
-    columns = [u'Datetime', u'Revision', u'User', u'BotName',
-               u'AnsweredBy', u'Question', u'Answer', u'Rate', u'Trace']
     df.to_csv(stats_csv, index=False, columns=columns)
     logger.info("Write statistic records to {}".format(stats_csv))
     records = len(df)
@@ -64,35 +56,36 @@ def history_stats(history_dir, days):
     return response
 
 
-def playback_history(df):
-    from client import Client
-    client = Client(os.environ.get('HR_CHATBOT_AUTHKEY', 'AAAAB3NzaC'), test=True)
-    pattern_column = []
-    for question in df.Question:
-        answer = client.ask(question, True)
-        traces = answer.get('trace')
-        patterns = []
-        if traces:
-            for trace in traces:
-                match_obj = trace_pattern.match(trace)
-                if match_obj:
-                    patterns.append(match_obj.group('pname'))
-        pattern_column.append(patterns)
-    df.loc[:,'Pattern'] = pd.Series(pattern_column, index=df.index)
-    return df
-
-def pattern_stats(history_dir, days):
-    df = collect_history_data(history_dir, days)
+def pattern_stats(history_dir, days, characters=None, workers=None):
+    """Replay the questions of the last days through the AIML characters,
+    loaded if they are not given, and count the patterns they match. The
+    replay resumes from its checkpoint."""
+    from replay import Replay, REPLAY_COLUMNS
+    index = HistoryIndex(history_dir)
+    index.update()
+    df = index.read(days, REPLAY_COLUMNS)
     if df is None:
         return {}
-    df = playback_history(df)
-    patterns = sum(df.Pattern, [])
-    counter = Counter(patterns)
-    pattern_freq = pd.Series(counter)
-    pattern_freq.sort(ascending=False)
+    if characters is None:
+        from chatbot.server.config import CHARACTER_PATH
+        from chatbot.server.loader import load_characters
+        characters = load_characters(CHARACTER_PATH)
+    # the rows of a failed index update are read again. The order of the
+    # rows is kept, for the checkpoint to resume from.
+    df = df.sort_values(['User', 'Datetime'], kind='mergesort')
+    df = df.drop_duplicates().sort_index()
+    df = df.where(df.notnull(), None)
+    rows = (dict(zip(REPLAY_COLUMNS, values))
+            for values in df.itertuples(index=False))
+    replay_csv = '{}/pattern_replay.csv'.format(history_dir)
+    Replay(characters, replay_csv, workers=workers).run(
+        history_days(index.index_dir, days), rows)
+    df = pd.read_csv(replay_csv, usecols=['Pattern'])
+    pattern_freq = df.Pattern.value_counts()
     stats_csv = '{}/pattern_frequency.csv'.format(history_dir)
-    pattern_freq.to_csv(stats_csv)
+    pattern_freq.to_csv(stats_csv, header=False)
     logger.info("Write pattern statistic to {}".format(stats_csv))
+    return pattern_freq.to_dict()
 
 if __name__ == '__main__':
     logging.basicConfig()
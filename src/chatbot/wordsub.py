@@ -52,6 +52,8 @@ not.
 import re
 import string
 
+from aiml.WordSub import WordSub as _WordSub
+
 DEFAULT_ENGLISH_NORMAL = {
     "I'd": "I would",
     "I'll": "I will",
@@ -166,50 +168,18 @@ DEFAULT_ENGLISH_NORMAL = {
     "you've": "you have",
 }
 
-class WordSub(dict):
-    """All-in-one multiple-string-substitution class."""
-
-    def _wordToRegex(self, word):
-        """Convert a word to a regex object which matches the word."""
-        if word != "" and word[0].isalpha() and word[-1].isalpha():
-            return "\\b%s\\b" % re.escape(word)
-        else:
-            return r"\b%s\b" % re.escape(word)
-
-    def _update_regex(self):
-        """Build re object based on the keys of the current
-        dictionary.
-
-        """
-        self._regex = re.compile("|".join(map(self._wordToRegex, self.keys())), re.UNICODE)
-        self._regexIsDirty = False
+class WordSub(_WordSub):
+    """WordSub that matches unicode words, and the lowercase, capitalized
+    and uppercase forms of each key."""
 
-    def __init__(self, defaults={}):
-        """Initialize the object, and populate it with the entries in
-        the defaults dictionary.
-
-        """
-        self._regex = None
-        self._regexIsDirty = True
-        for k, v in defaults.items():
-            self[k] = v
-
-    def __call__(self, match):
-        """Handler invoked for each regex match."""
-        return self[match.group(0)]
+    _reFlags = re.UNICODE
 
     def __setitem__(self, i, y):
-        self._regexIsDirty = True
+        self._trieIsDirty = True
         # for each entry the user adds, we actually add three entrys:
-        super(type(self), self).__setitem__(i.capitalize(), y.capitalize())  # Key = Value
-        super(type(self), self).__setitem__(string.upper(i), string.upper(y))  # KEY = VALUE
-        super(type(self), self).__setitem__(i, y)  # key = value
-
-    def sub(self, text):
-        """Translate text, returns the modified text."""
-        if self._regexIsDirty:
-            self._update_regex()
-        return self._regex.sub(self, text)
+        dict.__setitem__(self, i.capitalize(), y.capitalize())  # Key = Value
+        dict.__setitem__(self, string.upper(i), string.upper(y))  # KEY = VALUE
+        dict.__setitem__(self, i, y)  # key = value
 
 english_word_sub = WordSub(DEFAULT_ENGLISH_NORMAL)
 
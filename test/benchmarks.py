@@ -0,0 +1,766 @@
+#!/usr/bin/env python
+"""Micro benchmarks of the chatbot hot paths.
+
+Usage: python benchmarks.py <benchmark> [options]
+"""
+
+import argparse
+import glob
+import os
+import random
+import sys
+import time
+import logging
+from contextlib import contextmanager
+
+CWD = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(CWD, '..', 'src'))
+
+DEFAULT_AIML = [
+    os.path.join(CWD, 'characters', '*.aiml'),
+    os.path.join(CWD, '..', 'src', 'chatbot', 'aiml', 'self-test.aiml'),
+]
+
+BENCHMARKS = {}
+
+
+def benchmark(f):
+    BENCHMARKS[f.__name__] = f
+    return f
+
+
+def timeit(func, number):
+    start = time.time()
+    for _ in xrange(number):
+        func()
+    return time.time() - start
+
+
+def report(name, count, elapse):
+    print '{:<32} {:>10} in {:8.3f}s {:>12.1f}/s'.format(
+        name, count, elapse, count / elapse if elapse else float('inf'))
+
+
+def load_kernel(aiml_files):
+    from chatbot.aiml import Kernel
+    kernel = Kernel()
+    kernel.verbose(False)
+    for f in aiml_files:
+        kernel.learn(f)
+    return kernel
+
+
+def sample_questions(kernel, n, seed=0):
+    """Make questions from the learned patterns, filling the wildcards
+    with random words, plus some questions that match nothing."""
+    rnd = random.Random(seed)
+    templates = []
+    kernel._brain.get_templates(kernel._brain._root, templates)
+    patterns = [t[1]['pattern'] for t in templates]
+    words = [w for p in patterns for w in p.split() if w not in ('*', '_')]
+    questions = []
+    for _ in xrange(n):
+        if rnd.random() < 0.2:
+            question = [rnd.choice(words) for _ in xrange(rnd.randint(1, 12))]
+        else:
+            question = []
+            for w in rnd.choice(patterns).split():
+                if w in ('*', '_'):
+                    question.extend(rnd.choice(words)
+                                    for _ in xrange(rnd.randint(1, 4)))
+                else:
+                    question.append(w)
+        questions.append(' '.join(question))
+    return questions
+
+
+@benchmark
+def matcher(args):
+    """Matches/sec of the recursive and the compiled AIML matcher."""
+    kernel = load_kernel(args.aiml)
+    brain = kernel._brain
+    questions = sample_questions(kernel, args.number)
+    print '{} categories, {} questions'.format(
+        brain.numTemplates(), len(questions))
+
+    for compiled in [False, True]:
+        brain.setCompiled(compiled)
+        brain.match(u'warm up', u'', u'')
+        it = iter(questions * args.repeat)
+        elapse = timeit(lambda: brain.match(next(it), u'', u''),
+                        len(questions) * args.repeat)
+        report('compiled' if compiled else 'recursive',
+               len(questions) * args.repeat, elapse)
+
+
+@benchmark
+def session_locking(args):
+    """Responses/sec of concurrent sessions with the global respond lock
+    and with session locking."""
+    import threading
+    kernel = load_kernel(args.aiml)
+    questions = sample_questions(kernel, args.number)
+    kernel.respond('warm up')
+
+    def chat(sid):
+        for _ in xrange(args.repeat):
+            for question in questions:
+                kernel.respond(question, sid)
+
+    for locking in [False, True]:
+        kernel.sessionLocking(locking)
+        threads = [threading.Thread(target=chat, args=('s{}'.format(i),))
+                   for i in xrange(args.threads)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        report('session lock' if locking else 'global lock',
+               len(questions) * args.repeat * args.threads,
+               time.time() - start)
+
+
+@benchmark
+def wordsub(args):
+    """Substitutions/sec of the word subbers and of the regex alternation
+    they replace, on the DefaultSubs and the english_word_sub."""
+    import re
+    from chatbot.aiml import DefaultSubs
+    from chatbot.aiml.WordSub import WordSub
+    from chatbot.wordsub import english_word_sub, DEFAULT_ENGLISH_NORMAL
+    kernel = load_kernel(args.aiml)
+    rnd = random.Random(0)
+    # lowercase sentences, with a few of the keys in them
+    keys = DefaultSubs.defaultNormal.keys() + \
+        DefaultSubs.defaultPerson.keys()
+    questions = []
+    for question in sample_questions(kernel, args.number):
+        words = question.lower().split()
+        for _ in xrange(rnd.randint(0, 3)):
+            words.insert(rnd.randint(0, len(words)), rnd.choice(keys))
+        questions.append(unicode(' '.join(words)))
+
+    # a large subs file, like the ones loaded with Kernel.loadSubs()
+    merged = {}
+    for subs in [DefaultSubs.defaultNormal, DefaultSubs.defaultPerson,
+                 DefaultSubs.defaultGender, DEFAULT_ENGLISH_NORMAL]:
+        merged.update(subs)
+    merged.update(('{} {}'.format(a, b), '{} {}'.format(b, a))
+                  for a in keys[:20] for b in keys[-20:])
+
+    subbers = [('normal', WordSub(DefaultSubs.defaultNormal), 0),
+               ('person', WordSub(DefaultSubs.defaultPerson), 0),
+               ('gender', WordSub(DefaultSubs.defaultGender), 0),
+               ('english', english_word_sub, re.UNICODE),
+               ('large', WordSub(merged), 0)]
+    count = len(questions) * args.repeat
+    for name, subber, flags in subbers:
+        regex = re.compile('|'.join(
+            r'\b%s\b' % re.escape(k) for k in subber.keys()), flags)
+        it = iter(questions * args.repeat)
+        report('{} regex'.format(name), count, timeit(
+            lambda: regex.sub(lambda m: subber[m.group(0)], next(it)), count))
+        # bypass the cache
+        subber.sub(u'warm up')
+        it = iter(questions * args.repeat)
+        report('{} trie'.format(name), count,
+               timeit(lambda: subber._sub(next(it)), count))
+        # the same inputs over and over, like that and topic
+        it = iter(questions[:16] * (count / 16 + 1))
+        report('{} trie, cached'.format(name), count,
+               timeit(lambda: subber.sub(next(it)), count))
+
+
+@benchmark
+def startup(args):
+    """Loads/sec of an AIML character, parsing the AIML files and
+    restoring the brain snapshot."""
+    import shutil
+    import tempfile
+    from chatbot.server.brain_cache import BrainCache
+    from chatbot.server.character import AIMLCharacter
+    logging.getLogger('hr.chatbot').setLevel(logging.CRITICAL)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        brain_cache = BrainCache(cache_dir)
+
+        def load(cache):
+            character = AIMLCharacter('benchmark', 'benchmark')
+            character.kernel.verbose(False)
+            character.load_aiml_files(character.kernel, args.aiml, cache)
+            return character
+
+        print '{} categories'.format(load(None).kernel.numCategories())
+        report('parse', args.repeat,
+               timeit(lambda: load(None), args.repeat))
+        report('parse and save snapshot', 1,
+               timeit(lambda: load(brain_cache), 1))
+        report('restore snapshot', args.repeat,
+               timeit(lambda: load(brain_cache), args.repeat))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+@benchmark
+def parallel_load(args):
+    """Seconds to load a character set sequentially and with the AIML
+    files parsed in a process pool. Each character learns -n of the
+    AIML files."""
+    import shutil
+    import tempfile
+    import chatbot.server.loader as loader
+    logging.getLogger('hr.chatbot').setLevel(logging.CRITICAL)
+    # the load time breakdown
+    logging.getLogger('hr.chatbot.loader').setLevel(
+        logging.INFO if args.verbose else logging.CRITICAL)
+    loader.brain_cache = None
+    aiml_files = sorted(os.path.abspath(f) for pattern in args.aiml
+                        for f in glob.glob(pattern))
+    character_dir = tempfile.mkdtemp()
+    try:
+        size = max(1, args.number)
+        for i in xrange(0, len(aiml_files), size):
+            with open(os.path.join(
+                    character_dir, 'c{}.yaml'.format(i)), 'w') as f:
+                f.write('id: c{0}\nname: c{0}\naiml:\n'.format(i))
+                for aiml_file in aiml_files[i:i+size]:
+                    f.write('  - {}\n'.format(aiml_file))
+        print '{} AIML files, {} characters'.format(
+            len(aiml_files), len(os.listdir(character_dir)))
+        for workers in [0, args.threads]:
+            start = time.time()
+            loader.load_characters(character_dir, workers)
+            print '{:<32} {:8.3f}s'.format(
+                '{} workers'.format(workers), time.time() - start)
+    finally:
+        shutil.rmtree(character_dir)
+
+
+@benchmark
+def response_cache(args):
+    """Repeat checks/sec of a session's response cache as the session gets
+    longer. Each session answers -n questions of the AIML set."""
+    import datetime as dt
+    from chatbot.server.response_cache import ResponseCache
+    logging.getLogger('hr.chatbot').setLevel(logging.CRITICAL)
+    kernel = load_kernel(args.aiml)
+    questions = sample_questions(kernel, args.number)
+    answers = [kernel.respond(q) or q for q in questions]
+    now = dt.datetime.utcnow()
+    for length in [100, 1000, 10000, 100000]:
+        cache = ResponseCache()
+        for i in xrange(length):
+            cache.add({'Question': questions[i % len(questions)],
+                       'Answer': answers[i % len(answers)],
+                       'Datetime': now})
+        qas = zip(questions, answers) * args.repeat
+        it = iter(qas)
+        report('{} records'.format(length), len(qas),
+               timeit(lambda: cache.check(*next(it)), len(qas)))
+
+
+@benchmark
+def session_expiry(args):
+    """CPU seconds used in 5 seconds by the session cleaner, with 10000
+    idle sessions, polling the sessions every 0.1s and waiting for the
+    next expiry."""
+    import threading
+    import datetime as dt
+    import chatbot.server.session as session
+    logging.getLogger('hr.chatbot').setLevel(logging.CRITICAL)
+    session_manager = session.SessionManager(False)
+    for i in xrange(10000):
+        session_manager.start_session('benchmark', 'user{}'.format(i), True)
+
+    def polling():
+        # the cleaner loop the expiry heap replaces
+        while not stop.is_set():
+            since = dt.datetime.utcnow()
+            for s in session_manager.list_sessions():
+                if s.since_idle(since) > session.SESSION_REMOVE_TIMEOUT:
+                    session_manager.remove_session(s.sid)
+            time.sleep(0.1)
+
+    for name, target in [('polling', polling),
+                         ('expiry heap', session_manager._clean_sessions)]:
+        stop = threading.Event()
+        cleaner = threading.Thread(target=target)
+        cleaner.daemon = True
+        start = os.times()
+        cleaner.start()
+        time.sleep(5)
+        end = os.times()
+        stop.set()
+        if target is polling:
+            cleaner.join()
+        print '{:<32} {:8.3f}s CPU'.format(
+            name, end[0] + end[1] - start[0] - start[1])
+
+
+@benchmark
+def template(args):
+    """Renders/sec of the answer templates, compiling them every time and
+    with the compiled template cache."""
+    import jinja2
+    from jinja2 import meta
+    from chatbot.server.template import render
+    strings = [
+        '{{% set lineno = "file:{0}" %}}answer {0}'.format(i)
+        for i in xrange(20)] + [
+        '{{% if {0} > 10 %}} Big {{% else %}} Small {{% endif %}} '
+        '{{{{ {0} + 1 }}}}'.format(i)
+        for i in xrange(20)]
+
+    def compile_and_render(string):
+        # what render() did before the cache
+        t = jinja2.Template(string)
+        ast = jinja2.Environment().parse(string)
+        meta.find_undeclared_variables(ast)
+        return t.render()
+
+    count = len(strings) * args.repeat * 10
+    for name, func in [('compile', compile_and_render), ('cached', render)]:
+        it = iter(strings * args.repeat * 10)
+        report(name, count, timeit(lambda: func(next(it)), count))
+
+
+@benchmark
+def character_lookup(args):
+    """Responding character resolutions/sec with -n characters, scanning
+    the character list and with the character registry."""
+    from chatbot.server.character import Character
+    from chatbot.server.registry import CharacterRegistry
+    rnd = random.Random(0)
+    characters = []
+    for i in xrange(args.number):
+        c = Character('c{}'.format(i), 'bot{}'.format(i % 50),
+                      rnd.randint(0, 100))
+        c.languages = ['en']
+        characters.append(c)
+    generic = Character('generic', 'generic', 99)
+    generic.languages = ['en']
+    characters.append(generic)
+
+    def scan(botname, lang, user):
+        # the lookups of get_responding_characters the registry replaces
+        result = []
+        for c in characters:
+            if c.name == botname and lang in c.languages:
+                toks = c.id.split('/')
+                if len(toks) != 2 or toks[0] == user:
+                    result.append(c)
+        result = sorted(result, key=lambda x: x.level)
+        for c in characters:
+            if c.id == 'generic' and lang in c.languages:
+                if c not in result:
+                    result.append(c)
+                break
+        return sorted(result, key=lambda x: x.level)
+
+    registry = CharacterRegistry(characters)
+    count = 1000 * args.repeat
+    names = ['bot{}'.format(rnd.randint(0, 49)) for _ in xrange(count)]
+    for name, lookup in [('scan', scan),
+                         ('registry', registry.get_responding_characters)]:
+        it = iter(names)
+        report(name, count, timeit(lambda: lookup(next(it), 'en', 'user'),
+                                   count))
+
+
+SERVING_LOG_CONFIG = """
+[loggers]
+keys=root
+
+[handlers]
+keys=fileHandler
+
+[formatters]
+keys=
+
+[logger_root]
+level=WARN
+handlers=fileHandler
+
+[handler_fileHandler]
+class=logging.FileHandler
+args=(os.environ['ROS_LOG_FILENAME'], 'w')
+"""
+
+
+def _serving_client(job):
+    """Start a session and ask the questions, return the latencies"""
+    import json
+    import urllib
+    import urllib2
+    url, user, questions = job
+    query = {'Auth': os.environ.get('HR_CHATBOT_AUTHKEY', 'AAAAB3NzaC')}
+
+    def get(path, **kwargs):
+        kwargs.update(query)
+        return urllib2.urlopen('{}/{}?{}'.format(
+            url, path, urllib.urlencode(kwargs)), timeout=60).read()
+
+    sid = json.loads(get('start_session', botname='benchmark', user=user,
+                         client_id='benchmark'))['sid']
+    latencies = []
+    for question in questions:
+        start = time.time()
+        get('chat', question=question.encode('utf-8'), session=sid,
+            lang='en')
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def _serving_env(args, tmpdir):
+    """The environment of a server with one character, which learns the
+    AIML files"""
+    aiml_files = sorted(os.path.abspath(f) for pattern in args.aiml
+                        for f in glob.glob(pattern))
+    character_dir = os.path.join(tmpdir, 'characters')
+    os.makedirs(character_dir)
+    # sc sets the answer
+    with open(os.path.join(character_dir, 'benchmark.yaml'), 'w') as f:
+        f.write('id: sc\nname: benchmark\nlevel: 1\naiml:\n')
+        for aiml_file in aiml_files:
+            f.write('  - {}\n'.format(aiml_file))
+    # the warnings to a file, to keep the server's log out of the timing
+    log_config = os.path.join(tmpdir, 'logging.conf')
+    with open(log_config, 'w') as f:
+        f.write(SERVING_LOG_CONFIG)
+    env = dict(os.environ)
+    env['ROS_PYTHON_LOG_CONFIG_FILE'] = log_config
+    env['HR_CHARACTER_PATH'] = character_dir
+    env['CHATBOT_LOG_DIR'] = os.path.join(tmpdir, 'chatbot')
+    env['ROS_LOG_DIR'] = os.path.join(tmpdir, 'log')
+    return env
+
+
+@contextmanager
+def _server(env, tmpdir, workers):
+    """Run the server, and yield its URL when it's up"""
+    import signal
+    import socket
+    import subprocess
+    import urllib2
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    url = 'http://127.0.0.1:{}/v2.0'.format(port)
+    server = os.path.join(CWD, '..', 'scripts', 'run_server.py')
+    # the access log too
+    with open(os.path.join(tmpdir, 'server.log'), 'a') as log:
+        proc = subprocess.Popen(
+            [sys.executable, server, '-p', str(port), '-w', str(workers)],
+            env=env, stdout=log, stderr=log)
+    try:
+        for _ in xrange(600):
+            if proc.poll() is not None:
+                raise Exception("The server exited")
+            try:
+                urllib2.urlopen(url + '/ping', timeout=1).read()
+                break
+            except Exception:
+                time.sleep(0.1)
+        yield url
+    finally:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+            proc.wait()
+
+
+@benchmark
+def serving(args):
+    """Requests/sec and p99 latency of the server with 1 and -t worker
+    processes, under -t concurrent clients asking -n questions in total.
+    The server has one character, which learns the AIML files."""
+    import shutil
+    import tempfile
+    from multiprocessing import Pool
+    kernel = load_kernel(args.aiml)
+    questions = sample_questions(kernel, args.number)
+    tmpdir = tempfile.mkdtemp()
+    env = _serving_env(args, tmpdir)
+    pool = Pool(args.threads)
+    try:
+        for workers in [1, args.threads]:
+            with _server(env, tmpdir, workers) as url:
+                jobs = [(url, 'user{}'.format(i), questions[i::args.threads])
+                        for i in xrange(args.threads)]
+                start = time.time()
+                latencies = sorted(
+                    l for ls in pool.map(_serving_client, jobs) for l in ls)
+                elapse = time.time() - start
+            report('{} workers'.format(workers), len(latencies), elapse)
+            print '{:<32} p50 {:.3f}s p99 {:.3f}s'.format(
+                '', latencies[len(latencies) / 2],
+                latencies[int(len(latencies) * 0.99)])
+    finally:
+        pool.terminate()
+        shutil.rmtree(tmpdir)
+
+
+@benchmark
+def batch_chat(args):
+    """Questions/sec of -n questions asked one /chat request at a time,
+    in one /batch_chat request and in one streaming /batch_chat request,
+    and the seconds to the first streamed answer."""
+    import json
+    import shutil
+    import tempfile
+    import urllib
+    import urllib2
+    kernel = load_kernel(args.aiml)
+    questions = sample_questions(kernel, args.number)
+    tmpdir = tempfile.mkdtemp()
+    env = _serving_env(args, tmpdir)
+    auth = os.environ.get('HR_CHATBOT_AUTHKEY', 'AAAAB3NzaC')
+    try:
+        with _server(env, tmpdir, 1) as url:
+            sid = json.loads(urllib2.urlopen('{}/start_session?{}'.format(
+                url, urllib.urlencode({
+                    'Auth': auth, 'botname': 'benchmark',
+                    'user': 'benchmark'}))).read())['sid']
+            start = time.time()
+            _serving_client((url, 'benchmark', questions))
+            report('chat', len(questions), time.time() - start)
+
+            form = urllib.urlencode({
+                'Auth': auth, 'session': sid, 'lang': 'en',
+                'questions': json.dumps(list(enumerate(questions)))})
+            start = time.time()
+            response = json.loads(urllib2.urlopen(
+                url + '/batch_chat', form).read())
+            report('batch_chat', len(response['response']),
+                   time.time() - start)
+
+            start = time.time()
+            stream = urllib2.urlopen(url + '/batch_chat', form + '&stream=true')
+            first = None
+            count = 0
+            for line in stream:
+                if first is None:
+                    first = time.time() - start
+                json.loads(line)
+                count += 1
+            report('batch_chat stream', count, time.time() - start)
+            print '{:<32} first answer in {:.3f}s'.format('', first)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@benchmark
+def replay(args):
+    """Rows/sec of the replay of -n history rows, asking each question over
+    HTTP as the playback did, and with the in-process replay in 1 and -t
+    worker processes."""
+    import csv
+    import shutil
+    import tempfile
+    from chatbot.replay import Replay
+    from chatbot.server.character import AIMLCharacter
+    kernel = load_kernel(args.aiml)
+    questions = sample_questions(kernel, args.number)
+    tmpdir = tempfile.mkdtemp()
+    env = _serving_env(args, tmpdir)
+    history = os.path.join(tmpdir, 'history.csv')
+    with open(history, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Datetime', 'Question', 'BotName'])
+        for question in questions:
+            writer.writerow(['', question.encode('utf-8'), 'benchmark'])
+    try:
+        with _server(env, tmpdir, 1) as url:
+            start = time.time()
+            _serving_client((url, 'benchmark', questions))
+            report('http', len(questions), time.time() - start)
+
+        character = AIMLCharacter('sc', 'benchmark')
+        character.load_aiml_files(character.kernel, [
+            f for pattern in args.aiml for f in glob.glob(pattern)])
+        for workers in [1, args.threads]:
+            output = os.path.join(tmpdir, 'replay{}.csv'.format(workers))
+            start = time.time()
+            count = Replay([character], output, workers=workers).run(
+                [history])
+            report('replay {} workers'.format(workers), count,
+                   time.time() - start)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+
+def _read_history_csvs(files):
+    """The history records read from all the CSV files, as the stats did
+    before the history index"""
+    import pandas as pd
+    df = pd.concat([pd.read_csv(fname) for fname in files],
+                   ignore_index=True)
+    return df[df.Datetime != 'Datetime'].sort_values(
+        ['User', 'Datetime']).drop_duplicates()
+
+
+@benchmark
+def history_stats(args):
+    """Seconds per stats query of the last 7 days of 30 days of history,
+    -n sessions a day of -r records each: reading all the CSV files, and
+    reading the history index after building it and after a session is
+    added."""
+    import csv
+    import shutil
+    import tempfile
+    import datetime as dt
+    from chatbot.history_index import HistoryIndex
+    from chatbot.stats import history_files
+    header = ['Datetime', 'Revision', 'User', 'BotName', 'AnsweredBy',
+              'Question', 'Answer', 'Rate', 'Trace', 'Lang', 'Location',
+              'ServerIP', 'RequestId', 'Marker', 'RunID', 'Weight']
+    columns = ['Datetime', 'Revision', 'User', 'BotName', 'AnsweredBy',
+               'Question', 'Answer', 'Rate', 'Trace']
+    tmpdir = tempfile.mkdtemp()
+    today = dt.datetime.utcnow()
+
+    def write_session(day, i):
+        dirname = os.path.join(tmpdir, day.strftime('%Y%m%d'))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, '{}.csv'.format(i)), 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for j in xrange(args.repeat):
+                writer.writerow([str(day), 'rev', 'user{}'.format(i),
+                                 'benchmark', 'sc', 'question {}'.format(j),
+                                 'answer {}'.format(j), '', 'trace', 'en',
+                                 '', '', '', '', '', '1'])
+
+    try:
+        for d in xrange(30):
+            day = today - dt.timedelta(days=d)
+            for i in xrange(args.number):
+                write_session(day, '{}-{}'.format(d, i))
+        files = history_files(tmpdir, -1)
+        start = time.time()
+        _read_history_csvs(files)
+        report('read all csv files', len(files), time.time() - start)
+        start = time.time()
+        _read_history_csvs(history_files(tmpdir, 7))
+        report('read 7 days csv files', 1, time.time() - start)
+
+        index = HistoryIndex(tmpdir)
+        start = time.time()
+        count = index.update()
+        report('build index rows', count, time.time() - start)
+        start = time.time()
+        index.update()
+        index.read(7, columns)
+        report('index query', 1, time.time() - start)
+        write_session(today, 'new')
+        start = time.time()
+        index.update()
+        index.read(7, columns)
+        report('index query, session added', 1, time.time() - start)
+    finally:
+        shutil.rmtree(tmpdir)
+
+class _Bunch(dict):
+    """The dict with attributes the models were based on"""
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+
+def _chat_response(response_class, candidates):
+    """Build the response of a /chat request as the agent does, with the
+    candidate responses of the characters"""
+    response = response_class(
+        Datetime='2017-01-01 00:00:00.000000', Rate='', Lang='en-US',
+        Location='Hong Kong', ServerIP='127.0.0.1', RequestId='request',
+        Revision='revision')
+    response.ret = 0
+    response.responses = {}
+    response.trace = []
+    response.BotName = 'sophia'
+    response.User = 'user'
+    response.ClientId = 'client'
+    response.OriginalQuestion = 'what is your name'
+    response['yousaid'] = 'what is your name'
+    response['ModQuestion'] = 'what is your name'
+    response.Question = 'what is your name'
+    response.Marker = 'default'
+    response.RunId = ''
+    for i in xrange(candidates):
+        tier_response = {
+            'botid': 'bot{}'.format(i), 'botname': 'sophia',
+            'text': 'candidate answer {}'.format(i),
+            'trace': [['what is your name', 'aiml', 'WHAT IS YOUR NAME']],
+            'cweight': 50}
+        response.responses.setdefault('tier{}'.format(i % 4), []).append(
+            tier_response)
+        response.trace.append(['tier', i])
+    response.default_response = tier_response
+    response['OriginalAnswer'] = tier_response['text']
+    response['AnsweredBy'] = tier_response['botid']
+    return response
+
+
+@benchmark
+def chat_response(args):
+    """Builds and encodings/sec of a /chat response with -t candidates, on
+    the dict models and on the slot models, and the memory and the bytes
+    of the JSON of a response."""
+    import json
+    from chatbot.server.model import Response
+
+    def sizeof(response):
+        if isinstance(response, dict):
+            return sys.getsizeof(response)
+        return sys.getsizeof(response) + sys.getsizeof(response.extra)
+
+    models = [
+        ('dict', _Bunch, lambda r, verbose: json.dumps(r)),
+        ('slots', Response, lambda r, verbose: r.toJSON(verbose=verbose)),
+    ]
+    count = args.number * args.repeat
+    for name, response_class, encode in models:
+        build = lambda: _chat_response(response_class, args.threads)
+        for verbose in [True, False]:
+            if name == 'dict' and not verbose:
+                continue
+            label = '{} {}'.format(name, 'verbose' if verbose else 'compact')
+            report(label, count, timeit(
+                lambda: encode(build(), verbose), count))
+            response = build()
+            print '{:<32} {:>10} bytes {:>6} bytes of JSON'.format(
+                '', sizeof(response), len(encode(response, verbose)))
+
+
+def main():
+    parser = argparse.ArgumentParser('Chatbot benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument(
+        '--aiml', nargs='+', default=DEFAULT_AIML,
+        help='AIML files (globs) to load. Default: the test characters')
+    parser.add_argument(
+        '-n', '--number', type=int, default=1000,
+        help='Number of distinct inputs')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=5,
+        help='Number of passes over the inputs')
+    parser.add_argument(
+        '-t', '--threads', type=int, default=8,
+        help='Number of concurrent sessions, or worker processes')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true', help='Verbose output')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == '__main__':
+    main()
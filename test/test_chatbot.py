@@ -171,5 +171,1451 @@ class ChatbotTest(unittest.TestCase):
         self.assertTrue(words2num(None) is None)
         self.assertTrue(words2num("zero") == 0)
 
+    def test_compiled_matcher(self):
+        import random
+        from chatbot.aiml import Kernel
+        from chatbot.aiml.PatternMgr import PatternMgr
+        from chatbot.aiml.CompiledMatcher import CompiledMatcher
+
+        # wildcard heavy patterns, with and without that/topic
+        rnd = random.Random(0)
+        vocab = [u'A', u'B', u'C', u'NAMELESS', u'Nameless']
+        def words(n, bot=False):
+            seq = []
+            for _ in range(n):
+                r = rnd.random()
+                if r < 0.2:
+                    seq.append(u'*')
+                elif r < 0.35:
+                    seq.append(u'_')
+                elif bot and r < 0.4:
+                    seq.append(u'BOT_NAME')
+                else:
+                    seq.append(rnd.choice(vocab))
+            return u' '.join(seq)
+        for trial in range(100):
+            brain = PatternMgr()
+            for i in range(rnd.randint(1, 30)):
+                that = words(rnd.randint(1, 2)) if rnd.random() < 0.7 else u''
+                topic = words(rnd.randint(1, 2)) if rnd.random() < 0.6 else u''
+                brain.add((words(rnd.randint(1, 4), True), that, topic), [i])
+            matcher = CompiledMatcher(brain)
+            for _ in range(50):
+                inputs = [[rnd.choice(vocab) for _ in range(rnd.randint(0, n))]
+                          for n in (5, 3, 3)]
+                expected = brain._match(*(inputs + [brain._root]))
+                result = matcher.match(*inputs)
+                self.assertEqual(expected[1], result[1])
+                if expected[1] is not None:
+                    self.assertEqual(expected[0], result[0])
+
+        # the same responses on the self-test and the test characters
+        aiml_dir = os.path.join(self.cwd, '..', 'src', 'chatbot', 'aiml')
+        kernels = [Kernel(), Kernel()]
+        kernels[1].compiledMatching()
+        for k in kernels:
+            k.verbose(False)
+            k.learn(os.path.join(aiml_dir, 'self-test.aiml'))
+            k.learn(os.path.join(self.cwd, 'characters', '*.aiml'))
+            k.setPredicate('topic', 'Soylent Ham and Cheese')
+        for question in ['hello sophia', 'test star begin',
+                         'test star having multiple stars in a pattern makes me extremely happy',
+                         'test thatstar', 'test thatstar', 'test topicstar multiple',
+                         'test sr test srai', 'no such pattern']:
+            self.assertEqual(kernels[0].respond(question),
+                             kernels[1].respond(question))
+
+    def test_star_spans(self):
+        from chatbot.aiml import Kernel
+        k = Kernel()
+        k.verbose(False)
+        k.learn(os.path.join(
+            self.cwd, '..', 'src', 'chatbot', 'aiml', 'self-test.aiml'))
+        calls = []
+        _matchWords = k._brain._matchWords
+        def matchWords(*args):
+            calls.append(args)
+            return _matchWords(*args)
+        k._brain._matchWords = matchWords
+        question = 'test star having multiple stars in a pattern makes me extremely happy'
+        self.assertEqual(k.respond(question),
+            'Multiple stars matched: having, stars in a pattern, extremely happy')
+        self.assertEqual(len(calls), 1)
+
+        brain = k._brain
+        template, stars = brain.match(
+            u'TEST STAR A B MULTIPLE C MULTIPLE MAKES ME D', u'', u'', True)
+        self.assertEqual(stars['star'], [(2, 4), (5, 7), (9, 10)])
+        self.assertEqual(brain.match(u'no such pattern', u'', u'', True),
+                         (None, None))
+        for index, expected in enumerate(['A B', 'C MULTIPLE', 'D']):
+            self.assertEqual(expected, brain.star(
+                'star', u'TEST STAR A B MULTIPLE C MULTIPLE MAKES ME D',
+                u'', u'', index + 1))
+
+    def test_session_locking(self):
+        import threading
+        from chatbot.aiml import Kernel
+        k = Kernel()
+        k.verbose(False)
+        k.learn(os.path.join(
+            self.cwd, '..', 'src', 'chatbot', 'aiml', 'self-test.aiml'))
+        k.sessionLocking()
+
+        errors = []
+        def chat(sid):
+            try:
+                for i in range(50):
+                    word = '{}x{}'.format(sid, i)
+                    self.assertEqual(
+                        k.respond('test star end {}'.format(word), sid),
+                        'End star matched: {}'.format(word))
+                    self.assertIn('TEST STAR END *', k.getTraceDocs()[0])
+                    self.assertEqual(k.respond('test thatstar', sid),
+                                     'I say beans')
+                    self.assertEqual(k.respond('test thatstar', sid),
+                                     'I just said "beans"')
+                    self.assertEqual(k.respond('test id', sid, query=True),
+                                     'Your id is _query.{}'.format(sid))
+                    self.assertEqual(k.respond('test id', sid),
+                                     'Your id is {}'.format(sid))
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=chat, args=('s{}'.format(i),))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertFalse([s for s in k._sessions if s.startswith('_query')])
+        for i in range(8):
+            self.assertEqual(
+                k.getPredicate(k._outputHistory, 's{}'.format(i))[-1],
+                'Your id is s{}'.format(i))
+
+    def test_query_session_view(self):
+        from chatbot.aiml import Kernel
+        from chatbot.aiml.SessionView import SessionView
+        k = Kernel()
+        k.verbose(False)
+        k.learn(os.path.join(
+            self.cwd, '..', 'src', 'chatbot', 'aiml', 'self-test.aiml'))
+        k.setPredicate('food', 'bread', 'sid')
+        self.assertEqual(k.respond('test thatstar', 'sid'), 'I say beans')
+        history = k.getPredicate(k._outputHistory, 'sid')[:]
+
+        self.assertEqual(k.respond('test thatstar', 'sid', query=True),
+                         'I just said "beans"')
+        self.assertEqual(k.respond('test get and set', 'sid', query=True),
+                         'I like cheese. My favorite food is cheese')
+        self.assertEqual(k.getPredicate('food', 'sid'), 'bread')
+        self.assertEqual(k.getPredicate(k._outputHistory, 'sid'), history)
+        self.assertNotIn(k._querySessionID, k._sessions)
+
+        view = k.getSessionView('sid')
+        self.assertEqual(view['food'], 'bread')
+        self.assertEqual(dict(view), k.getSessionData('sid'))
+        self.assertRaises(TypeError, view.__setitem__, 'food', 'cake')
+        k.setPredicate('food', 'cake', 'sid')
+        self.assertEqual(view['food'], 'cake')
+
+        base = {'a': 1, 'l': [1]}
+        view = SessionView(base)
+        view['l'].append(2)
+        view['b'] = 2
+        del view['a']
+        self.assertEqual(dict(view), {'b': 2, 'l': [1, 2]})
+        self.assertEqual(base, {'a': 1, 'l': [1]})
+        self.assertNotIn('a', view)
+
+    def test_wordsub(self):
+        import random
+        import re
+        from chatbot.aiml import DefaultSubs
+        from chatbot.aiml.WordSub import WordSub
+        from chatbot.wordsub import english_word_sub
+
+        # same as the regex alternation where the keys don't overlap
+        rnd = random.Random(0)
+        for subs in [DefaultSubs.defaultNormal, DefaultSubs.defaultPerson,
+                     DefaultSubs.defaultPerson2, DefaultSubs.defaultGender]:
+            subber = WordSub(subs)
+            regex = re.compile('|'.join(
+                r'\b%s\b' % re.escape(k) for k in subber.keys()))
+            words = subber.keys() + ['hello', 'mE', ',', u'\xe9t\xe9']
+            for _ in range(500):
+                text = u''.join(rnd.choice([rnd.choice(words), ' ', ''])
+                                for _ in range(rnd.randint(0, 10)))
+                self.assertEqual(
+                    subber.sub(text),
+                    regex.sub(lambda m: subber[m.group(0)], text))
+
+        # the longest key wins
+        self.assertEqual(english_word_sub.sub(u"I'm'a go, I'm here"),
+                         u'I am about to go, I am here')
+        self.assertEqual(english_word_sub.sub(u"\xc9t\xe9 won't"),
+                         u'\xc9t\xe9 will not')
+
+        subber = WordSub({'he': 'she'})
+        self.assertEqual(subber.sub('He said'), 'She said')
+        self.assertEqual(subber.sub('He said'), 'She said')
+        self.assertEqual(len(subber._cache), 1)
+        subber['said'] = 'told'
+        self.assertEqual(subber.sub('He said'), 'She told')
+        self.assertIsInstance(subber.sub(u'He said'), unicode)
+
+    def test_brain_cache(self):
+        import shutil
+        import tempfile
+        from chatbot.server.brain_cache import BrainCache
+        from chatbot.server.character import AIMLCharacter
+        tmpdir = tempfile.mkdtemp()
+        try:
+            aiml_file = os.path.join(tmpdir, 'test.aiml')
+            shutil.copy(os.path.join(self.cwd, 'characters', 'sophia.aiml'),
+                        aiml_file)
+            brain_cache = BrainCache(os.path.join(tmpdir, 'cache'))
+
+            def load():
+                character = AIMLCharacter('sophia', 'sophia')
+                character.set_property_file(os.path.join(
+                    self.cwd, 'characters', 'sophia.properties'))
+                learned = []
+                learn = character.kernel.learn
+                def _learn(f):
+                    learned.append(f)
+                    return learn(f)
+                character.kernel.learn = _learn
+                errors = character.load_aiml_files(
+                    character.kernel, [aiml_file], brain_cache)
+                self.assertEqual(errors, [])
+                return character, learned
+
+            parsed, learned = load()
+            self.assertEqual(learned, [aiml_file])
+            restored, learned = load()
+            self.assertEqual(learned, [])
+            self.assertEqual(restored.aiml_files, [aiml_file])
+            self.assertEqual(restored.kernel.numCategories(),
+                             parsed.kernel.numCategories())
+            self.assertEqual(restored.kernel.respond('hello sophia'),
+                             'Hi there from sophia')
+
+            # any change of the sources invalidates the snapshot
+            with open(aiml_file) as f:
+                content = f.read()
+            with open(aiml_file, 'w') as f:
+                f.write(content.replace('Hi there from', 'Hello from'))
+            changed, learned = load()
+            self.assertEqual(learned, [aiml_file])
+            self.assertEqual(changed.kernel.respond('hello sophia'),
+                             'Hello from sophia')
+            self.assertEqual(len(os.listdir(brain_cache.cache_dir)), 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_brain_pool(self):
+        import shutil
+        import tempfile
+        from chatbot.server.brain_cache import BrainPool
+        from chatbot.server.character import AIMLCharacter
+        tmpdir = tempfile.mkdtemp()
+        try:
+            aiml_file = os.path.join(tmpdir, 'name.aiml')
+            with open(aiml_file, 'w') as f:
+                f.write('<aiml><category><pattern>HI <bot name="name"/>'
+                        '</pattern><template>Hi from <bot name="name"/>'
+                        '</template></category></aiml>')
+            generic = os.path.join(self.cwd, 'characters', 'generic.aiml')
+            brain_pool = BrainPool()
+
+            def load(name, aiml_files):
+                character = AIMLCharacter(name, name)
+                # bot names only match the uppercased input in upper case
+                character.kernel.setBotPredicate('name', name.upper())
+                learned = []
+                learn = character.kernel.learn
+                def _learn(f):
+                    learned.append(f)
+                    return learn(f)
+                character.kernel.learn = _learn
+                self.assertEqual(character.load_aiml_files(
+                    character.kernel, aiml_files, None, brain_pool), [])
+                return character, learned
+
+            sophia, learned = load('sophia', [aiml_file, generic])
+            self.assertEqual(learned, [aiml_file, generic])
+            han, learned = load('han', [aiml_file, generic])
+            self.assertEqual(learned, [])
+            self.assertIs(han.kernel._brain._root, sophia.kernel._brain._root)
+
+            # the bot names and the sessions are separate
+            han.kernel.compiledMatching()
+            for c in [han, sophia]:
+                name = c.name.upper()
+                self.assertEqual(c.kernel.respond('hi {}'.format(name), 'sid'),
+                                 'Hi from {}'.format(name))
+            self.assertEqual(han.kernel.respond('hi sophia', 'sid'), '')
+            self.assertEqual(sophia.kernel.respond('hi han', 'sid'), '')
+            self.assertEqual(len(han.kernel.getPredicate(
+                han.kernel._inputHistory, 'sid')), 2)
+
+            # a different set of files parses only the new ones
+            dummy, learned = load('dummy', [generic])
+            self.assertEqual(learned, [generic])
+            self.assertIsNot(dummy.kernel._brain._root,
+                             sophia.kernel._brain._root)
+            self.assertEqual(len(brain_pool.parsed), 2)
+            self.assertEqual(dummy.kernel.respond('hello sophia'),
+                             'Hi there from generic')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parallel_load(self):
+        import chatbot.server.loader as loader
+        character_path = os.environ.get('HR_CHARACTER_PATH')
+        brain_cache = loader.brain_cache
+        loader.brain_cache = None
+        try:
+            sequential = loader.load_characters(character_path, 0)
+            parallel = loader.load_characters(character_path, 2)
+        finally:
+            loader.brain_cache = brain_cache
+        self.assertEqual([c.name for c in sequential],
+                         [c.name for c in parallel])
+        for c1, c2 in zip(sequential, parallel):
+            if hasattr(c1, 'kernel'):
+                self.assertEqual(c1.kernel._brain._root,
+                                 c2.kernel._brain._root)
+                self.assertTrue(c1.kernel.numCategories() > 0)
+
+    def test_concurrent_tiers(self):
+        import shutil
+        import tempfile
+        import chatbot.server.chatbot_agent as agent
+        from chatbot.server.character import Character, AIMLCharacter
+        from chatbot.server.model import Request, Response
+
+        class SlowCharacter(Character):
+            def __init__(self, id, level, delay, text, lazy=False):
+                super(SlowCharacter, self).__init__(id, 'test', level)
+                self.delay = delay
+                self.text = text
+                self.lazy = lazy
+                self.asked = 0
+
+            def respond(self, question, lang, session, query, request_id):
+                self.asked += 1
+                time.sleep(self.delay)
+                return {'text': self.text, 'botid': self.id,
+                        'exact_match': True}
+
+        sid = agent.session_manager.start_session('test', 'concurrent')
+        session = agent.session_manager.get_session(sid)
+        session.session_context.botname = 'test'
+        request = Request()
+        request.sid = sid
+        request.question = 'hello'
+        request.lang = 'en'
+        tmpdir = tempfile.mkdtemp()
+
+        def ask(concurrent, characters):
+            agent.config['CONCURRENT_TIERS'] = concurrent
+            response = Response()
+            start = time.time()
+            agent._ask_characters(characters, request, response)
+            return response, time.time() - start
+
+        characters = [
+            # sc sets the answer, so the lazy tier is skipped
+            SlowCharacter('sc', 1, 0.3, 'answer a'),
+            SlowCharacter('b', 2, 0.3, 'answer b'),
+            SlowCharacter('c', 3, 0.3, 'answer c', lazy=True),
+        ]
+        try:
+            sequential, sequential_time = ask(False, characters)
+            concurrent, concurrent_time = ask(True, characters)
+
+            # merged in the same order, the lazy tier is not asked
+            self.assertEqual(
+                [r['text'] for r in sequential.get_default_responses()],
+                ['answer a', 'answer b'])
+            self.assertEqual(
+                [r['text'] for r in concurrent.get_default_responses()],
+                ['answer a', 'answer b'])
+            self.assertEqual(sequential.default_response['text'], 'answer a')
+            self.assertEqual(concurrent.default_response['text'], 'answer a')
+            self.assertEqual(characters[2].asked, 0)
+            self.assertTrue(sequential_time >= 0.6)
+            self.assertTrue(concurrent_time < 0.5)
+
+            # the late tier is ignored and traced
+            late = SlowCharacter('late', 1, 1, 'late answer')
+            late.timeout = 0.2
+            characters = [late, SlowCharacter('d', 2, 0, 'answer d')]
+            response, elapse = ask(True, characters)
+            self.assertTrue(elapse < 0.5)
+            self.assertEqual(
+                [r['text'] for r in response.get_default_responses()],
+                ['answer d'])
+            self.assertTrue(any(t[0] == 'late' and t[2].startswith('Timeout')
+                                for t in response.trace))
+
+            # the late AIML tier doesn't change the session, the next
+            # question doesn't match the answer that wasn't given
+            class SlowAIMLCharacter(AIMLCharacter):
+                def respond(self, question, *args, **kwargs):
+                    if 'slow' in question:
+                        time.sleep(0.5)
+                    return super(SlowAIMLCharacter, self).respond(
+                        question, *args, **kwargs)
+
+            aiml = SlowAIMLCharacter('aiml', 'test', 1)
+            aiml.timeout = 0.2
+            aiml_file = os.path.join(tmpdir, 'that.aiml')
+            with open(aiml_file, 'w') as f:
+                f.write("""<?xml version="1.0" encoding="ISO-8859-1"?>
+<aiml>
+<category><pattern>SLOW QUESTION</pattern><template>I am slow</template>
+</category>
+<category><pattern>FAST QUESTION</pattern><template>I am fast</template>
+</category>
+<category><pattern>YES</pattern><that>I AM SLOW</that>
+<template>that slow</template></category>
+<category><pattern>YES</pattern><that>I AM FAST</that>
+<template>that fast</template></category>
+<category><pattern>YES</pattern><template>plain yes</template></category>
+</aiml>""")
+            aiml.load_aiml_files(aiml.kernel, [aiml_file])
+            characters = [aiml, SlowCharacter('d', 2, 0, 'answer d')]
+
+            def answer(question):
+                request.question = question
+                response = ask(True, characters)[0]
+                return [r['text'] for r in response.get_default_responses()]
+
+            self.assertEqual(answer('slow question'), ['answer d'])
+            time.sleep(0.5)
+            self.assertEqual(answer('yes'), ['plain yes', 'answer d'])
+            self.assertEqual(answer('fast question'),
+                             ['I am fast', 'answer d'])
+            self.assertEqual(answer('yes'), ['that fast', 'answer d'])
+            # the copies of the session are dropped
+            self.assertEqual(
+                [s for s in aiml.kernel._sessions if '.tier' in s], [])
+        finally:
+            agent.config['CONCURRENT_TIERS'] = False
+            agent.session_manager.remove_session(sid)
+            shutil.rmtree(tmpdir)
+
+    def test_connectivity_monitor(self):
+        from chatbot.server import connectivity
+        from chatbot.server.character import respond_requires_internet
+        states = [False, False, False, True]
+        probes = []
+
+        def probe():
+            probes.append(time.time())
+            return states[min(len(probes), len(states)) - 1]
+
+        monitor = connectivity.ConnectivityMonitor(probe, 0.05, 0.15)
+        self.assertEqual(monitor.next_interval(), 0.05)
+        default_monitor = connectivity.monitor
+        connectivity.monitor = monitor
+        try:
+            @respond_requires_internet
+            def respond():
+                return {'text': 'online'}
+
+            # the first call probes once, the rest read the state
+            self.assertEqual(respond()['trace'], 'No Internet')
+            self.assertEqual(respond()['trace'], 'No Internet')
+            self.assertEqual(len(probes), 1)
+            self.assertEqual(monitor.skipped, 2)
+            self.assertEqual(monitor.next_interval(), 0.1)
+
+            # backs off while offline, up to the max interval
+            time.sleep(0.5)
+            self.assertEqual(respond()['text'], 'online')
+            self.assertEqual(monitor.next_interval(), 0.05)
+            self.assertTrue(probes[2] - probes[1] >= 0.15)
+            status = monitor.status()
+            self.assertTrue(status['online'])
+            self.assertIsNotNone(status['latency'])
+            self.assertEqual(status['failures'], 0)
+        finally:
+            monitor.stop()
+            connectivity.monitor = default_monitor
+
+    def test_response_cache(self):
+        import random
+        import datetime as dt
+        from chatbot.server.response_cache import ResponseCache
+        from chatbot.utils import norm
+
+        def linear_check(cache, question, answer):
+            # the record scans the indexes replace
+            same = [r for r in cache.record
+                    if norm(r['Answer']) == norm(answer)]
+            elapsed = (dt.datetime.utcnow() - same[-1]['Datetime']
+                       ).seconds if same else 0
+            if max(0, len(norm(answer)) - 10) * 30 <= elapsed:
+                return True
+            if norm(answer) == norm(cache.last_answer):
+                return False
+            if same:
+                return False
+            return norm(answer) not in [
+                norm(r['Answer']) for r in cache.record
+                if norm(r['Question']) == norm(question)]
+
+        rnd = random.Random(0)
+        answers = ['hi', 'hi  there', 'hi there [smile]', 'how are you',
+                   'I am a robot made by Hanson Robotics',
+                   'I am a robot made by  Hanson Robotics [happy]']
+        questions = ['hello', 'hi', 'who are you']
+        now = dt.datetime.utcnow()
+        cache = ResponseCache()
+        for i in xrange(200):
+            cache.add({
+                'Question': rnd.choice(questions),
+                'Answer': rnd.choice(answers),
+                'Datetime': now - dt.timedelta(seconds=rnd.randint(0, 600))})
+            if i % 50 == 0:
+                cache.update(-1, Feedback=rnd.choice(answers))
+            for answer in answers + ['something new to say']:
+                question = rnd.choice(questions)
+                self.assertEqual(cache.check(question, answer),
+                                 linear_check(cache, question, answer))
+                self.assertEqual(
+                    cache.is_unique(answer),
+                    all(norm(r['Answer']) != norm(answer)
+                        for r in cache.record))
+
+        cache.clean()
+        self.assertTrue(cache.check('hi', answers[-1]))
+        self.assertTrue(cache.is_unique(answers[-1]))
+
+    def test_response_cache_spill(self):
+        import csv
+        import shutil
+        import tempfile
+        import datetime as dt
+        from chatbot.server.response_cache import ResponseCache
+        from chatbot.server.history_writer import history_writer
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'history.csv')
+            cache = ResponseCache(max_records=10)
+            now = dt.datetime.utcnow()
+            long_answer = 'an answer that is too long to be repeated soon'
+            cache.add({'Question': 'q', 'Answer': long_answer,
+                       'Datetime': now})
+            cache.dump(fname)
+            for i in xrange(49):
+                cache.add({'Question': 'q{}'.format(i),
+                           'Answer': 'answer {}'.format(i % 20),
+                           'Datetime': now})
+                cache.dump(fname)
+            self.assertEqual(len(cache), 50)
+            self.assertEqual(len(cache.record), 10)
+            history_writer.flush()
+            with open(fname) as f:
+                self.assertEqual(len(list(csv.DictReader(f))), 50)
+
+            # the dropped records are still checked for repeats
+            self.assertFalse(cache.check('q', long_answer))
+            self.assertFalse(cache.is_unique('answer 0'))
+            self.assertTrue(cache.contain('q0', 'answer 0'))
+
+            # negative indexes count from the latest record
+            self.assertTrue(cache.rate('good', -1))
+            self.assertEqual(cache.record[-1]['Rate'], 'good')
+            self.assertTrue(cache.update(-10, Feedback='new answer'))
+            self.assertEqual(cache.record[0]['Answer'], 'new answer')
+            self.assertFalse(cache.is_unique('new answer'))
+            self.assertFalse(cache.rate('bad', -11))
+            self.assertFalse(cache.update(0, Rate='bad'))
+
+            # the memory doesn't grow with the same answers
+            usage = cache.memory_usage()
+            for i in xrange(500):
+                cache.add({'Question': 'q{}'.format(i % 20),
+                           'Answer': 'answer {}'.format(i % 20),
+                           'Datetime': now})
+            self.assertEqual(len(cache.record), 10)
+            self.assertTrue(cache.memory_usage() < usage * 1.5)
+
+            # capped by bytes, the test sessions that are never dumped
+            # drop the records
+            cache = ResponseCache(max_records=0, max_bytes=10000)
+            for i in xrange(500):
+                cache.add({'Question': 'q', 'Answer': 'answer {}'.format(i),
+                           'Datetime': now})
+            self.assertTrue(cache.bytes <= 10000)
+            self.assertTrue(0 < len(cache.record) < 500)
+            self.assertEqual(len(cache), 500)
+            self.assertEqual(cache.cursor, cache.offset)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_history_writer(self):
+        import csv
+        import glob
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        # writes the history of the sessions from several threads, and
+        # exits before the writer flushes them
+        script = """
+import sys, threading, datetime as dt
+from chatbot.server.response_cache import ResponseCache
+def chat(i):
+    cache = ResponseCache()
+    for j in xrange(200):
+        cache.add({'Question': 'q%d' % j, 'Answer': 'a%d' % j,
+                   'Datetime': dt.datetime.utcnow()})
+        cache.dump('%s/%d/history.csv' % (sys.argv[1], i % 5))
+threads = [threading.Thread(target=chat, args=(i,)) for i in xrange(10)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+"""
+        env = dict(os.environ)
+        env['HISTORY_FLUSH_SIZE'] = '100000'
+        env['HISTORY_FLUSH_INTERVAL'] = '3600'
+        env['PYTHONPATH'] = os.path.join(self.cwd, '..', 'src')
+        try:
+            subprocess.check_call(
+                [sys.executable, '-c', script, tmpdir], env=env)
+            fnames = glob.glob(os.path.join(tmpdir, '*/history.csv'))
+            self.assertEqual(len(fnames), 5)
+            for fname in fnames:
+                with open(fname) as f:
+                    # two sessions, each with a header
+                    rows = [r for r in csv.DictReader(f)
+                            if r['Question'] != 'Question']
+                self.assertEqual(len(rows), 400)
+                self.assertEqual(
+                    sorted(set((r['Question'], r['Answer']) for r in rows)),
+                    sorted(('q%d' % j, 'a%d' % j) for j in xrange(200)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_session_expiry(self):
+        import datetime as dt
+        import chatbot.server.session as session_module
+        from chatbot.server.session_store import MemorySessionStore
+        timeout = session_module.SESSION_REMOVE_TIMEOUT
+        session_module.SESSION_REMOVE_TIMEOUT = 0.5
+        try:
+            session_manager = session_module.SessionManager(True)
+            sids = [session_manager.start_session('test', 'user{}'.format(i),
+                                                  test=True)
+                    for i in xrange(3)]
+            active = session_manager.get_session(sids[0])
+            for _ in xrange(8):
+                time.sleep(0.1)
+                active.add({'Question': 'hi', 'Answer': 'hi there',
+                            'Datetime': dt.datetime.utcnow()})
+            # the idle sessions are removed, the active one is kept
+            self.assertTrue(session_manager.has_session(sids[0]))
+            self.assertFalse(session_manager.has_session(sids[1]))
+            self.assertFalse(session_manager.has_session(sids[2]))
+            time.sleep(0.7)
+            self.assertFalse(session_manager.has_session(sids[0]))
+            self.assertEqual(session_manager._expiry, [])
+
+            # the entries of the sessions that are only in the store are
+            # dropped, without loading them
+            session_manager = session_module.SessionManager(
+                False, store=MemorySessionStore())
+            session_manager.store.save('stored', {'not': 'a state'})
+            session_manager._push_expiry('stored')
+            session_manager._expiry[0] = (0, 'stored')
+            self.assertEqual(session_manager._pop_expired_sessions(),
+                             ([], 0))
+            self.assertEqual(session_manager.list_sessions(), [])
+        finally:
+            session_module.SESSION_REMOVE_TIMEOUT = timeout
+
+    def test_sharded_sessions(self):
+        import threading
+        from chatbot.server.session import SessionManager
+        session_manager = SessionManager(False, shards=4)
+        sids = [[] for _ in xrange(8)]
+
+        def start(i):
+            for j in xrange(50):
+                # the same user from every thread, and one of its own
+                sids[i].append(session_manager.start_session(
+                    'client', 'shared', test=True))
+                sids[i].append(session_manager.start_session(
+                    'client{}'.format(i % 3), 'user{}'.format(j), test=True))
+
+        threads = [threading.Thread(target=start, args=(i,))
+                   for i in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        shared = set(s for i in xrange(8) for s in sids[i][::2])
+        self.assertEqual(len(shared), 1)
+        own = set(s for i in xrange(8) for s in sids[i][1::2])
+        self.assertEqual(len(own), 150)
+        self.assertEqual(len(session_manager.list_sessions()), 151)
+        self.assertEqual(session_manager.get_sid('client1', 'user7'),
+                         sids[1][15])
+
+        sid = shared.pop()
+        session_manager.remove_session(sid)
+        self.assertIsNone(session_manager.get_session(sid))
+        self.assertIsNone(session_manager.get_sid('client', 'shared'))
+        new_sid = session_manager.start_session('client', 'shared')
+        self.assertNotEqual(new_sid, sid)
+        self.assertEqual(session_manager.start_session(
+            'client', 'shared', refresh=True) == new_sid, False)
+
+        # the session being answered is closed after the user shard is
+        # released
+        other = session_manager.start_session('client', 'other')
+        sid = session_manager.get_sid('client', 'shared')
+        session = session_manager.get_session(sid)
+        refreshed = []
+        found = []
+        refresh = threading.Thread(target=lambda: refreshed.append(
+            session_manager.start_session('client', 'shared', refresh=True)))
+        get_sids = threading.Thread(target=lambda: found.extend([
+            session_manager.get_sid('client', 'other'),
+            session_manager.get_sid('client', 'shared')]))
+        with session.lock:
+            refresh.start()
+            time.sleep(0.2)
+            get_sids.start()
+            get_sids.join(1)
+            self.assertEqual(len(found), 2)
+            self.assertEqual(found[0], other)
+            self.assertNotEqual(found[1], sid)
+            self.assertEqual(len(refreshed), 0)
+            self.assertFalse(session.closed)
+        refresh.join()
+        get_sids.join()
+        self.assertTrue(session.closed)
+        self.assertEqual(refreshed,
+                         [session_manager.get_sid('client', 'shared')])
+
+    def test_session_store(self):
+        import shutil
+        import tempfile
+        from chatbot.server.session_store import (
+            SqliteSessionStore, VersionConflict)
+        tmpdir = tempfile.mkdtemp()
+        # sc sets the answer
+        with open(os.path.join(tmpdir, 'generic.yaml'), 'w') as f:
+            f.write('id: sc\nname: generic\nlevel: 1\n'
+                    'aiml:\n    - generic.aiml\n')
+        with open(os.path.join(tmpdir, 'generic.aiml'), 'w') as f:
+            f.write("""<?xml version="1.0" encoding="ISO-8859-1"?>
+<aiml>
+<category><pattern>MY NAME IS *</pattern>
+<template><think><set name="name"><star/></set></think>Hi <star/></template>
+</category>
+<category><pattern>WHAT IS MY NAME</pattern>
+<template>Your name is <get name="name"/></template>
+</category>
+</aiml>""")
+        # a server process, that starts sessions and answers questions
+        # read from stdin
+        script = """
+import sys
+import chatbot.server.chatbot_agent as agent
+for line in iter(sys.stdin.readline, ''):
+    sid, text = line.rstrip('\\n').split('\\t')
+    if sid == 'start':
+        sid = agent.session_manager.start_session('test', text)
+        session = agent.session_manager.get_session(sid)
+        with agent.session_manager.transaction(session):
+            session.session_context.botname = 'generic'
+        print sid
+    elif sid == 'count':
+        session = agent.session_manager.get_session(text)
+        with agent.session_manager.transaction(session):
+            print len(session.cache)
+    else:
+        response = agent.ask(text, 'en', sid)
+        print response.default_response.get('text') if response.answered \\
+            else 'ret %s' % response.ret
+    sys.stdout.flush()
+"""
+        env = dict(os.environ)
+        env['HR_CHARACTER_PATH'] = tmpdir
+        env['CHATBOT_LOG_DIR'] = tmpdir
+        env['SESSION_STORE'] = 'sqlite:{}/sessions.db'.format(tmpdir)
+        env['PYTHONPATH'] = os.path.join(self.cwd, '..', 'src')
+        workers = [subprocess.Popen(
+            [sys.executable, '-c', script], env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE) for _ in xrange(2)]
+
+        def call(worker, sid, text):
+            worker.stdin.write('{}\t{}\n'.format(sid, text))
+            worker.stdin.flush()
+            return worker.stdout.readline().strip()
+
+        try:
+            # a save from a stale version is refused
+            store = SqliteSessionStore(os.path.join(tmpdir, 'versions.db'))
+            self.assertEqual(store.save('sid', {}), 1)
+            self.assertEqual(store.save('sid', {}, 1), 2)
+            self.assertRaises(VersionConflict, store.save, 'sid', {}, 1)
+
+            a, b = workers
+            sid = call(a, 'start', 'alice')
+            self.assertEqual(call(b, 'start', 'alice'), sid)
+            self.assertEqual(call(a, sid, 'my name is alice'), 'Hi alice')
+            # b loads the session from the store
+            self.assertEqual(call(b, sid, 'what is my name'),
+                             'Your name is alice')
+            self.assertEqual(call(b, sid, 'my name is bob'), 'Hi bob')
+            # a refreshes its stale copy
+            self.assertEqual(call(a, sid, 'what is my name'),
+                             'Your name is bob')
+            self.assertEqual(call(a, sid, 'my name is carol'), 'Hi carol')
+            self.assertEqual(call(b, sid, 'what is my name'),
+                             'Your name is carol')
+            # the other users get their own sessions
+            other = call(b, 'start', 'dave')
+            self.assertNotEqual(other, sid)
+            self.assertEqual(call(a, other, 'what is my name'),
+                             'Your name is')
+
+            # both answer the session at the same time, and keep all the
+            # records
+            count = int(call(a, 'count', sid))
+            for i in xrange(20):
+                for worker in workers:
+                    worker.stdin.write('{}\tmy name is {}\n'.format(sid, i))
+                    worker.stdin.flush()
+            for worker in workers:
+                for i in xrange(20):
+                    self.assertEqual(worker.stdout.readline().strip(),
+                                     'Hi {}'.format(i))
+            self.assertEqual(int(call(b, 'count', sid)), count + 40)
+            self.assertEqual(int(call(a, 'count', sid)), count + 40)
+        finally:
+            for worker in workers:
+                worker.stdin.close()
+                worker.wait()
+            shutil.rmtree(tmpdir)
+
+    def test_prefork_server(self):
+        import socket
+        import threading
+        import urllib2
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        # answers with the pid of the worker, after the given delay
+        script = """
+import os, sys, time
+from chatbot.server.prefork import PreforkServer
+def app(environ, start_response):
+    time.sleep(float(environ['QUERY_STRING'] or 0))
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+PreforkServer(app, '127.0.0.1', int(sys.argv[1]), 2,
+              graceful_timeout=5).run()
+"""
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.join(self.cwd, '..', 'src')
+        proc = subprocess.Popen(
+            [sys.executable, '-c', script, str(port)], env=env)
+        url = 'http://127.0.0.1:{}/'.format(port)
+
+        def get(delay=0):
+            return int(urllib2.urlopen(
+                '{}?{}'.format(url, delay), timeout=10).read())
+
+        def alive(pid):
+            try:
+                os.kill(pid, 0)
+                return True
+            except OSError:
+                return False
+
+        try:
+            for _ in xrange(100):
+                try:
+                    get()
+                    break
+                except Exception:
+                    time.sleep(0.1)
+            old = set(get() for _ in xrange(10))
+            self.assertTrue(1 <= len(old) <= 2)
+            self.assertNotIn(proc.pid, old)
+
+            # the old workers finish their requests when they are replaced
+            slow = []
+            t = threading.Thread(target=lambda: slow.append(get(1)))
+            t.start()
+            time.sleep(0.3)
+            proc.send_signal(signal.SIGHUP)
+            t.join()
+            self.assertEqual(len(slow), 1)
+            self.assertIn(slow[0], old)
+            deadline = time.time() + 10
+            while time.time() < deadline and any(alive(p) for p in old):
+                time.sleep(0.1)
+            self.assertFalse(any(alive(p) for p in old))
+            new = set(get() for _ in xrange(10))
+            self.assertFalse(new & old)
+
+            proc.send_signal(signal.SIGTERM)
+            deadline = time.time() + 10
+            while time.time() < deadline and proc.poll() is None:
+                time.sleep(0.1)
+            self.assertEqual(proc.poll(), 0)
+            self.assertFalse(any(alive(p) for p in new))
+
+            # the workers stop when the master is killed
+            proc = subprocess.Popen(
+                [sys.executable, '-c', script, str(port)], env=env)
+            for _ in xrange(100):
+                try:
+                    get()
+                    break
+                except Exception:
+                    time.sleep(0.1)
+            workers = set(get() for _ in xrange(10))
+            proc.kill()
+            proc.wait()
+            deadline = time.time() + 10
+            while time.time() < deadline and any(alive(p) for p in workers):
+                time.sleep(0.1)
+            self.assertFalse(any(alive(p) for p in workers))
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+
+    def test_character_registry(self):
+        import random
+        from chatbot.server.character import Character
+        from chatbot.server.registry import CharacterRegistry
+        rnd = random.Random(0)
+        characters = []
+        for i in xrange(200):
+            id = 'c{}'.format(i)
+            if rnd.random() < 0.3:
+                id = 'user{}/{}'.format(rnd.randint(0, 3), id)
+            c = Character(id, 'bot{}'.format(rnd.randint(0, 5)),
+                          rnd.randint(0, 100))
+            c.languages = rnd.sample(['en', 'zh', 'en-US'], rnd.randint(1, 2))
+            c.local = rnd.random() < 0.8
+            characters.append(c)
+        generic = Character('generic', 'generic', 99)
+        generic.languages = ['en']
+        characters.append(generic)
+
+        # the linear scans the registry replaces
+        def by_name(characters, name, local, lang, user):
+            result = []
+            for c in characters:
+                if c.name != name or (local and not c.local) or \
+                        (lang is not None and lang not in c.languages):
+                    continue
+                toks = c.id.split('/')
+                if user is None or len(toks) != 2 or toks[0] == user:
+                    result.append(c)
+            return result
+
+        def responding(characters, botname, lang, user):
+            result = sorted(by_name(characters, botname, False, lang, user),
+                            key=lambda x: x.level)
+            if lang in generic.languages and generic not in result:
+                result.append(generic)
+            return sorted(result, key=lambda x: x.level)
+
+        registry = CharacterRegistry(characters)
+        self.assertEqual(len(registry), len(characters))
+        self.assertIs(registry.get('generic', 'en'), generic)
+        self.assertIsNone(registry.get('generic', 'zh'))
+        self.assertIsNone(registry.get('generic', ns='bot0'))
+        self.assertEqual(registry.get_by_namespace('user1'),
+                         [c for c in characters if c.id.startswith('user1/')])
+        queries = [('bot{}'.format(b), lang, user)
+                   for b in xrange(7) for lang in [None, 'en', 'zh']
+                   for user in [None, 'user1', 'user2']]
+        for name, lang, user in queries:
+            for local in [True, False]:
+                self.assertEqual(
+                    registry.get_by_name(name, local, lang, user),
+                    by_name(characters, name, local, lang, user))
+            if lang is None:
+                continue
+            found, shared = registry.get_responding_characters(
+                name, lang, user)
+            self.assertEqual(list(found),
+                             responding(characters, name, lang, user))
+            self.assertEqual(shared, generic if lang == 'en' else None)
+            # cached
+            self.assertIs(registry.get_responding_characters(
+                name, lang, user)[0], found)
+
+        # the cache is dropped when the characters change
+        found, _ = registry.get_responding_characters('bot1', 'en', None)
+        new = Character('new', 'bot1', 0)
+        new.languages = ['en']
+        self.assertTrue(registry.add(new))
+        self.assertFalse(registry.add(Character('new', 'bot1', 0)))
+        self.assertEqual(
+            list(registry.get_responding_characters('bot1', 'en', None)[0]),
+            [new] + list(found))
+        registry.set([new])
+        self.assertEqual(
+            registry.get_responding_characters('bot1', 'en', None),
+            ((new,), None))
+        self.assertIsNone(registry.get('generic'))
+
+    def test_context_refresh(self):
+        import chatbot.server.session as session_module
+        from chatbot.server.character import AIMLCharacter
+        character = AIMLCharacter('aiml', 'test')
+        character.set_properties({'weather': 'sunny', 'location': 'here'})
+        kernel = character.kernel
+        clock_context = session_module._clock_context
+        clock = {'minute': 0}
+        session_module._clock_context = lambda now: (clock['minute'], {
+            'time': '10:0{} AM'.format(clock['minute']),
+            'date': 'January 01 2018'})
+        try:
+            session = session_module.Session('context')
+            session.set_characters([character])
+            self.assertEqual(
+                kernel.getPredicate('weather', 'context'), 'sunny')
+            self.assertEqual(
+                kernel.getPredicate('time', 'context'), '10:00 AM')
+            self.assertEqual(session.predicate_writes, 4)
+            self.assertEqual(session.predicate_writes_avoided, 0)
+
+            # the same characters within the same minute are left as they
+            # are
+            character.set_properties({'weather': 'rainy'})
+            kernel.setPredicate('location', 'there', 'context')
+            session.set_characters([character])
+            self.assertEqual(
+                kernel.getPredicate('weather', 'context'), 'sunny')
+            self.assertEqual(session.predicate_writes, 4)
+            self.assertEqual(session.predicate_writes_avoided, 0)
+
+            # only the changes are set, including the ones made by others
+            clock['minute'] = 1
+            session.set_characters([character])
+            self.assertEqual(
+                kernel.getPredicate('weather', 'context'), 'rainy')
+            self.assertEqual(
+                kernel.getPredicate('location', 'context'), 'here')
+            self.assertEqual(
+                kernel.getPredicate('time', 'context'), '10:01 AM')
+            self.assertEqual(session.predicate_writes, 7)
+            self.assertEqual(session.predicate_writes_avoided, 1)
+
+            # the context is set again after a reset
+            session.reset()
+            session.set_characters([character])
+            self.assertEqual(
+                kernel.getPredicate('weather', 'context'), 'rainy')
+            self.assertEqual(session.predicate_writes, 11)
+        finally:
+            session_module._clock_context = clock_context
+        now = session_module.dt.datetime(2018, 1, 1, 10, 0, 30)
+        self.assertEqual(clock_context(now), (
+            session_module.dt.datetime(2018, 1, 1, 10, 0),
+            {'time': '10:00 AM', 'date': 'January 01 2018'}))
+
+        # the private keys aren't predicates, and the name follows the
+        # first name
+        self.assertEqual(character.update_context(
+            session, {'firstname': 'Bob', '_private': 1}), 1)
+        self.assertEqual(kernel.getPredicate('name', 'context'), 'Bob')
+        kernel.setPredicate('name', 'Tom', 'context')
+        self.assertEqual(character.update_context(
+            session, {'firstname': 'Bob', '_private': 1}), 1)
+        self.assertEqual(kernel.getPredicate('name', 'context'), 'Bob')
+        self.assertEqual(character.update_context(
+            session, {'firstname': 'Bob', '_private': 1}), 0)
+
+    def test_template_cache(self):
+        import jinja2
+        from chatbot.server.template import (
+            TemplateCache, render, render_template, template_cache)
+        strings = [
+            'aa {% set lineno = "file:123" %}{% set lineno2 = "x" %}',
+            '{% if 3 > 2 %} Yes {% else %} No {% endif %}',
+            '{{ 1 + 2 }} apples',
+        ]
+        template_cache.clear()
+        hits, misses = template_cache.hits, template_cache.misses
+        for _ in xrange(3):
+            for string in strings:
+                self.assertEqual(render(string)['render_result'],
+                                 jinja2.Template(string).render())
+        self.assertEqual(template_cache.misses - misses, 3)
+        self.assertEqual(template_cache.hits - hits, 6)
+        self.assertEqual(render(strings[0])['variables'],
+                         {'lineno': 'file:123', 'lineno2': 'x'})
+        # the variables can be changed by the caller
+        render(strings[0])['variables'].clear()
+        self.assertEqual(len(render(strings[0])['variables']), 2)
+        self.assertEqual(render_template(strings[2]), '3 apples')
+
+        cache = TemplateCache(2)
+        first = cache.get(strings[0])
+        cache.get(strings[1])
+        self.assertIs(cache.get(strings[0]), first)
+        cache.get(strings[2])
+        self.assertEqual(cache.templates.keys(), [strings[0], strings[2]])
+        self.assertIsNot(cache.get(strings[1]), None)
+        self.assertEqual(cache.misses, 4)
+
+    def test_lazy_rendering(self):
+        import json
+        import chatbot.server.model as model
+        rendered = []
+        render_template = model.render_template
+
+        def counting_render_template(text):
+            rendered.append(text)
+            return render_template(text)
+
+        model.render_template = counting_render_template
+        try:
+            response = model.Response()
+            candidates = [{'text': '{{ %d + 1 }} apples' % i, 'botid': i}
+                          for i in xrange(3)]
+            response.add_response('gambit', candidates[0])
+            response.add_default_response(candidates[1])
+            response.add_response('quibble', candidates[2])
+            self.assertEqual(rendered, [])
+            self.assertEqual(candidates[0]['text'], '{{ 0 + 1 }} apples')
+
+            response.set_default_response(candidates[1])
+            response.set_default_response(candidates[1])
+            self.assertEqual(rendered, ['{{ 1 + 1 }} apples'])
+            self.assertEqual(response.default_response['text'], '2 apples')
+            self.assertEqual(response.default_response['orig_text'],
+                             '{{ 1 + 1 }} apples')
+
+            # the candidates are rendered only for the verbose JSON
+            self.assertNotIn('responses', response.to_dict(verbose=False))
+            self.assertEqual(rendered, ['{{ 1 + 1 }} apples'])
+            data = json.loads(response.toJSON(verbose=True))
+            self.assertEqual(
+                [r['text'] for r in data['responses']['gambit']],
+                ['1 apples'])
+            self.assertEqual(
+                [r['text'] for r in data['responses']['quibble']],
+                ['3 apples'])
+            self.assertEqual(len(rendered), 3)
+            response.toJSON(verbose=True)
+            self.assertEqual(len(rendered), 3)
+
+            response.strip_candidates()
+            self.assertNotIn('text', candidates[0])
+            self.assertNotIn('text', candidates[2])
+            self.assertEqual(candidates[2]['botid'], 2)
+            self.assertEqual(response.default_response['text'], '2 apples')
+        finally:
+            model.render_template = render_template
+
+    def test_response_model(self):
+        import json
+        from chatbot.server.model import Response, TierResponse
+        response = Response(Lang='en-US', RequestId='request')
+        self.assertFalse(hasattr(response, '__dict__'))
+        response.BotName = 'sophia'
+        response['yousaid'] = 'hello'
+        response.update({'text': 'command', 'ret': 0})
+        self.assertEqual(response['BotName'], 'sophia')
+        self.assertEqual(response.get('text'), 'command')
+        self.assertIn('text', response)
+        self.assertNotIn('User', response)
+        self.assertIsNone(response.get('User'))
+        self.assertRaises(KeyError, lambda: response['User'])
+        self.assertRaises(AttributeError, lambda: response.User)
+
+        response.add_response('gambit', {'text': 'candidate'})
+        response.set_default_response(TierResponse(botid='sc', text='hi'))
+        response.add_trace(['trace'])
+        verbose = json.loads(response.toJSON())
+        self.assertEqual(verbose['responses']['gambit'][0]['text'],
+                         'candidate')
+        self.assertEqual(verbose['trace'], [['trace']])
+        self.assertEqual(verbose['default_response']['botid'], 'sc')
+        self.assertEqual(verbose['text'], 'command')
+        self.assertNotIn('User', verbose)
+        compact = json.loads(response.toJSON(verbose=False))
+        self.assertNotIn('responses', compact)
+        self.assertNotIn('trace', compact)
+        verbose.pop('responses')
+        verbose.pop('trace')
+        self.assertEqual(compact, verbose)
+
+    def test_batch_chat(self):
+        import threading
+        import chatbot.server.chatbot_agent as agent
+        from chatbot.server.character import Character
+        from chatbot.server.registry import CharacterRegistry
+
+        class EchoCharacter(Character):
+            def __init__(self):
+                super(EchoCharacter, self).__init__('sc', 'batch', 1)
+                self.states = {}
+                self.asked = []
+                self.lock = threading.Lock()
+
+            def get_session_state(self, session):
+                return self.states.get(session.sid)
+
+            def set_session_state(self, session, state):
+                self.states[session.sid] = state
+
+            def respond(self, question, lang, session, query, request_id):
+                with self.lock:
+                    self.asked.append(
+                        (session.sid, query, self.states.get(session.sid)))
+                time.sleep(0.2)
+                return {'text': question.upper(), 'botid': self.id,
+                        'exact_match': True}
+
+        character = EchoCharacter()
+        characters = agent.CHARACTERS
+        agent.CHARACTERS = CharacterRegistry([character])
+        sid = agent.session_manager.start_session('test', 'batch')
+        session = agent.session_manager.get_session(sid)
+        session.session_context.botname = 'batch'
+        character.states[sid] = 'state'
+        workers = agent.config['BATCH_WORKERS']
+        agent.config['BATCH_WORKERS'] = 4
+        try:
+            questions = ['question {}'.format(i) for i in xrange(8)]
+            start = time.time()
+            results = list(agent.ask_batch(questions, 'en-US', sid))
+            elapse = time.time() - start
+            self.assertTrue(elapse < 1.2)
+            self.assertEqual(sorted(i for i, _ in results), range(8))
+            for i, response in results:
+                self.assertEqual(response.ret, 0)
+                self.assertEqual(response.default_response['text'],
+                                 questions[i].upper())
+            # asked as queries on the copies of the session
+            batch_sids = set(a[0] for a in character.asked)
+            self.assertEqual(len(batch_sids), 4)
+            self.assertNotIn(sid, batch_sids)
+            self.assertTrue(all(a[1] and a[2] == 'state'
+                                for a in character.asked))
+            for batch_sid in batch_sids:
+                self.assertIsNone(
+                    agent.session_manager.get_session(batch_sid))
+            # the records are added to the session
+            self.assertEqual(len(session.cache), 8)
+
+            # the session isn't locked while the responses are read, and
+            # the records are added when the batch is done
+            results = agent.ask_batch(questions, 'en-US', sid)
+            next(results)
+            locked = []
+
+            def lock():
+                locked.append(session.lock.acquire(False))
+                if locked[0]:
+                    session.lock.release()
+            thread = threading.Thread(target=lock)
+            thread.start()
+            thread.join()
+            self.assertEqual(locked, [True])
+            self.assertEqual(len(session.cache), 8)
+            list(results)
+            self.assertEqual(len(session.cache), 16)
+
+            # the questions left are skipped if the caller stops
+            del character.asked[:]
+            results = agent.ask_batch(questions * 4, 'en-US', sid)
+            next(results)
+            results.close()
+            self.assertTrue(len(character.asked) < 32)
+        finally:
+            agent.config['BATCH_WORKERS'] = workers
+            agent.CHARACTERS = characters
+            agent.session_manager.remove_session(sid)
+
+    def test_history_replay(self):
+        import csv
+        import shutil
+        import tempfile
+        import datetime as dt
+        import chatbot.replay as replay
+        from chatbot.server.character import AIMLCharacter
+        from chatbot.stats import history_files
+        character = AIMLCharacter('sc', 'replay')
+        character.load_aiml_files(character.kernel, [
+            os.path.join(self.cwd, '..', 'src', 'chatbot', 'aiml',
+                         'self-test.aiml')])
+        tmpdir = tempfile.mkdtemp()
+        day = os.path.join(tmpdir, dt.datetime.utcnow().strftime('%Y%m%d'))
+        os.makedirs(day)
+        questions = ['test bot', 'test srai', 'no match', 'test size',
+                     'test star a middle']
+        for i, fname in enumerate(['a.csv', 'b.csv']):
+            with open(os.path.join(day, fname), 'w') as f:
+                writer = csv.writer(f)
+                for question in questions:
+                    # the header is written again by the appends
+                    writer.writerow(['Datetime', 'Question', 'BotName'])
+                    writer.writerow(['2018-01-0{}'.format(i + 1), question,
+                                     'replay'])
+        files = history_files(tmpdir, 1)
+        self.assertEqual(len(files), 2)
+        output = os.path.join(tmpdir, 'replay.csv')
+
+        def read_output():
+            with open(output) as f:
+                return [(row['Offset'], row['Question'], row['Pattern'])
+                        for row in csv.DictReader(f)]
+
+        replay_row = replay.replay_row
+        try:
+            self.assertEqual(replay.Replay(
+                [character], output, workers=1, chunk_size=3).run(files), 10)
+            rows = read_output()
+            self.assertEqual(rows[:5], [
+                ('0', 'test bot', 'TEST BOT'),
+                ('1', 'test srai', 'TEST SRAI'),
+                ('1', 'test srai', 'SRAI TARGET'),
+                ('2', 'no match', ''),
+                ('3', 'test size', 'TEST SIZE')])
+            self.assertEqual(rows[6:], [(str(int(o) + 5), q, p)
+                                        for o, q, p in rows[:6]])
+
+            # stopped in the second chunk, and resumed
+            os.remove(output)
+
+            def failing_replay_row(registry, row):
+                if row['Question'] == 'test size':
+                    raise Exception('stopped')
+                return replay_row(registry, row)
+            replay.replay_row = failing_replay_row
+            self.assertRaises(Exception, replay.Replay(
+                [character], output, workers=1, chunk_size=3).run, files)
+            replay.replay_row = replay_row
+            self.assertEqual(replay.Replay(
+                [character], output, workers=1, chunk_size=3).run(files), 7)
+            self.assertEqual(read_output(), rows)
+
+            # in the worker processes
+            os.remove(output)
+            self.assertEqual(replay.Replay(
+                [character], output, workers=2, chunk_size=3).run(files), 10)
+            self.assertEqual(read_output(), rows)
+        finally:
+            replay.replay_row = replay_row
+            shutil.rmtree(tmpdir)
+
+    def test_history_index(self):
+        import csv
+        import json
+        import shutil
+        import tempfile
+        import datetime as dt
+        from chatbot.history_index import HistoryIndex
+        from chatbot.server.character import AIMLCharacter
+        from chatbot.stats import history_stats, pattern_stats
+        header = ['Datetime', 'User', 'BotName', 'Question', 'Answer',
+                  'Rate', 'Lang']
+        now = dt.datetime.utcnow()
+        tmpdir = tempfile.mkdtemp()
+
+        def write(day, fname, rows, write_header=True):
+            dirname = os.path.join(tmpdir, day.strftime('%Y%m%d'))
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(os.path.join(dirname, fname), 'a') as f:
+                writer = csv.DictWriter(f, header)
+                if write_header:
+                    writer.writeheader()
+                writer.writerows(rows)
+            return os.path.join(dirname, fname)
+
+        def row(question, rate='', user='user'):
+            return {'Datetime': str(now), 'User': user, 'BotName': 'index',
+                    'Question': question, 'Answer': 'answer', 'Rate': rate,
+                    'Lang': 'en'}
+
+        old = write(now - dt.timedelta(days=10), 'old.csv',
+                    [row('test bot')])
+        a = write(now, 'a.csv', [row('test bot', 'good'), row('test srai')])
+        # the header is written again by the appends
+        write(now, 'a.csv', [row('no match', 'bad')])
+        b = write(now, 'b.csv', [row('test bot', user='other')])
+        index = HistoryIndex(tmpdir)
+        try:
+            self.assertEqual(history_stats(tmpdir, 7), {
+                'customers_satisfaction_degree': 0.75,
+                'number_of_records': 4,
+                'number_of_rates': 2,
+                'number_of_good_rates': 1,
+                'number_of_bad_rates': 1,
+            })
+            with open(os.path.join(tmpdir, 'last_7_days.csv')) as f:
+                self.assertEqual(len(list(csv.DictReader(f))), 4)
+            self.assertEqual(history_stats(tmpdir, -1)['number_of_records'],
+                             5)
+            with open(index.manifest) as f:
+                offsets = json.load(f)['files']
+            self.assertEqual(sorted(offsets.values()), sorted(
+                os.path.getsize(fname) for fname in [old, a, b]))
+
+            # only the rows appended since, and only the complete ones
+            self.assertEqual(index.update(), 0)
+            write(now, 'a.csv', [row('test size')], False)
+            with open(a, 'a') as f:
+                f.write('{},user,index,test star'.format(now))
+            self.assertEqual(index.update(), 1)
+            with open(a, 'a') as f:
+                f.write(' a middle,answer,,en\r\n')
+            self.assertEqual(index.update(), 1)
+            df = index.read(7, ['Question', 'Rate', 'Trace'])
+            self.assertEqual(list(df.columns), ['Question', 'Rate', 'Trace'])
+            self.assertEqual(list(df.Question), [
+                'test bot', 'test srai', 'no match', 'test bot',
+                'test size', 'test star a middle'])
+            self.assertEqual(df.Rate.notnull().sum(), 2)
+            self.assertTrue(df.Trace.isnull().all())
+
+            character = AIMLCharacter('sc', 'index')
+            character.load_aiml_files(character.kernel, [
+                os.path.join(self.cwd, '..', 'src', 'chatbot', 'aiml',
+                             'self-test.aiml')])
+            patterns = pattern_stats(tmpdir, 7, [character], workers=1)
+            self.assertEqual(patterns['TEST BOT'], 2)
+            self.assertEqual(patterns['SRAI TARGET'], 1)
+            self.assertNotIn('', patterns)
+
+            # the rows of a failed update are indexed again, and counted
+            # once. The replay resumes after the rows it has replayed.
+            offsets = index.load_manifest()
+            offsets[os.path.relpath(a, tmpdir)] = 0
+            index.save_manifest(offsets)
+            self.assertEqual(index.update(), 5)
+            write(now, 'c.csv', [row('test bot', user='first')])
+            patterns = pattern_stats(tmpdir, 7, [character], workers=1)
+            self.assertEqual(patterns['TEST BOT'], 3)
+            self.assertEqual(patterns['SRAI TARGET'], 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
 if __name__ == '__main__':
     unittest.main()